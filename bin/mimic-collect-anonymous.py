@@ -5,21 +5,10 @@ import asyncio
 import requests
 import time
 
-from mimic.util import proxy_dicts_from_proxy_broker_proxy, url_from_proxy
+from mimic.ingest import IngestPipeline
 from proxybroker import Broker
 
 
-async def register(proxies, endpoint):
-    while True:
-        proxy = await proxies.get()
-        if proxy is None:
-            break
-        for p in proxy_dicts_from_proxy_broker_proxy(proxy):
-            url = url_from_proxy(p)
-            resp = requests.post(endpoint, data=p).content
-            print("Resp on {}: {} on ".format(url, resp))
-
-
 def ensure_server_up(url, retries=3, delay=30):
     for i in range(retries):
         try:
@@ -33,6 +22,22 @@ def ensure_server_up(url, retries=3, delay=30):
     raise RuntimeError("Couldn't connect to {}".format(url))
 
 
+async def collect(endpoint, limit, loop):
+    pipeline = IngestPipeline(endpoint, loop=loop)
+    await pipeline.start()
+
+    proxies = asyncio.Queue(loop=loop)
+    broker = Broker(proxies, loop=loop)
+
+    # Discovery and registration share the loop; neither blocks the other.
+    await asyncio.gather(broker.find(types=[('HTTP', ('Anonymous', 'High'))],
+                                     strict=True,
+                                     limit=limit),
+                         pipeline.consume(proxies),
+                         loop=loop)
+    await pipeline.close()
+
+
 if __name__ == '__main__':
     desc = 'Collect and inject proxies from public sources'
     parser = argparse.ArgumentParser(description=desc)
@@ -41,18 +46,14 @@ if __name__ == '__main__':
                         dest='endpoint',
                         help='url to mimic server (with no trailing slash)',
                         default='http://0.0.0.0:8901')
+    parser.add_argument('--limit',
+                        action='store',
+                        dest='limit',
+                        help='the maximum number of proxies to find',
+                        default=10000,
+                        type=int)
     args = parser.parse_args()
     ensure_server_up(args.endpoint)
 
-    endpoint = args.endpoint + '/proxies/register'
-    proxies = asyncio.Queue()
-    broker = Broker(proxies)
-
-    find_coro = broker.find(types=[('HTTP', ('Anonymous', 'High'))],
-                            strict=True,
-                            limit=10000)
-    register_coro = register(proxies, endpoint)
-
-    tasks = asyncio.gather(find_coro, register_coro)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(tasks)
+    loop.run_until_complete(collect(args.endpoint, args.limit, loop))
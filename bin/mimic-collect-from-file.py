@@ -2,21 +2,29 @@
 
 import argparse
 import asyncio
-import requests
 
-from mimic.util import proxy_dicts_from_proxy_broker_proxy, url_from_proxy
+from mimic.ingest import IngestPipeline, iter_chunks, CHUNK_SIZE
 from proxybroker import Broker
 
 
-async def register(proxies, endpoint):
-    while True:
-        proxy = await proxies.get()
-        if proxy is None:
-            break
-        for p in proxy_dicts_from_proxy_broker_proxy(proxy):
-            url = url_from_proxy(p)
-            resp = requests.post(endpoint, data=p).content
-            print("Resp on {}: {} on ".format(url, resp))
+async def collect(file_path, endpoint, chunk_size, loop):
+    pipeline = IngestPipeline(endpoint, loop=loop)
+    await pipeline.start()
+
+    # Only one chunk of the file is in memory at a time. The next chunk is
+    # read once the pipeline has accepted every proxy from this one.
+    with open(file_path) as fp:
+        for chunk in iter_chunks(fp, chunk_size):
+            proxies = asyncio.Queue(loop=loop)
+            broker = Broker(proxies, loop=loop)
+            await asyncio.gather(
+                broker.find(types=[('HTTP', ('Anonymous', 'High'))],
+                            strict=True,
+                            data=chunk),
+                pipeline.consume(proxies),
+                loop=loop)
+
+    await pipeline.close()
 
 
 if __name__ == '__main__':
@@ -28,21 +36,14 @@ if __name__ == '__main__':
     parser.add_argument('endpoint',
                         metavar='ENDPOINT',
                         help='url to mimic server (with no trailing slash)')
+    parser.add_argument('--chunk-size',
+                        action='store',
+                        dest='chunk_size',
+                        help='characters of the file read at a time',
+                        default=CHUNK_SIZE,
+                        type=int)
     args = parser.parse_args()
-    endpoint = args.endpoint + '/proxies/register'
-    file_path = args.filepath
-
-    with open(file_path) as fp:
-        data = fp.read()
-
-    proxies = asyncio.Queue()
-    broker = Broker(proxies)
-
-    find_coro = broker.find(types=[('HTTP', ('Anonymous', 'High'))],
-                            strict=True,
-                            data=data)
-    register_coro = register(proxies, endpoint)
 
-    tasks = asyncio.gather(find_coro, register_coro)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(tasks)
+    loop.run_until_complete(collect(args.filepath, args.endpoint,
+                                    args.chunk_size, loop))
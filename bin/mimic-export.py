@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import argparse
+import requests
+
+from mimic.export import CHUNK_ROWS, ENCODERS, MAX_CHUNK_ROWS
+
+
+if __name__ == '__main__':
+    desc = 'Export per-domain proxy performance for offline analysis'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('output',
+                        metavar='OUTPUT',
+                        help='the file to write the export to')
+    parser.add_argument('--endpoint',
+                        action='store',
+                        dest='endpoint',
+                        help='url to mimic server (with no trailing slash)',
+                        default='http://localhost:8901')
+    parser.add_argument('--format',
+                        action='store',
+                        dest='format',
+                        help='csv, or npy (one array per chunk)',
+                        choices=sorted(ENCODERS),
+                        default='csv')
+    parser.add_argument('--chunk-rows',
+                        action='store',
+                        dest='chunk_rows',
+                        help='rows the server encodes at a time (at most '
+                             '{})'.format(MAX_CHUNK_ROWS),
+                        default=CHUNK_ROWS,
+                        type=int)
+    args = parser.parse_args()
+
+    # The export is streamed to the file as it arrives.
+    params = {'format': args.format, 'chunk_rows': args.chunk_rows}
+    with requests.get(args.endpoint + '/export', params=params,
+                      stream=True) as resp:
+        resp.raise_for_status()
+        with open(args.output, 'wb') as fp:
+            for data in resp.iter_content(chunk_size=64 * 1024):
+                fp.write(data)
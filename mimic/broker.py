@@ -1,14 +1,90 @@
 import asyncio
+import heapq
+import itertools
+import math
+from collections import OrderedDict
 
+from mimic.history import DEFAULT_TIERS, DomainHistory
+from mimic.lease import Lease, new_lease_id
+from mimic.memory import SAMPLE_SIZE, count_unknown, structure_sizes
+from mimic.query import Query
+from mimic.scheduler import (FairScheduler, Waiter, DEFAULT_CLIENT,
+                             MAX_IDLE_CLIENTS)
+from mimic.throttle import FixedThrottle
 from mimic.util import setup_logger
 
 
 LOGGER = setup_logger('broker')
 
+# Names for the hot-path log events, for sampling them (see
+# :class:`mimic.logs.SamplingFilter`).
+ACQUIRE_EVENT = {'event': 'acquire'}
+ACQUIRE_FAILED_EVENT = {'event': 'acquire_failed'}
+RELEASE_EVENT = {'event': 'release'}
+STALE_RELEASE_EVENT = {'event': 'stale_release'}
+LEASE_EXPIRED_EVENT = {'event': 'lease_expired'}
+
 ONE_SECOND = 1
 THIRTY_SECONDS = 30
 ONE_MINUTE = 60
 
+# The longest a single renewal may push a lease's deadline out.
+MAX_LEASE_EXTENSION = 60*ONE_MINUTE
+
+# The settings a live broker can change (see ``Broker.configure``), with
+# their defaults.
+TUNABLE_DEFAULTS = {'return_delay': THIRTY_SECONDS,
+                    'auto_return_delay': ONE_MINUTE,
+                    'bad_return_delay': 10*ONE_MINUTE,
+                    'max_consecutive_failures': 3,
+                    'failed_release_resp_time': THIRTY_SECONDS,
+                    'retry_time': ONE_SECOND,
+                    'client_weights': None,
+                    'client_caps': None,
+                    'max_waiters': None,
+                    'sticky_wait_time': 5,
+                    'sticky_fallbacks': 3,
+                    'proxy_capacity': None}
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised instead of parking an acquire when a waiter limit is reached.
+    """
+    def __init__(self, domain, retry_after):
+        """
+        :param domain: the domain that rejected the acquire
+        :param retry_after: the estimated seconds until a retry is useful
+        """
+        super().__init__("Too many waiters on {}".format(domain))
+        self.domain = domain
+        self.retry_after = retry_after
+
+
+class AcquireAborted(Exception):
+    """
+    Raised to parked acquires dropped before their wait was up, e.g. by a
+    server handing its state off to its successor; they may retry at once.
+    """
+
+
+class WaiterBudget:
+    """
+    A limit on parked waiters, shared by several brokers.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+
+    def try_take(self):
+        if self.in_use >= self.limit:
+            return False
+        self.in_use += 1
+        return True
+
+    def give_back(self):
+        self.in_use -= 1
+
 
 class Broker:
     """
@@ -23,6 +99,52 @@ class Broker:
     (``bad_return_delay``), assuming the maximum number of consecutive
     failures for that proxy has not been exceeded. If it has been exceeded,
     that proxy is removed permanently.
+
+    Those two delays can instead be tuned per proxy from observed outcomes
+    by passing a ``throttle_factory`` that makes a
+    :class:`mimic.throttle.AdaptiveThrottle`.
+
+    When no proxy is available, acquires park as waiters. Freed proxies are
+    handed to waiters by a weighted fair scheduler over client identities
+    (``client_weights``), so one aggressive client can't starve the rest.
+    A client holding ``client_caps[client]`` proxies is not handed more
+    until it releases one.
+
+    To keep a spike from piling up hanging requests, an acquire that would
+    park beyond ``max_waiters`` on this broker (or beyond a ``waiter_budget``
+    shared across brokers) raises :class:`AdmissionRejected` at once, with a
+    ``retry_after`` estimated from the scheduled proxy returns.
+
+    Every acquisition is a :class:`mimic.lease.Lease`. Clients may
+    :meth:`renew` a lease to push its auto-return deadline back, and a
+    release naming a lease that has already ended (e.g. by auto-return) is
+    ignored, so a slow client can't return a proxy that someone else now
+    holds.
+
+    A hedged acquire (``hedge > 1``) leases up to that many proxies at once,
+    for firing the same request through each and keeping the first answer.
+    Releasing any of them names it the winner: its outcome is recorded as
+    usual, while the others are returned after their normal cooldown with
+    no outcome or response time recorded. Each proxy in the group counts
+    against the client's cap and fair share; the group parks as one waiter.
+
+    An acquire with a ``session`` key prefers the proxy the key hashes to on
+    the domain's consistent hash ring, so a session keeps its exit address.
+    If that proxy is cooling down and due back within ``sticky_wait_time``,
+    the acquire waits for it; otherwise it falls back to the next available
+    proxy on the ring, trying up to ``sticky_fallbacks`` of them before
+    acquiring as usual.
+
+    A proxy with several slots (see
+    :class:`mimic.domain_monitor.DomainMonitor`) can be under several leases
+    at once. Auto-returns and throttling delays run per slot, keyed by
+    ``(proxy, lease id)``, so one slot cooling down leaves the others in
+    use. ``proxy_capacity`` overrides the registered
+    capacities for this domain.
+
+    Acquires, waits, releases, failures, expiries and the pool's
+    utilisation are also kept over time in fixed-size ring buffers (see
+    :class:`mimic.history.DomainHistory`), read with :meth:`history`.
     """
     def __init__(self, domain_monitor, loop=None,
                  return_delay=THIRTY_SECONDS,
@@ -30,122 +152,718 @@ class Broker:
                  bad_return_delay=10*ONE_MINUTE,
                  max_consecutive_failures=3,
                  failed_release_resp_time=THIRTY_SECONDS,
-                 retry_time=ONE_SECOND):
+                 retry_time=ONE_SECOND,
+                 client_weights=None,
+                 client_caps=None,
+                 max_waiters=None,
+                 waiter_budget=None,
+                 throttle_factory=None,
+                 sticky_wait_time=5,
+                 sticky_fallbacks=3,
+                 proxy_capacity=None,
+                 history_tiers=DEFAULT_TIERS):
 
         self._loop = loop or asyncio.get_event_loop()
         self._monitor = domain_monitor
-        self._return_delay = return_delay
-        self._auto_return_delay = auto_return_delay
-        self._bad_return_delay = bad_return_delay
-        self._max_consecutive_failures = max_consecutive_failures
-        self._failed_release_resp_time = failed_release_resp_time
-        self._retry_time = retry_time
+
+        if throttle_factory is None:
+            self._throttle = FixedThrottle(return_delay, bad_return_delay)
+        else:
+            self._throttle = throttle_factory()
+
+        self._scheduler = FairScheduler()
+        self._waiter_budget = waiter_budget
+        self._outside_waiters = 0  # Parked by multi-domain acquires.
+        self._rejected = 0
 
         self._consecutive_failures = {}
-        self._tasks = {}  # proxy -> (status, task)
+        self._tasks = {}  # (proxy, lease id) slot -> task
+        self._return_at = {}  # slot -> when its pending return is due
+        self._outcomes = {}  # cooling slot -> (response time, source)
+        self._leases = {}  # lease id -> lease
+        self._proxy_leases = {}  # proxy -> {lease id: lease}, oldest first
+        self._untokened = set()  # Ids never handed out (see ``acquire``).
+        self._lease_listeners = []
+        self._fence = 0
+        self._held = {}  # client -> number of proxies held
+        self._client_stats = {}
+        self._client_stats_limit = MAX_IDLE_CLIENTS
+        self._history = DomainHistory(self._loop.time, history_tiers)
+
+        self.configure(return_delay=return_delay,
+                       auto_return_delay=auto_return_delay,
+                       bad_return_delay=bad_return_delay,
+                       max_consecutive_failures=max_consecutive_failures,
+                       failed_release_resp_time=failed_release_resp_time,
+                       retry_time=retry_time,
+                       client_weights=client_weights,
+                       client_caps=client_caps,
+                       max_waiters=max_waiters,
+                       sticky_wait_time=sticky_wait_time,
+                       sticky_fallbacks=sticky_fallbacks,
+                       proxy_capacity=proxy_capacity)
+
+        self._monitor.add_listener(self._dispatch)
 
         LOGGER.info("Initiated Broker on %s", self._monitor.domain)
 
-    async def acquire(self, *requirements, max_wait_time=ONE_MINUTE):
+    def configure(self, **settings):
+        """
+        Change a live broker's settings, keeping its leases, waiters and
+        learned state. Settings not given go back to ``TUNABLE_DEFAULTS``.
+
+        New delays apply from the next lease or release; a running lease
+        keeps its deadline. An adaptive throttle keeps its own cooldowns.
+
+        :param settings: any of the keys of ``TUNABLE_DEFAULTS``
+        """
+        unknown = set(settings) - set(TUNABLE_DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown broker settings: {}".format(
+                ", ".join(sorted(unknown))))
+
+        settings = dict(TUNABLE_DEFAULTS, **settings)
+        # First, as it checks the weights before anything has changed.
+        self._scheduler.set_weights(settings['client_weights'])
+        self._auto_return_delay = settings['auto_return_delay']
+        self._max_consecutive_failures = settings['max_consecutive_failures']
+        self._failed_release_resp_time = settings['failed_release_resp_time']
+        self._retry_time = settings['retry_time']
+        self._max_waiters = settings['max_waiters']
+        self._sticky_wait_time = settings['sticky_wait_time']
+        self._sticky_fallbacks = settings['sticky_fallbacks']
+        self._throttle.reconfigure(settings['return_delay'],
+                                   settings['bad_return_delay'])
+        self._client_caps = dict(settings['client_caps'] or {})
+        if settings['proxy_capacity'] != self._monitor.capacity_override:
+            self._monitor.set_capacity(settings['proxy_capacity'])
+
+        # Looser caps may let waiters through.
+        self._dispatch()
+
+    async def acquire(self, *requirements, max_wait_time=ONE_MINUTE,
+                      client=None, hedge=1, session=None):
         """
         Acquire a proxy for use with this broker's domain.
 
         :param requirements: the tagged requirements for a proxy
         :param max_wait_time: the maximum time to wait before failing
+        :param client: the requesting client's identity, for fair sharing
+        :param hedge: lease up to this many proxies together (only the
+            first is returned here; see :meth:`acquire_lease`)
+        :param session: a session key to keep on the same proxy
         :return: the proxy string, or None if the ``max_wait_time`` was
             exceeded.
+        :raises AdmissionRejected: if the acquire would have to wait but
+            too many acquires are waiting already
         """
+        lease = await self.acquire_lease(*requirements,
+                                         max_wait_time=max_wait_time,
+                                         client=client, hedge=hedge,
+                                         session=session)
+        if lease is None:
+            return None
+
+        # The caller never sees the lease, so only this lease may be ended
+        # by a release without a lease id or fence.
+        self._untokened.add(lease.id)
+        return lease.proxy
+
+    async def acquire_lease(self, *requirements, max_wait_time=ONE_MINUTE,
+                            client=None, hedge=1, session=None):
+        """
+        Like :meth:`acquire`, but return the :class:`mimic.lease.Lease`.
+        """
+        client = client or DEFAULT_CLIENT
         start_time = self._loop.time()
-        proxy = self._monitor.acquire(*requirements)
+        query = Query.compile(requirements)
+
+        lease = None
+        if session is not None:
+            lease = await self._acquire_for_session(query, client, session,
+                                                    max_wait_time)
+
+        # Only skip the queue when nobody is queued ahead.
+        if lease is None and not self._scheduler:
+            proxies = self._take(query, self._room(client, hedge))
+            if proxies:
+                lease = self._grant(proxies, client)
 
-        # If the proxy is None, there were no proxies currently available.
-        # Sleep for the maximum_wait_time, then try again.
-        # This doesn't FIFO queue at all. It's just stochastic.
-        while proxy is None and self._loop.time() - start_time < max_wait_time:
-            await asyncio.sleep(self._retry_time)
-            proxy = self._monitor.acquire(*requirements)
+        if lease is None and max_wait_time > 0:
+            self._admit()
+            lease = await self._wait_for_lease(query, client, start_time,
+                                               max_wait_time, hedge)
+
+        self._record_wait(client, self._loop.time() - start_time,
+                          lease is not None)
 
         # No proxy acquired within the max_wait_time.
-        if proxy is None:
-            LOGGER.info("Failed to acquire on %s", self._monitor.domain)
-            LOGGER.info("\tcount={}".format(len(self._monitor._proxies)))
+        if lease is None:
+            LOGGER.info("Failed to acquire on %s (count=%s)",
+                        self._monitor.domain, self._monitor.available,
+                        extra=ACQUIRE_FAILED_EVENT)
             return None  # None could be acquired.
 
-        # Create auto-return task.
-        coro = self._return_after(proxy,
-                                  self._failed_release_resp_time,
-                                  self._auto_return_delay)
-        self._tasks[proxy] = self._loop.create_task(coro)
+        LOGGER.info("Acquire %s on %s (count=%s)", lease.proxies,
+                    self._monitor.domain, self._monitor.available,
+                    extra=ACQUIRE_EVENT)
+        return lease
+
+    def can_lease_now(self, client=None):
+        """
+        :return: whether an available proxy would be leased to the client
+            without queueing
+        """
+        client = client or DEFAULT_CLIENT
+        return not self._scheduler and not self._at_cap(client)
 
-        LOGGER.info("Acquire %s on %s", proxy, self._monitor.domain)
-        LOGGER.info("\tcount={}".format(len(self._monitor._proxies)))
-        return proxy
+    def lease_available(self, proxy, client=None, waited=0.0):
+        """
+        Lease a specific proxy at once, without queueing.
 
-    def release(self, proxy, response_time, is_failure=False):
+        :param proxy: the proxy string
+        :param client: the requesting client's identity
+        :param waited: the time the caller spent waiting, for client stats
+        :return: the lease, or None if the proxy isn't available to the
+            client right now
+        """
+        client = client or DEFAULT_CLIENT
+        if not self.can_lease_now(client) or not self._monitor.take(proxy):
+            return None
+
+        self._record_wait(client, waited, True)
+        return self._grant([proxy], client)
+
+    async def _acquire_for_session(self, query, client, session,
+                                   max_wait_time):
+        """
+        :return: a lease on the session's proxy or one of its fallbacks on
+            the hash ring, or None
+        """
+        preferred = next(self._monitor.session_proxies(session, query), None)
+        if preferred is None:
+            return None
+
+        # The earliest of its slots to come back from cooling down.
+        due = min((at for (proxy, lease_id), at in self._return_at.items()
+                   if proxy == preferred and lease_id not in self._leases),
+                  default=None)
+        if due is not None and not self._monitor.is_available(preferred):
+            # Cooling down; wait for it if it's due back soon enough.
+            delay = due - self._loop.time()
+            if delay <= min(self._sticky_wait_time, max_wait_time):
+                await asyncio.sleep(max(0, delay), loop=self._loop)
+                await asyncio.sleep(0, loop=self._loop)
+
+        # The pool may have changed while waiting, so walk the ring afresh.
+        ring = self._monitor.session_proxies(session, query)
+        for proxy in itertools.islice(ring, 1 + self._sticky_fallbacks):
+            if self.can_lease_now(client) and self._monitor.take(proxy):
+                return self._grant([proxy], client)
+        return None
+
+    def _take(self, query, n):
+        """
+        :return: up to ``n`` distinct matching proxies taken from the
+            monitor
+        """
+        proxies = []
+        while len(proxies) < n:
+            proxy = self._monitor.acquire(query, exclude=proxies)
+            if proxy is None:
+                break
+            proxies.append(proxy)
+        return proxies
+
+    def _grant(self, proxies, client):
+        """
+        Lease proxies just taken from the monitor and start their
+        auto-return.
+        """
+        self._fence += 1
+        now = self._loop.time()
+        return self._install(Lease(proxies, client, self._fence, now,
+                                   now + self._auto_return_delay))
+
+    def _install(self, lease):
+        """
+        Track a lease on proxies taken from the monitor until its deadline.
+        """
+        self._leases[lease.id] = lease
+        self._held[lease.client] = (self._held.get(lease.client, 0)
+                                    + len(lease.proxies))
+        task = self._loop.create_task(self._auto_return(lease))
+        for proxy in lease.proxies:
+            leases = self._proxy_leases.get(proxy)
+            if leases is None:
+                leases = self._proxy_leases[proxy] = OrderedDict()
+            leases[lease.id] = lease
+            self._tasks[proxy, lease.id] = task
+            self._return_at[proxy, lease.id] = lease.deadline
+
+        return lease
+
+    def _end_lease(self, lease):
+        """
+        Forget a lease, cancelling its auto-return.
+        """
+        del self._leases[lease.id]
+        self._untokened.discard(lease.id)
+        for proxy in lease.proxies:
+            self._monitor.lease_ended(proxy)
+            self._forget_slot(proxy, lease.id)
+            self._cancel_slot((proxy, lease.id))
+
+        self._unhold(lease.client, len(lease.proxies))
+        for callback in self._lease_listeners:
+            callback(lease)
+
+    def add_lease_listener(self, callback):
+        """
+        :param callback: called with every lease that ends, however it ends
+        """
+        self._lease_listeners.append(callback)
+
+    def _forget_slot(self, proxy, lease_id):
+        leases = self._proxy_leases.get(proxy)
+        if leases is not None and leases.pop(lease_id, None) and not leases:
+            del self._proxy_leases[proxy]
+
+    def _unhold(self, client, n):
+        held = self._held[client] - n
+        if held:
+            self._held[client] = held
+        else:
+            del self._held[client]
+
+        if self._client_caps.get(client) is not None:
+            self._dispatch()
+
+    def get_lease(self, lease_id):
+        """
+        :return: the live lease with that id, or None
+        """
+        return self._leases.get(lease_id)
+
+    def lease_for(self, proxy):
+        """
+        :return: the oldest live lease on a proxy, or None
+        """
+        leases = self._proxy_leases.get(proxy)
+        return next(iter(leases.values())) if leases else None
+
+    def _lease_to_release(self, proxy, lease_id, fence):
+        """
+        :return: the live lease on the proxy with the id or, failing that,
+            the fence; without either, the oldest lease whose id was never
+            handed out (see :meth:`acquire`). None if there is no such lease.
+        """
+        leases = self._proxy_leases.get(proxy, {})
+        if lease_id is not None:
+            return leases.get(lease_id)
+        if fence is not None:
+            return next((lease for lease in leases.values()
+                         if lease.fence == fence), None)
+        return next((lease for lease in leases.values()
+                     if lease.id in self._untokened), None)
+
+    def renew(self, lease_id, extension=None):
+        """
+        Push a live lease's auto-return deadline back.
+
+        :param lease_id: the lease's id
+        :param extension: seconds from now until the new deadline; defaults
+            to ``auto_return_delay``
+        :return: the renewed lease, or None if it already ended
+        :raises ValueError: unless ``0 < extension <= MAX_LEASE_EXTENSION``
+        """
+        if extension is None:
+            extension = self._auto_return_delay
+        elif not 0 < extension <= MAX_LEASE_EXTENSION:  # False for NaN too.
+            raise ValueError("extension must be in (0, {}] seconds".format(
+                MAX_LEASE_EXTENSION))
+
+        lease = self._leases.get(lease_id)
+        if lease is None:
+            return None
+
+        lease.deadline = self._loop.time() + extension
+        for proxy in lease.proxies:
+            self._return_at[proxy, lease.id] = lease.deadline
+        return lease
+
+    async def _auto_return(self, lease):
+        """
+        Return a leased proxy once its (possibly renewed) deadline passes.
+        """
+        try:
+            # Renewals just move the deadline; the sleep catches up.
+            while True:
+                remaining = lease.deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining, loop=self._loop)
+        except asyncio.CancelledError:
+            return
+
+        LOGGER.info("Lease on %s expired on %s",
+                    lease.proxies, self._monitor.domain,
+                    extra=LEASE_EXPIRED_EVENT)
+        for proxy in lease.proxies:
+            self._tasks.pop((proxy, lease.id), None)
+            self._return_at.pop((proxy, lease.id), None)
+        self._end_lease(lease)
+        self._history.record(expired=1)
+        for proxy in lease.proxies:
+            self._monitor.release(proxy, self._failed_release_resp_time,
+                                  'penalty')
+
+    async def _wait_for_lease(self, query, client, start_time, max_wait_time,
+                              hedge):
+        waiter = Waiter(client, query, self._loop.create_future(), start_time,
+                        hedge)
+        self._scheduler.push(waiter)
+        self._dispatch()
+
+        deadline = start_time + max_wait_time
+        try:
+            while not waiter.future.done():
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    # Let returns due at the deadline land before giving up.
+                    await asyncio.sleep(0, loop=self._loop)
+                    self._dispatch()
+                    break
+
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future),
+                                           min(self._retry_time, remaining),
+                                           loop=self._loop)
+                except asyncio.TimeoutError:
+                    # Registrations normally notify; this is a safety net.
+                    if self._monitor.available:
+                        self._dispatch()
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        finally:
+            if self._waiter_budget is not None:
+                self._waiter_budget.give_back()
+
+        if waiter.future.done():
+            return waiter.future.result()
+
+        self._scheduler.remove(waiter)
+        return None
+
+    def _admit(self, take_budget=True):
+        """
+        Reserve room for one more waiter, or reject the acquire.
+
+        :param take_budget: whether to take room in the shared waiter
+            budget too
+        """
+        if (self._max_waiters is not None
+                and len(self._scheduler) + self._outside_waiters
+                >= self._max_waiters):
+            self._reject()
+
+        if (take_budget and self._waiter_budget is not None
+                and not self._waiter_budget.try_take()):
+            self._reject()
+
+    def admit_outside_waiter(self, take_budget=True):
+        """
+        Count an acquire parked outside this broker's queue (a multi-domain
+        acquire; see :meth:`mimic.brokerage.Brokerage.acquire_multi`)
+        against ``max_waiters`` and, with ``take_budget``, the shared waiter
+        budget.
+
+        :raises AdmissionRejected: if there is no room for it
+        """
+        self._admit(take_budget)
+        self._outside_waiters += 1
+
+    def outside_waiter_left(self, give_back_budget=True):
+        self._outside_waiters -= 1
+        if give_back_budget and self._waiter_budget is not None:
+            self._waiter_budget.give_back()
+
+    def _reject(self):
+        self._rejected += 1
+        retry_after = self.estimate_retry_after()
+        LOGGER.info("Rejected an acquire on %s; retry after %s",
+                    self._monitor.domain, retry_after)
+        raise AdmissionRejected(self._monitor.domain, retry_after)
+
+    def estimate_retry_after(self):
+        """
+        Estimate when a new waiter would be served.
+
+        The waiters already queued take the earliest scheduled returns; a
+        newcomer gets the next one. Past the known returns, every further
+        round through the pool is assumed to take the mean cooldown.
+
+        :return: whole seconds, at least one
+        """
+        cooldown = self._throttle.mean_cooldown()
+        n = len(self._return_at)
+        if n == 0:
+            return max(1, int(math.ceil(cooldown)))
+
+        rounds, i = divmod(len(self._scheduler), n)
+        due = heapq.nsmallest(i + 1, self._return_at.values())[-1]
+        eta = due - self._loop.time() + rounds * cooldown
+        return max(1, int(math.ceil(eta)))
+
+    def _abandon(self, waiter):
+        """
+        Drop a waiter whose caller went away, returning any proxy it was
+        handed in the meantime.
+        """
+        if self._scheduler.remove(waiter):
+            return
+
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.cancel_lease(waiter.future.result().id)
+
+    def cancel_lease(self, lease_id):
+        """
+        Undo a lease granted moments ago, e.g. one part of a multi-domain
+        acquire that couldn't be completed, putting its proxies straight
+        back without recording an outcome.
+
+        :return: True if the lease was still live
+        """
+        lease = self._leases.get(lease_id)
+        if lease is None:
+            return False
+
+        self._end_lease(lease)
+        for proxy in lease.proxies:
+            self._monitor.release(proxy, 0)
+        return True
+
+    def _dispatch(self):
+        """
+        Hand available proxies to parked waiters, in fair-share order.
+        """
+        progress = bool(self._scheduler)
+        while progress and self._monitor.available:
+            progress = False
+            for client in self._scheduler.clients_in_order():
+                if self._at_cap(client):
+                    continue
+
+                for waiter in self._scheduler.waiters_of(client):
+                    if waiter.future.done():
+                        self._scheduler.remove(waiter)
+                        continue
+
+                    proxies = self._take(waiter.query,
+                                         self._room(client, waiter.size))
+                    if proxies:
+                        self._scheduler.remove(waiter)
+                        self._scheduler.charge(client, len(proxies))
+                        waiter.future.set_result(self._grant(proxies, client))
+                        progress = True
+                        break
+
+                if progress:
+                    break  # The order changed; start over.
+
+    def _at_cap(self, client):
+        return self._room(client, 1) == 0
+
+    def _room(self, client, wanted):
+        """
+        :return: how many of ``wanted`` proxies the client's cap allows
+        """
+        cap = self._client_caps.get(client)
+        if cap is None:
+            return wanted
+
+        # Proxies handed to waiters that haven't resumed yet count, too.
+        return max(0, min(wanted, cap - self._held.get(client, 0)))
+
+    def _record_wait(self, client, wait_time, acquired):
+        stats = self._client_stats.get(client)
+        if stats is None:
+            if len(self._client_stats) > self._client_stats_limit:
+                self._prune_client_stats()
+            stats = self._client_stats[client] = {'acquired': 0,
+                                                  'timed_out': 0,
+                                                  'total_wait': 0.0,
+                                                  'max_wait': 0.0}
+
+        outcome = 'acquired' if acquired else 'timed_out'
+        stats[outcome] += 1
+        stats['total_wait'] += wait_time
+        stats['max_wait'] = max(stats['max_wait'], wait_time)
+
+        self._history.record(wait=wait_time,
+                             utilisation=self._monitor.utilisation(),
+                             samples=1, **{outcome: 1})
+
+    def _prune_client_stats(self):
+        """
+        Forget the statistics of clients with nothing parked or held, once
+        ``MAX_IDLE_CLIENTS`` have built up.
+        """
+        self._client_stats = {
+            client: stats for client, stats in self._client_stats.items()
+            if self._scheduler.waiting_for(client) or self._held.get(client)}
+        self._client_stats_limit = (len(self._client_stats) +
+                                    MAX_IDLE_CLIENTS)
+
+    def client_stats(self):
+        """
+        :return: per-client acquisition and wait-time statistics
+        """
+        res = {}
+        for client, stats in self._client_stats.items():
+            n = stats['acquired'] + stats['timed_out']
+            res[client] = {'acquired': stats['acquired'],
+                           'timed_out': stats['timed_out'],
+                           'avg_wait': stats['total_wait'] / n,
+                           'max_wait': stats['max_wait'],
+                           'waiting': self._scheduler.waiting_for(client),
+                           'held': self._held.get(client, 0),
+                           'weight': self._scheduler.weight(client)}
+        return res
+
+    def release(self, proxy, response_time=None, is_failure=False,
+                lease=None, fence=None):
         """
         Release the proxy so others can acquire it.
 
         :param proxy: the proxy string
         :param response_time: the time it took to make a request using the
-            given proxy
+            given proxy, as measured by the client. If None, the time since
+            the lease was granted stands in for it, recorded as an estimate.
         :param is_failure: if True, indicate the proxy failed to yield the
             targeted page
-        """
-        self._cancel_tasks_on(proxy)
+        :param lease: the lease id from the acquire; if given, the release
+            only counts while that lease is live
+        :param fence: the lease's fence, identifying it in place of the id
+        :return: True if the release was applied, False if it was stale
 
+        Without a lease id or fence, only a lease from :meth:`acquire`
+        (whose id the caller never saw) is released. This way a late
+        release from an earlier holder cannot free the proxy under the
+        holder that leased it since.
+
+        For a hedged lease, ``proxy`` is the winner, and the rest of the
+        group is returned unpenalised.
+        """
         # TODO: Remove these checks!
         assert proxy is not None, "Released a NONE!"
 
+        current = self._lease_to_release(proxy, lease, fence)
+        if current is None:
+            LOGGER.info("Ignoring stale release of %s on %s",
+                        proxy, self._monitor.domain,
+                        extra=STALE_RELEASE_EVENT)
+            return False
+
+        source = 'measured'
+        if response_time is None:
+            source = 'estimated'
+            response_time = self._loop.time() - current.acquired_at
+
+        self._end_lease(current)
+        self._monitor.record_outcome(proxy, is_failure)
+        self._history.record(released=1, failed=int(is_failure),
+                             utilisation=self._monitor.utilisation(),
+                             samples=1)
+
         if is_failure:
             failures = self._consecutive_failures.get(proxy, 0) + 1
             if failures >= self._max_consecutive_failures:
                 LOGGER.info("Proxy %s failed out on %s",
                             proxy, self._monitor.domain)
                 del self._consecutive_failures[proxy]
+                self._throttle.forget(proxy)
+                self._monitor.retire(proxy)
             else:
                 self._consecutive_failures[proxy] = failures
-                coro = self._return_after(proxy,
-                                          self._failed_release_resp_time,
-                                          self._bad_return_delay)
-                self._tasks[proxy] = self._loop.create_task(coro)
+                self._schedule_return(proxy, current.id,
+                                      self._failed_release_resp_time,
+                                      self._throttle.cooldown(proxy, True),
+                                      'penalty')
 
         else:
             # This request was successful. Reset consecutive failures counter.
             if proxy in self._consecutive_failures:
                 del self._consecutive_failures[proxy]
 
-            coro = self._return_after(proxy, response_time, self._return_delay)
-            self._tasks[proxy] = self._loop.create_task(coro)
+            self._schedule_return(proxy, current.id, response_time,
+                                  self._throttle.cooldown(proxy, False),
+                                  source)
+
+        for loser in current.proxies:
+            if loser != proxy:
+                # Zero leaves its response time alone.
+                self._schedule_return(loser, current.id, 0,
+                                      self._throttle.current(loser))
 
-    async def _return_after(self, proxy, response_time, wait_seconds):
+        return True
+
+    def _schedule_return(self, proxy, lease_id, response_time, wait_seconds,
+                         source='measured'):
+        slot = (proxy, lease_id)
+        self._outcomes[slot] = (response_time, source)
+        coro = self._return_after(slot, response_time, wait_seconds, source)
+        self._tasks[slot] = self._loop.create_task(coro)
+
+    async def _return_after(self, slot, response_time, wait_seconds,
+                            source='measured'):
         """
-        Release a proxy for subsequent usage after some throttling delay.
+        Release a proxy's slot for subsequent usage after some throttling
+        delay.
 
-        :param proxy: the proxy string
+        :param slot: the ``(proxy, lease id)`` the slot was leased under
         :param response_time: the time a request took using this proxy
         :param wait_seconds: the number of seconds to wait before returning
-            the proxy
+            the slot
+        :param source: where the response time came from (see
+            :meth:`mimic.domain_monitor.DomainMonitor.release`)
         """
+        proxy = slot[0]
         # TODO: Add check for None
         assert proxy is not None, "Released a NONE!"
 
         LOGGER.info("Waiting %s to release %s on %s",
-                    wait_seconds, proxy, self._monitor.domain)
+                    wait_seconds, proxy, self._monitor.domain,
+                    extra=RELEASE_EVENT)
+        self._return_at[slot] = self._loop.time() + wait_seconds
         try:
-            # This is a cheap form of per-domain, per-proxy throttling.
+            # This is a cheap form of per-domain, per-slot throttling.
             await asyncio.sleep(wait_seconds, loop=self._loop)
-            self._monitor.release(proxy, response_time)
+            self._return_at.pop(slot, None)
+            self._outcomes.pop(slot, None)
+            self._monitor.release(proxy, response_time, source)
 
-            # Only one task should exist at any moment each any proxy.
-            if proxy in self._tasks:
-                del self._tasks[proxy]
+            # Only one task should exist at any moment for any slot.
+            if slot in self._tasks:
+                del self._tasks[slot]
         except asyncio.CancelledError:
             pass
 
-    def _cancel_tasks_on(self, proxy):
-        existing_task = self._tasks.get(proxy)
+    def _cancel_slot(self, slot):
+        existing_task = self._tasks.pop(slot, None)
         if existing_task:
             existing_task.cancel()
+        self._return_at.pop(slot, None)
+        self._outcomes.pop(slot, None)
+
+    def _cancel_tasks_on(self, proxies):
+        for slot in [slot for slot in self._tasks if slot[0] in proxies]:
+            self._cancel_slot(slot)
+        for slot in [slot for slot in self._return_at
+                     if slot[0] in proxies]:
+            del self._return_at[slot]
+            self._outcomes.pop(slot, None)
 
     def register(self, proxy):
         """
@@ -157,15 +875,183 @@ class Broker:
         """
         Remove a proxy from this broker's pool.
         """
-        self._monitor.delist(proxy)
-        self._cancel_tasks_on(proxy)
+        self.delist_many((proxy,))
+
+    def delist_many(self, proxies):
+        """
+        Remove several proxies from this broker's pool at once, cancelling
+        their pending returns in a single pass over the tasks.
+        """
+        proxies = set(proxies)
+        self._monitor.delist_many(proxies)
+
+        for proxy in proxies:
+            for lease in list(self._proxy_leases.get(proxy, {}).values()):
+                if len(lease.proxies) > 1:
+                    # Drop it from the group, leaving the rest of the lease
+                    # running.
+                    lease.proxies = tuple(p for p in lease.proxies
+                                          if p != proxy)
+                    self._forget_slot(proxy, lease.id)
+                    self._tasks.pop((proxy, lease.id), None)
+                    self._monitor.lease_ended(proxy)
+                    self._unhold(lease.client, 1)
+                else:
+                    self._end_lease(lease)
+
+            self._consecutive_failures.pop(proxy, None)
+            self._throttle.forget(proxy)
+
+        self._cancel_tasks_on(proxies)
+
+    def abort_waiters(self):
+        """
+        Drop every parked acquire, raising :class:`AcquireAborted` in it.
+
+        :return: the number dropped
+        """
+        waiters = [waiter for client in self._scheduler.clients_in_order()
+                   for waiter in self._scheduler.waiters_of(client)]
+        for waiter in waiters:
+            self._scheduler.remove(waiter)
+            if not waiter.future.done():
+                waiter.future.set_exception(AcquireAborted(
+                    "Dropped from {}".format(self._monitor.domain)))
+        return len(waiters)
+
+    def snapshot(self):
+        """
+        Capture the broker's live state as plain data, for a successor
+        process to :meth:`restore` (see :mod:`mimic.handoff`).
+
+        Deadlines are kept as seconds remaining, since loop times don't
+        carry across processes. Waiters aren't included; see
+        :meth:`abort_waiters`.
+        """
+        now = self._loop.time()
+        leases = []
+        for lease in self._leases.values():
+            held = lease.to_dict(now)
+            held['client'] = lease.client
+            held['held_for'] = now - lease.acquired_at
+            leases.append(held)
+
+        cooling = []
+        for slot, at in self._return_at.items():
+            if slot[1] not in self._leases:
+                response_time, source = self._outcomes.get(slot, (0, None))
+                cooling.append({'proxy': slot[0],
+                                'returns_in': max(0.0, at - now),
+                                'response_time': response_time,
+                                'source': source})
+
+        return {'monitor': self._monitor.snapshot(),
+                'leases': leases,
+                'cooling': cooling,
+                'fence': self._fence,
+                'consecutive_failures': dict(self._consecutive_failures)}
+
+    def restore(self, snapshot):
+        """
+        Take over the state of another broker's :meth:`snapshot`: learned
+        response times, failure counts, live leases (same ids, fences and
+        remaining time) and slots still cooling down.
+
+        Proxies not registered here, or without a free slot, are skipped.
+        """
+        self._monitor.restore(snapshot['monitor'])
+        self._fence = max(self._fence, snapshot['fence'])
+        self._consecutive_failures.update(
+            (proxy, n) for proxy, n
+            in snapshot['consecutive_failures'].items()
+            if self._monitor.is_registered(proxy))
+
+        now = self._loop.time()
+        for held in snapshot['leases']:
+            proxies = [p for p in held['proxies'] if self._monitor.take(p)]
+            if proxies:
+                self._install(Lease(proxies, held['client'], held['fence'],
+                                    now - held['held_for'],
+                                    now + held['expires_in'],
+                                    lease_id=held['lease']))
+
+        for slot in snapshot['cooling']:
+            proxy = slot['proxy']
+            if self._monitor.take(proxy):
+                self._monitor.lease_ended(proxy)
+                self._schedule_return(proxy, new_lease_id(),
+                                      slot['response_time'],
+                                      slot['returns_in'],
+                                      slot['source'] or 'measured')
+
+    def task_counts(self):
+        """
+        :return: the number of pending auto-returns (one per lease),
+            throttled returns (one per cooling slot) and parked waiters
+        """
+        throttled = sum(1 for _, lease_id in self._tasks
+                        if lease_id not in self._leases)
+        return {'auto_return': len(self._leases),
+                'throttled_return': throttled,
+                'waiters': len(self._scheduler)}
+
+    def history(self, window=None, step=None):
+        """
+        :return: the domain's recent activity, downsampled (see
+            :meth:`mimic.history.DomainHistory.series`)
+        """
+        return self._history.series(window, step)
+
+    def memory_usage(self, sample=SAMPLE_SIZE):
+        """
+        :return: the estimated bytes of each of the broker's structures (see
+            :func:`mimic.memory.estimate_size`), not counting its monitor's
+        """
+        sizes = structure_sizes(self, ('_tasks', '_return_at', '_outcomes',
+                                       '_leases', '_proxy_leases',
+                                       '_untokened',
+                                       '_consecutive_failures', '_held',
+                                       '_client_stats', '_scheduler',
+                                       '_throttle'), sample)
+        sizes['history'] = self._history.nbytes
+        return sizes
+
+    def leaks(self):
+        """
+        :return: counts of entries that should have gone: tasks, returns
+            and failure counters kept for proxies no longer registered,
+            finished tasks never removed, and references to ended leases
+        """
+        registered = self._monitor.is_registered
+        ended = sum(1 for leases in self._proxy_leases.values()
+                    for lease_id in leases if lease_id not in self._leases)
+        return {'orphaned_tasks': count_unknown(
+                    (proxy for proxy, _ in self._tasks), registered),
+                'finished_tasks': sum(1 for task in self._tasks.values()
+                                      if task.done()),
+                'orphaned_returns': count_unknown(
+                    (proxy for proxy, _ in self._return_at), registered),
+                'stale_failure_counters': count_unknown(
+                    self._consecutive_failures, registered),
+                'ended_lease_refs': ended}
 
     def stats(self):
         """
-        :return: the underlying monitor's stats
+        :return: the underlying monitor's stats, plus waiter, throttle and
+            per-client stats
         """
-        return self._monitor.stats()
+        stats = self._monitor.stats()
+        stats['waiting'] = len(self._scheduler)
+        stats['rejected'] = self._rejected
+        stats['leased'] = len(self._leases)
+        stats['throttle'] = self._throttle.stats()
+        stats['clients'] = self.client_stats()
+        return stats
 
     @property
     def monitor(self):
         return self._monitor
+
+    @property
+    def loop(self):
+        return self._loop
@@ -1,41 +1,448 @@
-from mimic.broker import Broker
+import asyncio
+import sys
+from mimic.broker import (AcquireAborted, AdmissionRejected, Broker,
+                          WaiterBudget, TUNABLE_DEFAULTS)
 from mimic.domain_monitor import DomainMonitor
-from mimic.util import parse_and_intern_domain
+from mimic.lease import new_lease_id
+from mimic.memory import SAMPLE_SIZE, estimate_size
+from mimic.policy import PolicyTable
+from mimic.proxy_state import ProxyState
+from mimic.query import Query
+from mimic.util import DEFAULT_RESOLVER
 
 
 class Brokerage:
-    def __init__(self, proxy_collection, broker_opts=None):
+    def __init__(self, proxy_collection, broker_opts=None,
+                 domain_resolver=None, max_total_waiters=None,
+                 selection_policy_factory=None, proxy_state=None,
+                 policy_table=None):
+        """
+        :param broker_opts: keyword arguments for every ``Broker``
+        :param domain_resolver: maps urls to broker domains
+        :param max_total_waiters: the limit on acquires parked across all
+            domains, or None for no limit
+        :param selection_policy_factory: makes each domain's proxy selection
+            policy (see :mod:`mimic.selection`)
+        :param proxy_state: the per-proxy lease caps and failure scores
+            shared by all domains
+        :param policy_table: a :class:`mimic.policy.PolicyTable` of
+            per-domain broker settings, over ``broker_opts``
+        """
         self._proxy_collection = proxy_collection
         self._broker_opts = broker_opts or {}
+        self._domain_resolver = domain_resolver or DEFAULT_RESOLVER
+        self._waiter_budget = None
+        if max_total_waiters is not None:
+            self._waiter_budget = WaiterBudget(max_total_waiters)
+        self._selection_policy_factory = selection_policy_factory
+        self._proxy_state = proxy_state or ProxyState()
+        self._policy_table = policy_table or PolicyTable()
         self._brokers = {}
+        self._multi_leases = {}  # group lease id -> [(domain, lease)]
+        self._multi_groups = {}  # per-domain lease id -> group lease id
+        self._multi_waits = set()  # Wake-up events of waiting multi acquires
+        self._aborts = 0
 
-    async def acquire(self, request_url, requirements, max_wait_time):
-        domain = parse_and_intern_domain(request_url)
+    def resolve_domain(self, request_url):
+        """
+        :return: the interned domain keying the broker for the url
+        """
+        return self._domain_resolver.resolve(request_url)
+
+    def _broker_for(self, domain):
         broker = self._brokers.get(domain)
         if not broker:
-            monitor = DomainMonitor(domain)
+            policy = None
+            if self._selection_policy_factory is not None:
+                policy = self._selection_policy_factory()
+            monitor = DomainMonitor(domain, selection_policy=policy,
+                                    proxy_state=self._proxy_state)
             self._proxy_collection.register_domain_monitor(monitor)
-            broker = Broker(monitor, **self._broker_opts)
+            opts = dict(self._broker_opts)
+            opts.update(self._policy_table.settings_for(domain))
+            broker = Broker(monitor, waiter_budget=self._waiter_budget,
+                            **opts)
+            broker.add_lease_listener(self._lease_ended)
             self._brokers[domain] = broker
+        return broker
+
+    async def acquire(self, request_url, requirements, max_wait_time,
+                      client=None, hedge=1, session=None):
+        domain = self._domain_resolver.resolve(request_url)
+        broker = self._broker_for(domain)
 
-        return {'broker': domain,
-                'proxy': await broker.acquire(*requirements,
-                                              max_wait_time=max_wait_time)}
+        lease = await broker.acquire_lease(*requirements,
+                                           max_wait_time=max_wait_time,
+                                           client=client, hedge=hedge,
+                                           session=session)
+        if lease is None:
+            return {'broker': domain, 'proxy': None, 'proxies': [],
+                    'lease': None}
 
-    async def release(self, domain, proxy, response_time, is_failure):
+        res = lease.to_dict(broker.loop.time())
+        res['broker'] = domain
+        return res
+
+    async def release(self, domain, proxy, response_time, is_failure,
+                      lease=None, fence=None):
         broker = self._brokers.get(domain)
         if not broker:
             return False
 
-        broker.release(proxy, response_time, is_failure)
-        return True
+        return broker.release(proxy, response_time, is_failure, lease=lease,
+                              fence=fence)
+
+    async def acquire_multi(self, request_urls, requirements, max_wait_time,
+                            client=None):
+        """
+        Lease one proxy for every domain of several urls at once (e.g. a
+        page's origin, CDN and API), so they all see the same exit address.
+
+        The proxy is picked from the intersection of the domains' available
+        proxies matching the requirements, and leased on all of them in one
+        step. While there is none, this waits for proxies to be released
+        on any of the domains, up to ``max_wait_time``, counting as a
+        waiter on every one of them.
+
+        :return: the group's ``lease``, the ``proxy``, the ``brokers`` and
+            each broker's own lease id under ``leases``
+        :raises AdmissionRejected: if it would have to wait but any of the
+            domains (or the shared budget) has too many waiters already
+        :raises ValueError: if there are no urls, or two share a domain
+        """
+        domains = [self._domain_resolver.resolve(url) for url in request_urls]
+        if not domains:
+            raise ValueError("Expected one or more urls")
+        if len(set(domains)) != len(domains):
+            raise ValueError("Expected urls on distinct domains")
+        brokers = [self._broker_for(domain) for domain in domains]
+        query = Query.compile(requirements)
+
+        loop = brokers[0].loop
+        start_time = loop.time()
+        deadline = start_time + max_wait_time
+        released = asyncio.Event(loop=loop)
+        for broker in brokers:
+            broker.monitor.add_listener(released.set)
+        self._multi_waits.add(released)
+        aborts = self._aborts
+        parked = False
+
+        try:
+            while True:
+                if self._aborts != aborts:
+                    raise AcquireAborted("Dropped from {}".format(
+                        ", ".join(domains)))
+                released.clear()
+                leases = self._lease_common(brokers, query, client,
+                                            loop.time() - start_time)
+                remaining = deadline - loop.time()
+                if leases or remaining <= 0:
+                    break
+
+                if not parked:
+                    self._admit_multi(brokers)
+                    parked = True
+                try:
+                    await asyncio.wait_for(released.wait(), remaining,
+                                           loop=loop)
+                except asyncio.TimeoutError:
+                    pass  # One last look, then give up.
+        finally:
+            self._multi_waits.discard(released)
+            for i, broker in enumerate(brokers):
+                broker.monitor.remove_listener(released.set)
+                if parked:
+                    broker.outside_waiter_left(give_back_budget=i == 0)
+
+        if not leases:
+            return {'brokers': domains, 'proxy': None, 'lease': None,
+                    'leases': {}}
+
+        group_id = new_lease_id()
+        self._add_multi_lease(group_id, list(zip(domains, leases)))
+        return {'brokers': domains,
+                'proxy': leases[0].proxy,
+                'lease': group_id,
+                'leases': {d: held.id for d, held in zip(domains, leases)},
+                'expires_in': leases[0].expires_in(loop.time())}
+
+    def _lease_common(self, brokers, query, client, waited):
+        if not all(broker.can_lease_now(client) for broker in brokers):
+            return None
+
+        # Intersect from the smallest candidate set up.
+        sets = sorted((broker.monitor.candidates(query) for broker in brokers),
+                      key=len)
+        common = sets[0]
+        for candidates in sets[1:]:
+            if not common:
+                break
+            common = common & candidates
+
+        n = len(brokers)
+        common = [p for p in common if self._proxy_state.can_lease(p, n)]
+        if not common:
+            return None
+
+        proxy = brokers[0].monitor.choose(common)
+        leases = []
+        for broker in brokers:
+            lease = broker.lease_available(proxy, client, waited)
+            if lease is None:
+                # Never a partial group: give back what was leased so far.
+                for leased_on, held in zip(brokers, leases):
+                    leased_on.cancel_lease(held.id)
+                return None
+            leases.append(lease)
+        return leases
+
+    @staticmethod
+    def _admit_multi(brokers):
+        """
+        Admit a multi-domain acquire as a waiter on every broker, taking
+        room in the shared budget once, or on none of them.
+        """
+        admitted = []
+        try:
+            for broker in brokers:
+                broker.admit_outside_waiter(take_budget=not admitted)
+                admitted.append(broker)
+        except AdmissionRejected:
+            for i, broker in enumerate(admitted):
+                broker.outside_waiter_left(give_back_budget=i == 0)
+            raise
+
+    def _add_multi_lease(self, group_id, leases):
+        self._multi_leases[group_id] = leases
+        for _, held in leases:
+            self._multi_groups[held.id] = group_id
+
+    def _lease_ended(self, lease):
+        """
+        Forget a multi-domain lease once all of its per-domain leases ended.
+        """
+        group_id = self._multi_groups.pop(lease.id, None)
+        leases = self._multi_leases.get(group_id)
+        if leases is None:
+            return
+
+        for domain, held in leases:
+            broker = self._brokers.get(domain)
+            if broker is not None and broker.get_lease(held.id) is not None:
+                return
+        del self._multi_leases[group_id]
+
+    def release_multi(self, lease, response_time, is_failure):
+        """
+        Release a multi-domain lease on all of its domains at once.
+
+        :return: True if any of its per-domain leases was still live
+        """
+        leases = self._multi_leases.pop(lease, None)
+        if leases is None:
+            return False
+
+        released = [self._brokers[domain].release(held.proxy, response_time,
+                                                  is_failure, lease=held.id)
+                    for domain, held in leases]
+        return any(released)
+
+    def renew(self, domain, lease, extension=None):
+        """
+        :return: the seconds left on the renewed lease, or None if the
+            lease (or domain) is unknown
+        """
+        broker = self._brokers.get(domain)
+        if not broker:
+            return None
+
+        renewed = broker.renew(lease, extension)
+        return renewed.expires_in(broker.loop.time()) if renewed else None
+
+    @property
+    def policy_table(self):
+        return self._policy_table
+
+    def set_policy_table(self, policy_table):
+        """
+        Swap in a new policy table and apply it to every live broker, which
+        keep their leases, waiters and learned state.
+        """
+        self._policy_table = policy_table
+        for domain, broker in self._brokers.items():
+            settings = {k: v for k, v in self._broker_opts.items()
+                        if k in TUNABLE_DEFAULTS}
+            settings.update(policy_table.settings_for(domain))
+            broker.configure(**settings)
+
+    @property
+    def proxy_state(self):
+        return self._proxy_state
 
     def list_all(self):
         return {k: v.stats() for k, v in self._brokers.items()}
 
+    def history(self, domain, window=None, step=None):
+        """
+        :return: the domain's recent activity (see
+            :meth:`mimic.broker.Broker.history`), or None if it is unknown
+        """
+        broker = self._brokers.get(domain)
+        return broker.history(window, step) if broker else None
+
+    def usage_rows(self):
+        """
+        Yield a row per (domain, registered proxy), one domain at a time:
+        the domain followed by the monitor's row (see
+        :meth:`mimic.domain_monitor.DomainMonitor.usage_rows`). Domains
+        deleted while the rows are consumed are skipped.
+        """
+        for domain in list(self._brokers):
+            broker = self._brokers.get(domain)
+            if broker is None:
+                continue
+            for row in broker.monitor.usage_rows():
+                yield (domain,) + row
+
+    def task_counts(self):
+        """
+        :return: the brokers' pending tasks and waiters, summed by kind
+        """
+        counts = {'auto_return': 0, 'throttled_return': 0, 'waiters': 0}
+        for broker in self._brokers.values():
+            for kind, n in broker.task_counts().items():
+                counts[kind] += n
+        return counts
+
+    def memory_report(self, sample=SAMPLE_SIZE, domains=None):
+        """
+        Estimate the memory held per domain and per structure, and count
+        entries that look leaked.
+
+        :param sample: the elements measured per container (see
+            :func:`mimic.memory.estimate_size`)
+        :param domains: report only these domains; totals still cover all
+        :return: ``domains`` (per domain, its broker's and monitor's bytes
+            per structure, their total, and leak counts), ``global``
+            (structures shared by all domains) and ``total`` bytes
+        """
+        report = {}
+        total = 0
+        for domain, broker in self._brokers.items():
+            broker_bytes = broker.memory_usage(sample)
+            monitor_bytes = broker.monitor.memory_usage(sample)
+            domain_total = (sum(broker_bytes.values())
+                            + sum(monitor_bytes.values()))
+            total += domain_total
+            if domains is not None and domain not in domains:
+                continue
+
+            leaks = broker.leaks()
+            leaks.update(broker.monitor.leaks())
+            report[domain] = {'broker': broker_bytes,
+                              'monitor': monitor_bytes,
+                              'total': domain_total,
+                              'leaks': leaks}
+
+        shared = {'brokers': estimate_size(self._brokers, sample, depth=1),
+                  'multi_leases': estimate_size(self._multi_leases, sample),
+                  'multi_groups': estimate_size(self._multi_groups, sample)}
+        shared.update(self._domain_resolver.memory_usage(sample))
+        shared.update(self._proxy_collection.memory_usage(sample))
+        shared.update(('proxy_state_' + name, n) for name, n
+                      in self._proxy_state.memory_usage(sample).items())
+        total += sum(shared.values())
+
+        leaks = self._proxy_state.leaks(self._proxy_collection.is_registered)
+        return {'domains': report,
+                'global': {'bytes': shared, 'leaks': leaks},
+                'total': total}
+
+    def abort_waiters(self):
+        """
+        Drop every parked acquire on every domain, single or multi, raising
+        :class:`mimic.broker.AcquireAborted` in it.
+        """
+        self._aborts += 1
+        for released in self._multi_waits:
+            released.set()
+        for broker in self._brokers.values():
+            broker.abort_waiters()
+
+    def snapshot(self):
+        """
+        Capture the registry and every domain's live state as plain data,
+        for a successor process to :meth:`restore` (see
+        :mod:`mimic.handoff`).
+        """
+        proxies = self._proxy_collection.proxies
+        multi_leases = {group_id: [[domain, held.id]
+                                   for domain, held in leases]
+                        for group_id, leases in self._multi_leases.items()}
+        return {'proxies': [props.to_dict() for props in proxies.values()],
+                'domains': {domain: broker.snapshot()
+                            for domain, broker in self._brokers.items()},
+                'multi_leases': multi_leases}
+
+    def restore(self, snapshot):
+        """
+        Register the proxies of a :meth:`snapshot` and have each of its
+        domains' brokers take over their state (see
+        :meth:`mimic.broker.Broker.restore`).
+        """
+        for proxy in snapshot['proxies']:
+            self._proxy_collection.register_proxy(proxy)
+
+        for domain, state in snapshot['domains'].items():
+            self._broker_for(sys.intern(domain)).restore(state)
+
+        for group_id, refs in snapshot['multi_leases'].items():
+            leases = [(domain, self._brokers[domain].get_lease(lease_id))
+                      for domain, lease_id in refs
+                      if domain in self._brokers]
+            leases = [(domain, held) for domain, held in leases if held]
+            if leases:
+                self._add_multi_lease(group_id, leases)
+
     def delete(self, broker):
         pass
 
     def register_on_all(self, proxy_obj):
         for broker in self._brokers.values():
             broker.monitor.register(proxy_obj)
+
+    def delist_on_all(self, proxy):
+        for broker in self._brokers.values():
+            broker.delist(proxy)
+        self._proxy_state.forget(proxy)
+
+    def delist_matching(self, requirements):
+        """
+        Delist every registered proxy matching the requirements (see
+        :meth:`mimic.proxy_collection.ProxyCollection.select`) from the
+        registry and all domains, in one pass per domain.
+
+        :return: the delisted proxy strings
+        """
+        proxies = self._proxy_collection.select(*requirements)
+        if proxies:
+            for broker in self._brokers.values():
+                broker.delist_many(proxies)
+            # The brokers delisted them from their monitors already.
+            self._proxy_collection.unregister_many(proxies)
+            for proxy in proxies:
+                self._proxy_state.forget(proxy)
+        return proxies
+
+    def retag_matching(self, requirements, **changes):
+        """
+        Change the properties of every registered proxy matching the
+        requirements, on all domains (see
+        :meth:`mimic.proxy_collection.ProxyCollection.retag`).
+
+        :return: the retagged proxy strings
+        """
+        proxies = self._proxy_collection.select(*requirements)
+        self._proxy_collection.retag(proxies, **changes)
+        return proxies
@@ -0,0 +1,300 @@
+import asyncio
+import gc
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from mimic.util import setup_logger
+
+
+LOGGER = setup_logger('debug')
+
+# Upper bounds, in seconds, of the loop lag histogram's buckets.
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# The request key a handler's phase timer is kept under.
+TIMER_KEY = 'mimic.debug.timer'
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how much later than scheduled a callback runs.
+
+    Every ``interval`` seconds it sleeps, and the time past the wake-up it
+    asked for is the lag, binned into a histogram over ``LAG_BUCKETS`` (a
+    final bucket catches everything longer).
+    """
+    def __init__(self, loop, interval=0.1, buckets=LAG_BUCKETS):
+        self._loop = loop
+        self._interval = interval
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._total = 0.0
+        self._max = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            while True:
+                scheduled = self._loop.time() + self._interval
+                await asyncio.sleep(self._interval, loop=self._loop)
+                self.record(max(0.0, self._loop.time() - scheduled))
+        except asyncio.CancelledError:
+            pass
+
+    def record(self, lag):
+        self._counts[bisect_left(self._buckets, lag)] += 1
+        self._total += lag
+        self._max = max(self._max, lag)
+
+    def stats(self):
+        n = sum(self._counts)
+        labels = ["<={}".format(b) for b in self._buckets]
+        labels.append(">{}".format(self._buckets[-1]))
+        return {'samples': n,
+                'mean': self._total / n if n else None,
+                'max': self._max,
+                'histogram': dict(zip(labels, self._counts))}
+
+
+class GCTimer:
+    """
+    Counts garbage collections and the time spent in them, by generation.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._started = None
+        self._collections = [0, 0, 0]
+        self._seconds = [0.0, 0.0, 0.0]
+
+    def start(self):
+        if self._callback not in gc.callbacks:
+            gc.callbacks.append(self._callback)
+
+    def stop(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._started = self._clock()
+        elif self._started is not None:
+            generation = info['generation']
+            self._collections[generation] += 1
+            self._seconds[generation] += self._clock() - self._started
+            self._started = None
+
+    def stats(self):
+        return {'collections': list(self._collections),
+                'seconds': list(self._seconds),
+                'counts': list(gc.get_count())}
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler of one thread (the event loop's).
+
+    While running, a background thread looks at the target thread's stack
+    every ``interval`` seconds and counts it. :meth:`collapsed` gives the
+    counts in the collapsed format flame graph tools read: one
+    ``outer;...;inner count`` line per distinct stack.
+    """
+    def __init__(self, thread_id=None, interval=0.005):
+        """
+        :param thread_id: the thread to sample; by default, the one that
+            calls :meth:`start`
+        :param interval: seconds between samples
+        """
+        self._thread_id = thread_id
+        self._target = None
+        self.interval = interval
+        self._stacks = Counter()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._target = self._thread_id or threading.get_ident()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='mimic-profiler')
+        self._thread.start()
+        LOGGER.info("Started sampling every %ss", self.interval)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        LOGGER.info("Stopped sampling after %s samples", self.samples)
+
+    def reset(self):
+        self._stacks.clear()
+
+    @property
+    def samples(self):
+        return sum(self._stacks.values())
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._stacks[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{}:{}".format(os.path.basename(code.co_filename),
+                                        code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        """
+        :return: the sampled stacks, most frequent first
+        """
+        return ''.join("{} {}\n".format(stack, n)
+                       for stack, n in self._stacks.most_common())
+
+
+class PhaseTimer:
+    """
+    Splits one request's handling into phases. A handler calls
+    :func:`mark` as each phase ends; the time after the last mark is the
+    response's serialization.
+    """
+    __slots__ = ['last', 'phases']
+
+    def __init__(self, now):
+        self.last = now
+        self.phases = []
+
+    def mark(self, phase, now):
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+
+def mark(request, phase):
+    """
+    End a phase of the request's handling, if it is being timed.
+    """
+    timer = request.get(TIMER_KEY)
+    if timer is not None:
+        timer.mark(phase, time.perf_counter())
+
+
+class HandlerTimings:
+    """
+    Per-handler request counts and time spent, split into the phases the
+    handlers mark (``parse`` and ``broker``) plus ``serialize``.
+    """
+    def __init__(self):
+        self._handlers = {}  # name -> {'count': n, phase: seconds, ...}
+
+    async def middleware(self, app, handler):
+        """
+        An aiohttp middleware factory timing every handler.
+        """
+        name = getattr(handler, '__name__', repr(handler))
+
+        async def timed(request):
+            start = time.perf_counter()
+            timer = request[TIMER_KEY] = PhaseTimer(start)
+            try:
+                return await handler(request)
+            finally:
+                end = time.perf_counter()
+                if timer.phases:
+                    timer.mark('serialize', end)
+                self._record(name, end - start, timer.phases)
+
+        return timed
+
+    def _record(self, name, total, phases):
+        timings = self._handlers.get(name)
+        if timings is None:
+            timings = self._handlers[name] = {'count': 0, 'total': 0.0,
+                                              'max': 0.0}
+        timings['count'] += 1
+        timings['total'] += total
+        timings['max'] = max(timings['max'], total)
+        for phase, seconds in phases:
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+    def stats(self):
+        """
+        :return: per handler, the request count, the worst time, and the
+            mean time in total and in each phase
+        """
+        res = {}
+        for name, timings in self._handlers.items():
+            n = timings['count']
+            res[name] = {key: value if key in ('count', 'max') else value / n
+                         for key, value in timings.items()}
+        return res
+
+
+class DebugSurface:
+    """
+    The instruments behind the server's opt-in ``/debug`` endpoints.
+    """
+    def __init__(self, brokerage, loop, lag_interval=0.1,
+                 profile_interval=0.005):
+        self._brokerage = brokerage
+        self._loop = loop
+        self.lag = LoopLagMonitor(loop, lag_interval)
+        self.gc = GCTimer()
+        self.profiler = SamplingProfiler(interval=profile_interval)
+        self.handlers = HandlerTimings()
+
+    def start(self):
+        """
+        Start the always-on instruments (not the profiler).
+        """
+        self.lag.start()
+        self.gc.start()
+
+    def stop(self):
+        self.lag.stop()
+        self.gc.stop()
+        self.profiler.stop()
+
+    def task_counts(self):
+        counts = self._brokerage.task_counts()
+        counts['live'] = len([task for task in _all_tasks(self._loop)
+                              if not task.done()])
+        return counts
+
+    def stats(self):
+        return {'loop_lag': self.lag.stats(),
+                'gc': self.gc.stats(),
+                'tasks': self.task_counts(),
+                'handlers': self.handlers.stats(),
+                'profiler': {'running': self.profiler.running,
+                             'interval': self.profiler.interval,
+                             'samples': self.profiler.samples}}
+
+
+def _all_tasks(loop):
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop=loop)
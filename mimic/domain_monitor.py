@@ -1,11 +1,26 @@
+import math
 import random
-from collections import defaultdict
-from functools import reduce
+import time
+from mimic.hashring import HashRing
+from mimic.index import PropertyIndex
+from mimic.memory import SAMPLE_SIZE, count_unknown, structure_sizes
+from mimic.query import Query
+from mimic.selection import ResponseTimeWeighted
 from mimic.util import ProxyProps, setup_logger
 
 
 LOGGER = setup_logger('domain_monitor')
 
+# Names for the hot-path log events (see :class:`mimic.logs.SamplingFilter`).
+ACQUIRE_EVENT = {'event': 'monitor_acquire'}
+RELEASE_EVENT = {'event': 'monitor_release'}
+
+# Picks redrawn when the shared proxy state rejects one, before giving in.
+MAX_PICKS = 8
+
+# The usage of a proxy never acquired: acquisitions, failures, last used.
+_NO_USAGE = (0, 0, None)
+
 
 class DomainMonitor:
     """
@@ -14,16 +29,45 @@ class DomainMonitor:
     This class does no error management. If you acquire then fail to release
     or delist, it never corrects itself. But, those operations all have
     elements of timing. And, timing is a lower level operation.
+
+    A proxy may serve several acquires at once: it has ``capacity`` slots,
+    from its registration or from :meth:`set_capacity` for the whole
+    domain, and stays available while any slot is free.
+
+    Response times come from a ``source``: ``measured`` by clients,
+    ``estimated`` by the server from lease durations, or a ``penalty`` the
+    broker charges a failed or overdue proxy. Selection goes by the latest
+    measurement or penalty, falling back on the latest estimate only while
+    a proxy has never been measured. Measurements and estimates are kept in
+    separate statistics.
     """
-    def __init__(self, domain):
+    def __init__(self, domain, selection_policy=None, proxy_state=None):
         """
         :param domain: the domain being managed, used for logging purposes.
+        :param selection_policy: picks among matching proxies on acquire (see
+            :mod:`mimic.selection`); response time weighted by default
+        :param proxy_state: the :class:`mimic.proxy_state.ProxyState` shared
+            across domains, if any
         """
         self._domain = domain
-        self._proxies = set()
-        self._response_times = {}
+        self._proxies = set()  # Those with a free slot.
+        self._response_times = {}  # What selection goes by.
+        self._measured = set()  # Proxies with a client measurement.
+        self._latency = {'measured': [0, 0.0], 'estimated': [0, 0.0]}
+        self._capacity = {}  # proxy -> slots, as registered
+        self._capacity_override = None
+        self._in_use = {}  # proxy -> slots taken and not yet released
+        self._slots_in_use = 0
+        self._total_slots = None  # Summed on demand; None when stale.
+        self._retired = set()  # Failed out; never available again.
         self._acquisitions_processed = 0
-        self._props = defaultdict(set)
+        self._usage = {}  # proxy -> [acquisitions, failures, last used]
+        self._props = PropertyIndex()
+        self._ring = None  # Of registered proxies; built for sessions.
+        self._unringed = []  # Registered since the ring was last built.
+        self._listeners = []
+        self._policy = selection_policy or ResponseTimeWeighted()
+        self._proxy_state = proxy_state
 
         LOGGER.info("Initiated DomainMonitor on %s", self._domain)
 
@@ -31,6 +75,68 @@ class DomainMonitor:
     def domain(self):
         return self._domain
 
+    @property
+    def available(self):
+        """
+        The number of proxies that can be acquired right now.
+        """
+        return len(self._proxies)
+
+    @property
+    def capacity_override(self):
+        return self._capacity_override
+
+    def capacity(self, proxy):
+        """
+        :return: the number of slots on a registered proxy
+        """
+        if proxy in self._retired:
+            return 0
+        if self._capacity_override is not None:
+            return self._capacity_override
+        return self._capacity.get(proxy, 0)
+
+    def free_slots(self, proxy):
+        return max(0, self.capacity(proxy) - self._in_use.get(proxy, 0))
+
+    def utilisation(self):
+        """
+        :return: the fraction of the domain's slots in use
+        """
+        if self._total_slots is None:
+            self._total_slots = sum(map(self.capacity, self._response_times))
+        if not self._total_slots:
+            return 0.0
+        return min(1.0, self._slots_in_use / self._total_slots)
+
+    def set_capacity(self, capacity):
+        """
+        Give every proxy ``capacity`` slots on this domain, or go back to
+        their registered capacities if None. Slots in use over a lowered
+        capacity drain as they are released.
+        """
+        self._capacity_override = capacity
+        self._total_slots = None
+        for proxy in self._response_times:
+            if self.free_slots(proxy):
+                self._proxies.add(proxy)
+            else:
+                self._proxies.discard(proxy)
+        self._notify()
+
+    def add_listener(self, callback):
+        """
+        Call ``callback()`` whenever a proxy becomes available.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
     def register(self, proxy_props):
         """
         Add a proxy and index its properties.
@@ -43,86 +149,283 @@ class DomainMonitor:
             LOGGER.info("%s already registered with DomainMonitor(%s)", proxy,
                         self._domain)
         else:
-            self._proxies.add(proxy)
+            self._props.add(proxy, proxy_props)
             self._response_times[proxy] = proxy_props.resp_time
-
-            for k in ['geo', 'anon_level']:
-                v = getattr(proxy_props, k)
-                if v is not None:
-                    self._props[v].add(proxy)
+            self._capacity[proxy] = proxy_props.capacity
+            self._total_slots = None
+            if self.free_slots(proxy):
+                self._proxies.add(proxy)
+            if self._ring is not None:
+                self._unringed.append(proxy)
 
             LOGGER.info("Registered %s with DomainMonitor(%s)", proxy,
                         self._domain)
+            self._notify()
 
     def delist(self, proxy):
         """
         Remove a proxy and remove its properties from all indices.
         """
         assert isinstance(proxy, str)
+        self.delist_many((proxy,))
 
-        self._proxies.remove(proxy)
-        del self._response_times[proxy]
+    def delist_many(self, proxies):
+        """
+        Remove several proxies, filtering the hash ring (if built) once.
+        """
+        for proxy in proxies:
+            # The proxy may be leased out; the release is ignored later on.
+            self._proxies.discard(proxy)
+            self._response_times.pop(proxy, None)
+            self._measured.discard(proxy)
+            self._capacity.pop(proxy, None)
+            self._slots_in_use -= self._in_use.pop(proxy, 0)
+            self._retired.discard(proxy)
+            self._usage.pop(proxy, None)
+            self._props.remove(proxy)
+            self._policy.forget(proxy)
+
+            LOGGER.info("Delisted %s with DomainMonitor(%s)",
+                        proxy, self._domain)
 
-        keys_to_delete = []
-        for prop, proxy_set in self._props.items():
-            if proxy in proxy_set:
-                proxy_set.remove(proxy)
-            if not proxy_set:
-                keys_to_delete.append(prop)
+        self._total_slots = None
+        if self._ring is not None:
+            self._ring.remove_many(proxies)
+            if self._unringed:
+                self._unringed = [p for p in self._unringed
+                                  if p in self._response_times]
 
-        for k in keys_to_delete:
-            del self._props[k]
+    def reindex(self, proxy_props):
+        """
+        Index a registered proxy's changed properties (e.g. its ``geo`` or
+        tags), keeping its learned response time.
+        """
+        proxy = str(proxy_props)
+        if proxy in self._response_times:
+            self._props.add(proxy, proxy_props)
+            self._props.update_value('resp_time', proxy,
+                                     self._response_times[proxy])
 
-        LOGGER.info("Delisted %s with DomainMonitor(%s)", proxy, self._domain)
+    def retire(self, proxy):
+        """
+        Take a proxy out of rotation for good, while keeping it registered
+        so that releases of its slots still in use are accepted.
+        """
+        if proxy in self._response_times:
+            self._retired.add(proxy)
+            self._total_slots = None
+            self._proxies.discard(proxy)
 
-    def acquire(self, *requirements):
+    def acquire(self, *requirements, exclude=()):
         """
         Acquire a proxy for use.
 
-        :param requirements: optional tags to match
+        :param requirements: optional requirement terms to match (see
+            :class:`mimic.query.Query`), or a single compiled ``Query``
+        :param exclude: proxies not to pick, even with a free slot
         """
-        # This is a conjunction. What about an disjunction (e.g. country code)
-        def _query(proxies, prop):
-            return {p for p in proxies if p in self._props[prop]}
+        query = Query.compile(requirements)
 
         LOGGER.info("Acquiring proxy from DomainMonitor(%s) over reqs=%s",
-                    self._domain, requirements)
-
-        candidates = list(reduce(_query, requirements, self._proxies))
+                    self._domain, query, extra=ACQUIRE_EVENT)
+
+        candidates = query.candidates(self._proxies, self._props.posting)
+        if exclude:
+            candidates = (p for p in candidates if p not in exclude)
+        if self._proxy_state is not None:
+            candidates = filter(self._proxy_state.can_lease, candidates)
+        candidates = list(candidates)
         if len(candidates) == 0:
             return None  # None available right now.
 
-        proxy = self._sample_proxy(candidates)
-        self._proxies.remove(proxy)
+        proxy = self.choose(candidates)
+        self.take(proxy)
+        return proxy
+
+    def candidates(self, *requirements):
+        """
+        :return: the set of available proxies matching the requirements, not
+            to be mutated
+        """
+        query = Query.compile(requirements)
+        return query.candidates(self._proxies, self._props.posting)
+
+    def session_proxies(self, session, *requirements):
+        """
+        Yield the registered proxies matching the requirements, whether
+        available or not, in consistent-hash order from a session key: the
+        session's own proxy first, then its fallbacks.
+        """
+        query = Query.compile(requirements)
+        matching = query.candidates(self._response_times.keys(),
+                                    self._props.posting)
+        for proxy in self._session_ring().walk(session):
+            if proxy in matching:
+                yield proxy
+
+    def _session_ring(self):
+        """
+        :return: the hash ring of registered proxies, built in bulk on the
+            first session acquire, since most domains never see one
+        """
+        if self._ring is None:
+            self._ring = HashRing()
+            self._ring.add_many(self._response_times)
+        elif self._unringed:
+            self._ring.add_many(self._unringed)
+            self._unringed = []
+        return self._ring
+
+    def is_available(self, proxy):
+        return proxy in self._proxies
+
+    def is_registered(self, proxy):
+        return proxy in self._response_times
+
+    def take(self, proxy):
+        """
+        Acquire a specific proxy, if it is available.
+
+        :return: True if it was taken
+        """
+        if proxy not in self._proxies:
+            return False
+        if (self._proxy_state is not None
+                and not self._proxy_state.can_lease(proxy)):
+            return False
+
+        in_use = self._in_use.get(proxy, 0) + 1
+        self._in_use[proxy] = in_use
+        self._slots_in_use += 1
+        if in_use >= self.capacity(proxy):
+            self._proxies.remove(proxy)
+        if self._proxy_state is not None:
+            self._proxy_state.leased(proxy)
+
+        usage = self._usage.get(proxy)
+        if usage is None:
+            self._usage[proxy] = [1, 0, time.time()]
+        else:
+            usage[0] += 1
+            usage[2] = time.time()
 
         self._acquisitions_processed += 1
+        return True
 
+    def choose(self, candidates):
+        """
+        :param candidates: a non-empty list of available proxies
+        :return: the one the selection policy (and shared state) prefers,
+            among those with the most free slots
+        """
+        if len(candidates) > 1:
+            free = [self.free_slots(p) for p in candidates]
+            most = max(free)
+            if min(free) < most:
+                candidates = [p for p, n in zip(candidates, free) if n == most]
+
+        proxy = self._policy.choose(candidates, self._response_times)
+        if self._proxy_state is None:
+            return proxy
+
+        # Stochastic acceptance by the proxy's failures on all domains.
+        for _ in range(MAX_PICKS - 1):
+            if random.random() < self._proxy_state.weight(proxy):
+                break
+            proxy = self._policy.choose(candidates, self._response_times)
         return proxy
 
-    def release(self, proxy, response_time):
+    def lease_ended(self, proxy):
+        """
+        Note that a proxy acquired from this monitor is no longer in use,
+        though it may not be released yet.
         """
-        Return this proxy so other requestors can use it.
+        if self._proxy_state is not None:
+            self._proxy_state.returned(proxy)
+
+    def release(self, proxy, response_time, source='measured'):
+        """
+        Return one of this proxy's slots so other requestors can use it.
+
+        :param source: where the response time came from (``measured``,
+            ``estimated`` or ``penalty``)
         """
         assert proxy is not None, "Attempting to release None!"  # BUGTEST
 
-        if proxy in self._proxies:
+        if proxy not in self._response_times:
+            # Delisted while it was leased out.
+            LOGGER.info("%s no longer registered with DomainMonitor(%s)",
+                        proxy, self._domain)
+        elif not self._in_use.get(proxy):
             # This means that the auto-return already returned it.
             # TODO: Should be auto-reacquired, for wait seconds for correct
             # throttling.
-            LOGGER.info("%s already on DomainMonitor(%s)", proxy, self._domain)
+            LOGGER.info("%s already on DomainMonitor(%s)", proxy, self._domain,
+                        extra=RELEASE_EVENT)
 
             # Hrm. I think this needs a special flag for released by
             # auto-return or client...
 
-            if response_time > 0:
-                self._response_times[proxy] = response_time
+            self._set_response_time(proxy, response_time, source)
         else:
-            self._proxies.add(proxy)
-            if response_time > 0:
-                self._response_times[proxy] = response_time
+            in_use = self._in_use[proxy] - 1
+            self._slots_in_use -= 1
+            if in_use:
+                self._in_use[proxy] = in_use
+            else:
+                del self._in_use[proxy]
+            self._set_response_time(proxy, response_time, source)
+            if not self.free_slots(proxy):
+                return  # Still over a lowered capacity, or retired.
 
+            self._proxies.add(proxy)
             LOGGER.info("%s ready again on DomainMonitor(%s)",
-                        proxy, self._domain)
+                        proxy, self._domain, extra=RELEASE_EVENT)
+            self._notify()
+
+    def record_response_time(self, proxy, response_time):
+        """
+        Record an out-of-band measurement (e.g. from a health probe) for a
+        registered proxy, without changing its availability.
+        """
+        if proxy in self._response_times:
+            self._set_response_time(proxy, response_time)
+
+    def record_outcome(self, proxy, is_failure):
+        """
+        Tell the selection policy how a request through the proxy went.
+        """
+        if proxy in self._response_times:
+            self._policy.record(proxy, is_failure)
+            if is_failure:
+                self._usage.setdefault(proxy, [0, 0, None])[1] += 1
+        if is_failure and self._proxy_state is not None:
+            self._proxy_state.record_failure(proxy)
+
+    def _set_response_time(self, proxy, response_time, source='measured'):
+        if not math.isfinite(response_time) or response_time <= 0:
+            return
+
+        samples = self._latency.get(source)
+        if samples is not None:
+            samples[0] += 1
+            samples[1] += response_time
+
+        if source == 'measured':
+            self._measured.add(proxy)
+        elif source == 'estimated' and proxy in self._measured:
+            return  # A client's measurement beats the estimate.
+
+        self._response_times[proxy] = response_time
+        self._props.update_value('resp_time', proxy, response_time)
+
+    def latency_stats(self):
+        """
+        :return: the number and mean of measured and of estimated response
+            times recorded on releases
+        """
+        return {source: {'samples': n, 'mean': total / n if n else None}
+                for source, (n, total) in self._latency.items()}
 
     def average_response_time(self):
         """
@@ -135,34 +438,82 @@ class DomainMonitor:
 
         return sum(self._response_times.values()) / n
 
+    def snapshot(self):
+        """
+        :return: the learned response times and the retired proxies, as
+            plain data for a successor process (see :mod:`mimic.handoff`)
+        """
+        return {'response_times': dict(self._response_times),
+                'measured': sorted(self._measured),
+                'usage': dict(self._usage),
+                'retired': sorted(self._retired)}
+
+    def restore(self, snapshot):
+        """
+        Take over the response times of a :meth:`snapshot`, and retire the
+        proxies retired there, for the proxies registered here.
+        """
+        for proxy, response_time in snapshot['response_times'].items():
+            if proxy in self._response_times and response_time > 0:
+                self._response_times[proxy] = response_time
+                self._props.update_value('resp_time', proxy, response_time)
+        self._measured.update(p for p in snapshot['measured']
+                              if p in self._response_times)
+        for proxy, usage in snapshot.get('usage', {}).items():
+            if proxy in self._response_times:
+                self._usage[proxy] = list(usage)
+        for proxy in snapshot.get('retired', ()):
+            self.retire(proxy)
+
+    def usage_rows(self):
+        """
+        Yield a row per registered proxy: ``(proxy, resp_time, measured,
+        acquisitions, failures, last_used)``, where ``measured`` tells
+        whether the response time came from a client and ``last_used`` is
+        the wall-clock time of the latest acquire (None if never).
+
+        The proxies are listed up front, so the rows may be consumed across
+        awaits; any delisted meanwhile are skipped.
+        """
+        for proxy in list(self._response_times):
+            resp_time = self._response_times.get(proxy)
+            if resp_time is None:
+                continue
+            acquisitions, failures, last_used = self._usage.get(proxy,
+                                                                _NO_USAGE)
+            yield (proxy, resp_time, proxy in self._measured, acquisitions,
+                   failures, last_used)
+
+    def memory_usage(self, sample=SAMPLE_SIZE):
+        """
+        :return: the estimated bytes of each structure (see
+            :func:`mimic.memory.estimate_size`)
+        """
+        return structure_sizes(self, ('_proxies', '_response_times',
+                                      '_measured', '_capacity', '_in_use',
+                                      '_retired', '_usage', '_props', '_ring',
+                                      '_unringed',
+                                      '_policy', '_listeners'), sample)
+
+    def leaks(self):
+        """
+        :return: counts of entries kept for proxies no longer registered
+        """
+        registered = self._response_times
+        return {'unregistered_available': count_unknown(self._proxies,
+                                                        registered),
+                'unregistered_slots': count_unknown(self._in_use,
+                                                    registered),
+                'unregistered_capacities': count_unknown(self._capacity,
+                                                         registered),
+                'unregistered_usage': count_unknown(self._usage,
+                                                    registered)}
+
     def stats(self):
         return {'available': len(self._proxies),
+                'free_slots': sum(map(self.free_slots, self._proxies)),
                 'acquisitions_processed': self._acquisitions_processed,
                 'avg_resp_time': self.average_response_time(),
-                'indices': {k: len(v) for k, v in self._props.items()}}
-
-    def _sample_proxy(self, proxies, min_offset=0.01):
-        # Network conditions change. Selection is a function of the average
-        # response time. It's stochastic to avoid synchronization issues but
-        # weighted in favor of faster proxies.
-        #
-        # Do stochastic acceptance for fast proportional selection.
-        # See: http://jbn.github.io/fast_proportional_selection/
-        min_resp_time, max_resp_time, resp_times = 1000000000, -1, []
-        for proxy in proxies:
-            resp_time = self._response_times[proxy]
-            if resp_time > max_resp_time:
-                max_resp_time = resp_time
-            if resp_time < min_resp_time:
-                min_resp_time = resp_time
-            resp_times.append(resp_time)
-
-        if max_resp_time == 0.0:
-            return random.choice(proxies)
-
-        n = len(proxies)
-        while True:
-            i = int(n * random.random())
-            score = max_resp_time - (resp_times[i] - min_resp_time)
-            if random.random() < score:
-                return proxies[i]
+                'latency': self.latency_stats(),
+                'indices': self._props.sizes(),
+                'selection': self._policy.stats()}
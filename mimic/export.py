@@ -0,0 +1,110 @@
+import csv
+import io
+import struct
+from itertools import islice
+
+
+# The columns of an export, one row per (domain, proxy).
+COLUMNS = ('domain', 'proxy', 'resp_time', 'measured', 'acquisitions',
+           'failures', 'last_used')
+
+# Rows encoded at a time; a chunk is all that is held in memory.
+CHUNK_ROWS = 10000
+
+# The most rows a client may ask to have encoded at a time.
+MAX_CHUNK_ROWS = 100000
+
+CONTENT_TYPES = {'csv': 'text/csv',
+                 'npy': 'application/octet-stream'}
+
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+# Each NPY header, with the magic, is padded to a multiple of this.
+_NPY_ALIGNMENT = 64
+
+
+def chunked(rows, chunk_rows=CHUNK_ROWS):
+    """
+    :param rows: an iterable of rows
+    :return: a generator of lists of up to ``chunk_rows`` rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            break
+        yield chunk
+
+
+def csv_chunks(rows, chunk_rows=CHUNK_ROWS):
+    """
+    Encode rows as CSV, a header line first. A proxy never acquired has an
+    empty ``last_used``.
+
+    :return: a generator of UTF-8 encoded chunks, which concatenate into
+        one CSV file
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    for chunk in chunked(rows, chunk_rows):
+        for (domain, proxy, resp_time, measured, acquisitions, failures,
+             last_used) in chunk:
+            writer.writerow((domain, proxy, repr(resp_time), int(measured),
+                             acquisitions, failures,
+                             '' if last_used is None else repr(last_used)))
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')  # The header, with no rows.
+
+
+def npy_chunks(rows, chunk_rows=CHUNK_ROWS):
+    """
+    Encode rows as NPY (format 1.0) arrays of records, one array per chunk.
+    The domain and proxy are fixed-width byte strings, sized to the longest
+    in their chunk; a proxy never acquired has a NaN ``last_used``.
+
+    Read the stream back by calling ``numpy.load`` on the open file until
+    it is exhausted, and concatenating the arrays.
+
+    :return: a generator of encoded arrays
+    """
+    for chunk in chunked(rows, chunk_rows):
+        domains = [row[0].encode('utf-8') for row in chunk]
+        proxies = [row[1].encode('utf-8') for row in chunk]
+        domain_width = max(map(len, domains)) or 1
+        proxy_width = max(map(len, proxies)) or 1
+
+        descr = [('domain', '|S{}'.format(domain_width)),
+                 ('proxy', '|S{}'.format(proxy_width)),
+                 ('resp_time', '<f8'), ('measured', '|b1'),
+                 ('acquisitions', '<u8'), ('failures', '<u8'),
+                 ('last_used', '<f8')]
+        record = struct.Struct('<{}s{}sd?QQd'.format(domain_width,
+                                                     proxy_width))
+
+        body = bytearray(_npy_header(descr, len(chunk)))
+        for domain, proxy, row in zip(domains, proxies, chunk):
+            _, _, resp_time, measured, acquisitions, failures, last_used = row
+            body += record.pack(domain, proxy, resp_time, measured,
+                                acquisitions, failures,
+                                float('nan') if last_used is None
+                                else last_used)
+        yield bytes(body)
+
+
+def _npy_header(descr, length):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}"
+    header = header.format(descr, length)
+
+    # The magic and length take 10 bytes; the header ends in a newline.
+    padding = -(len(_NPY_MAGIC) + 2 + len(header) + 1) % _NPY_ALIGNMENT
+    header = (header + ' ' * padding + '\n').encode('latin1')
+    return _NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+
+ENCODERS = {'csv': csv_chunks,
+            'npy': npy_chunks}
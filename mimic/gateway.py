@@ -0,0 +1,526 @@
+import asyncio
+from collections import deque
+from urllib.parse import urlsplit
+
+from mimic.broker import AcquireAborted, AdmissionRejected
+from mimic.util import setup_logger
+
+
+LOGGER = setup_logger('gateway')
+
+MAX_HEAD_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Headers that only concern one hop, so are never forwarded.
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-connection',
+                        'proxy-authenticate', 'proxy-authorization', 'te',
+                        'trailer', 'upgrade'])
+
+# Gateway controls, read from the client's request and never forwarded.
+CLIENT_HEADER = 'x-mimic-client'
+REQUIREMENTS_HEADER = 'x-mimic-requirements'
+SESSION_HEADER = 'x-mimic-session'
+
+# Statuses that count as the proxy failing for the domain.
+FAILURE_STATUSES = frozenset([403, 407, 429, 502, 503, 504])
+
+
+class HTTPHead:
+    """
+    The start line and headers of an HTTP message.
+    """
+    __slots__ = ['start_line', 'headers']
+
+    def __init__(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers  # [(name, value)], in order.
+
+    @classmethod
+    def parse(cls, data):
+        lines = data.decode('latin-1').split('\r\n')
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers.append((name.strip(), value.strip()))
+        return cls(lines[0], headers)
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def without(self, names):
+        """
+        :return: the headers, less those named (lowercase) in ``names``
+        """
+        return [(k, v) for k, v in self.headers if k.lower() not in names]
+
+    def connection_tokens(self):
+        value = "{},{}".format(self.get('connection', ''),
+                               self.get('proxy-connection', ''))
+        return {t.strip().lower() for t in value.split(',') if t.strip()}
+
+    def status(self):
+        """
+        :return: a response head's status code
+        :raises ValueError: if the status line is malformed
+        """
+        parts = self.start_line.split(' ', 2)
+        if len(parts) < 2:
+            raise ValueError("Bad status line: {!r}".format(self.start_line))
+        return int(parts[1])
+
+    def content_length(self):
+        """
+        :return: the ``Content-Length``, or None if there is none
+        :raises ValueError: if it is not a non-negative integer
+        """
+        length = self.get('content-length')
+        if length is None:
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ValueError("Bad Content-Length: {!r}".format(
+                self.get('content-length')))
+        return length
+
+
+def serialize(start_line, headers):
+    lines = [start_line] + ["{}: {}".format(k, v) for k, v in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def read_head(reader):
+    """
+    :return: the next message head on the stream, or None at EOF
+    """
+    try:
+        data = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Truncated message head")
+        return None
+    except asyncio.LimitOverrunError:
+        raise ConnectionError("Message head too large")
+    return HTTPHead.parse(data)
+
+
+async def relay_body(reader, writer, head, method):
+    """
+    Relay a response body framed as its head says.
+
+    :return: True if the body was delimited, so the connection can be
+        reused; False if it ran until the connection closed
+    """
+    status = head.status()
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        return True
+
+    if 'chunked' in head.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            writer.write(size_line)
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            writer.write(await reader.readexactly(size + 2))
+            await writer.drain()
+
+        # Trailers, up to the blank line.
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            writer.write(line)
+            if line == b'\r\n':
+                break
+        await writer.drain()
+        return True
+
+    length = head.content_length()
+    if length is not None:
+        remaining = length
+        while remaining:
+            data = await reader.readexactly(min(remaining, CHUNK_SIZE))
+            writer.write(data)
+            remaining -= len(data)
+            await writer.drain()
+        return True
+
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            return False
+        writer.write(data)
+        await writer.drain()
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        if writer.can_write_eof():
+            try:
+                writer.write_eof()
+            except OSError:
+                pass
+
+
+def proxy_address(proxy):
+    """
+    :param proxy: a proxy string, e.g. ``HTTP://HOST:8080``
+    :return: its (host, port)
+    """
+    parts = urlsplit(proxy.lower())
+    return parts.hostname, parts.port or 80
+
+
+class UpstreamPool:
+    """
+    Idle keep-alive connections to upstream proxies, most recent first.
+    """
+    def __init__(self, loop, max_idle_per_upstream=8, idle_timeout=30,
+                 connect_timeout=10):
+        self._loop = loop
+        self._max_idle = max_idle_per_upstream
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = connect_timeout
+        self._idle = {}  # (host, port) -> deque of (reader, writer, since)
+        self.opened = 0
+        self.reused = 0
+
+    async def get(self, address):
+        """
+        :return: ``(reader, writer, pooled)`` for the address
+        """
+        idle = self._idle.get(address)
+        now = self._loop.time()
+        while idle:
+            reader, writer, since = idle.pop()
+            if now - since < self._idle_timeout and not reader.at_eof():
+                self.reused += 1
+                return reader, writer, True
+            writer.close()
+
+        reader, writer = await self.connect(address)
+        return reader, writer, False
+
+    async def connect(self, address):
+        host, port = address
+        conn = asyncio.open_connection(host, port, loop=self._loop,
+                                       limit=MAX_HEAD_SIZE)
+        reader, writer = await asyncio.wait_for(conn, self._connect_timeout,
+                                                loop=self._loop)
+        self.opened += 1
+        return reader, writer
+
+    def put(self, address, reader, writer):
+        idle = self._idle.setdefault(address, deque())
+        if len(idle) >= self._max_idle:
+            writer.close()
+            return
+        idle.append((reader, writer, self._loop.time()))
+
+    def idle_count(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class ProxyGateway:
+    """
+    A forward HTTP proxy that sends each request through a brokered proxy.
+
+    Every request acquires an upstream from the brokerage, keyed on the
+    target host; plain HTTP is forwarded over pooled keep-alive connections
+    to the upstream, and ``CONNECT`` is tunnelled. The gateway times the
+    upstream exchange itself and releases the lease with that latency and
+    whether the response was a failure, so clients need no broker calls at
+    all. Clients may pass ``X-Mimic-Client``, ``X-Mimic-Requirements`` (as
+    for acquires) and ``X-Mimic-Session`` headers.
+
+    Each client connection carries one request; the response is sent with
+    ``Connection: close``.
+    """
+    def __init__(self, brokerage, host='0.0.0.0', port=8081, loop=None,
+                 max_wait_time=30, read_timeout=60, renew_interval=20,
+                 failure_statuses=FAILURE_STATUSES, pool=None):
+        """
+        :param brokerage: the brokerage to acquire upstream proxies from
+        :param host: the address to listen on
+        :param port: the port to listen on
+        :param max_wait_time: how long a request waits for an upstream
+        :param read_timeout: the longest wait for the upstream's response
+        :param renew_interval: seconds between lease renewals while a
+            tunnel stays open
+        :param failure_statuses: response statuses released as failures
+        :param pool: the :class:`UpstreamPool` for upstream connections
+        """
+        self._brokerage = brokerage
+        self._host = host
+        self._port = port
+        self._loop = loop or asyncio.get_event_loop()
+        self._max_wait_time = max_wait_time
+        self._read_timeout = read_timeout
+        self._renew_interval = renew_interval
+        self._failure_statuses = failure_statuses
+        self._pool = pool or UpstreamPool(self._loop)
+        self._server = None
+        self._stats = {'requests': 0, 'tunnels': 0, 'failures': 0,
+                       'no_proxy': 0, 'rejected': 0, 'in_flight': 0}
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, self._host, self._port, loop=self._loop,
+            limit=MAX_HEAD_SIZE)
+        LOGGER.info("Gateway listening on %s:%s", self._host, self.port)
+
+    @property
+    def port(self):
+        """
+        The bound port (useful when listening on port 0).
+        """
+        if self._server is None or not self._server.sockets:
+            return self._port
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._pool.close()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['upstream_connections_opened'] = self._pool.opened
+        stats['upstream_connections_reused'] = self._pool.reused
+        stats['upstream_connections_idle'] = self._pool.idle_count()
+        return stats
+
+    async def _handle_client(self, reader, writer):
+        self._stats['in_flight'] += 1
+        try:
+            head = await read_head(reader)
+            if head is not None:
+                parts = head.start_line.split(' ')
+                if len(parts) != 3:
+                    self._reply(writer, 400, "Bad Request")
+                elif parts[0].upper() == 'CONNECT':
+                    await self._tunnel(head, parts[1], reader, writer)
+                else:
+                    await self._forward(head, parts[0].upper(), parts[1],
+                                        reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            LOGGER.info("Gateway client connection failed: %s", e)
+        finally:
+            self._stats['in_flight'] -= 1
+            writer.close()
+
+    def _reply(self, writer, status, reason, headers=(), body=b''):
+        headers = list(headers) + [('Content-Length', str(len(body))),
+                                   ('Connection', 'close')]
+        writer.write(serialize("HTTP/1.1 {} {}".format(status, reason),
+                               headers) + body)
+
+    async def _acquire(self, url, head, writer):
+        """
+        :return: the acquire result with a proxy, or None once the client
+            has been answered
+        """
+        requirements = head.get(REQUIREMENTS_HEADER, '')
+        requirements = requirements.split(',') if requirements else []
+        try:
+            res = await self._brokerage.acquire(
+                url, requirements, self._max_wait_time,
+                client=head.get(CLIENT_HEADER),
+                session=head.get(SESSION_HEADER))
+        except AdmissionRejected as e:
+            self._stats['rejected'] += 1
+            self._reply(writer, 429, "Too Many Requests",
+                        [('Retry-After', str(e.retry_after))])
+            return None
+        except AcquireAborted:
+            # Shutting down or handing off; a retry reaches the successor.
+            self._stats['no_proxy'] += 1
+            self._reply(writer, 503, "No Proxy Available",
+                        [('Retry-After', '0')])
+            return None
+
+        if res['proxy'] is None:
+            self._stats['no_proxy'] += 1
+            self._reply(writer, 503, "No Proxy Available")
+            return None
+        return res
+
+    async def _release(self, acquired, response_time, is_failure):
+        if is_failure:
+            self._stats['failures'] += 1
+        await self._brokerage.release(acquired['broker'], acquired['proxy'],
+                                      response_time, is_failure,
+                                      lease=acquired['lease'])
+
+    async def _forward(self, head, method, target, reader, writer):
+        url = urlsplit(target)
+        if url.scheme != 'http' or not url.hostname:
+            self._reply(writer, 400, "Absolute http URL Required")
+            return
+
+        try:
+            length = head.content_length()
+        except ValueError:
+            self._reply(writer, 400, "Bad Content-Length")
+            return
+        if length is None and head.get('transfer-encoding'):
+            self._reply(writer, 411, "Length Required")
+            return
+        body = await reader.readexactly(length) if length else b''
+
+        self._stats['requests'] += 1
+        acquired = await self._acquire(target, head, writer)
+        if acquired is None:
+            return
+
+        headers = head.without(HOP_BY_HOP | head.connection_tokens() |
+                               {CLIENT_HEADER, REQUIREMENTS_HEADER,
+                                SESSION_HEADER})
+        headers.append(('Connection', 'keep-alive'))
+        request = serialize(head.start_line, headers) + body
+
+        address = proxy_address(acquired['proxy'])
+        start_time = self._loop.time()
+        try:
+            resp_head, up_reader, up_writer = await self._send(address,
+                                                               request)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            LOGGER.info("Upstream %s failed: %s", acquired['proxy'], e)
+            await self._release(acquired, self._loop.time() - start_time,
+                                True)
+            self._reply(writer, 502, "Bad Gateway")
+            return
+
+        headers = resp_head.without(HOP_BY_HOP |
+                                    resp_head.connection_tokens())
+        headers.append(('Connection', 'close'))
+        writer.write(serialize(resp_head.start_line, headers))
+
+        try:
+            reusable = await relay_body(up_reader, writer, resp_head, method)
+            await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            # Too late for an error response; the client sees a cut-off.
+            LOGGER.info("Relaying from %s failed: %s", acquired['proxy'], e)
+            up_writer.close()
+            await self._release(acquired, self._loop.time() - start_time,
+                                True)
+            return
+
+        # The full exchange, through to the last byte of the body.
+        response_time = self._loop.time() - start_time
+        if reusable and 'close' not in resp_head.connection_tokens():
+            self._pool.put(address, up_reader, up_writer)
+        else:
+            up_writer.close()
+
+        await self._release(acquired, response_time,
+                            resp_head.status() in self._failure_statuses)
+
+    async def _send(self, address, request):
+        """
+        Send a request upstream and read the response head.
+
+        :return: the response head and the upstream connection
+        """
+        up_reader, up_writer, pooled = await self._pool.get(address)
+        try:
+            up_writer.write(request)
+            resp_head = await self._read_upstream_head(up_reader)
+            if resp_head is None and pooled:
+                # The idle connection had gone stale; retry on a fresh one.
+                up_writer.close()
+                up_reader, up_writer = await self._pool.connect(address)
+                up_writer.write(request)
+                resp_head = await self._read_upstream_head(up_reader)
+            if resp_head is None:
+                raise ConnectionError("Upstream closed without a response")
+            # Both raise ValueError if malformed, before anything is relayed.
+            resp_head.status()
+            resp_head.content_length()
+        except BaseException:
+            up_writer.close()
+            raise
+
+        return resp_head, up_reader, up_writer
+
+    async def _read_upstream_head(self, up_reader):
+        return await asyncio.wait_for(read_head(up_reader),
+                                      self._read_timeout, loop=self._loop)
+
+    async def _tunnel(self, head, authority, reader, writer):
+        host, _, port = authority.rpartition(':')
+        if not host or not port.isdigit():
+            self._reply(writer, 400, "Bad CONNECT Authority")
+            return
+
+        self._stats['tunnels'] += 1
+        url = "https://{}/".format(host if port == '443' else authority)
+        acquired = await self._acquire(url, head, writer)
+        if acquired is None:
+            return
+
+        start_time = self._loop.time()
+        up_writer = None
+        try:
+            up_reader, up_writer = await self._pool.connect(
+                proxy_address(acquired['proxy']))
+            up_writer.write(serialize(
+                "CONNECT {} HTTP/1.1".format(authority),
+                [('Host', authority)]))
+            resp_head = await self._read_upstream_head(up_reader)
+            status = resp_head.status() if resp_head else 502
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            LOGGER.info("Upstream %s failed: %s", acquired['proxy'], e)
+            if up_writer is not None:
+                up_writer.close()
+            await self._release(acquired, self._loop.time() - start_time,
+                                True)
+            self._reply(writer, 502, "Bad Gateway")
+            return
+
+        # Tunnelled traffic is opaque, so the handshake is what's timed.
+        response_time = self._loop.time() - start_time
+        if status != 200:
+            up_writer.close()
+            await self._release(acquired, response_time, True)
+            self._reply(writer, status, "Upstream Refused CONNECT")
+            return
+
+        writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        renewals = self._loop.create_task(self._keep_renewed(acquired))
+        try:
+            await asyncio.gather(pipe(reader, up_writer),
+                                 pipe(up_reader, writer), loop=self._loop)
+        finally:
+            renewals.cancel()
+            up_writer.close()
+            await self._release(acquired, response_time, False)
+
+    async def _keep_renewed(self, acquired):
+        while True:
+            await asyncio.sleep(self._renew_interval, loop=self._loop)
+            self._brokerage.renew(acquired['broker'], acquired['lease'])
@@ -0,0 +1,189 @@
+import array
+import json
+import os
+import socket
+import struct
+from mimic.util import setup_logger
+
+
+LOGGER = setup_logger('handoff')
+
+# What a successor sends to ask for the listening socket and the state.
+HANDOFF_REQUEST = b'HANDOFF\n'
+
+# Bumped whenever the layout of the handed off state changes.
+STATE_VERSION = 1
+
+_FAMILY = struct.Struct('!i')
+_LENGTH = struct.Struct('!Q')
+
+
+class HandoffError(Exception):
+    """
+    Raised when the other end of a handoff breaks the protocol or goes away.
+    """
+
+
+def bind_listener(host, port, backlog=128):
+    """
+    :return: a TCP socket listening on ``host:port``
+    """
+    info = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                              flags=socket.AI_PASSIVE)
+    family, kind, proto, _, address = info[0]
+    sock = socket.socket(family, kind, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send_socket(channel, sock):
+    """
+    Pass a socket to the process at the other end of a unix socket. The
+    kernel duplicates its descriptor (``SCM_RIGHTS``), so both processes
+    share it until one closes its own.
+    """
+    fds = array.array('i', [sock.fileno()])
+    channel.sendmsg([_FAMILY.pack(sock.family)],
+                    [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def receive_socket(channel):
+    """
+    :return: the socket passed with :func:`send_socket`
+    :raises HandoffError: if none came
+    """
+    fds = array.array('i')
+    msg, ancdata, _, _ = channel.recvmsg(_FAMILY.size,
+                                         socket.CMSG_LEN(fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+
+    if len(msg) != _FAMILY.size or not fds:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("Expected a socket from the predecessor")
+
+    family, = _FAMILY.unpack(msg)
+    return socket.socket(family, socket.SOCK_STREAM, fileno=fds[0])
+
+
+def encode_state(state):
+    """
+    :return: the state as length-prefixed JSON, for :func:`read_state`
+    """
+    body = json.dumps({'version': STATE_VERSION,
+                       'state': state}).encode('utf-8')
+    return _LENGTH.pack(len(body)) + body
+
+
+def read_state(channel):
+    """
+    Read the state sent with :func:`encode_state` from a blocking socket.
+
+    :raises HandoffError: if the channel closes early or the state is of
+        another version
+    """
+    length, = _LENGTH.unpack(_recv_exactly(channel, _LENGTH.size))
+    message = json.loads(_recv_exactly(channel, length).decode('utf-8'))
+    if message.get('version') != STATE_VERSION:
+        raise HandoffError("Unsupported state version {}".format(
+            message.get('version')))
+    return message['state']
+
+
+def _recv_exactly(channel, n):
+    chunks = []
+    while n:
+        chunk = channel.recv(min(n, 65536))
+        if not chunk:
+            raise HandoffError("The predecessor closed the channel")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def request_handoff(path, timeout=None):
+    """
+    Ask the server listening for successors on the unix socket ``path``
+    to hand over.
+
+    The listening socket comes first, then the state once the predecessor
+    has drained its in-flight requests. Connections arriving meanwhile wait
+    in the socket's backlog. Should the state not come, the socket is kept
+    and the caller starts cold rather than leaving it unserved.
+
+    :param timeout: the seconds to wait for the listening socket. The
+        state is then waited for however long the predecessor drains; its
+        own drain timeout bounds that, and the channel closes if it exits.
+    :return: the listening socket and the state (or None), or None if no
+        server was waiting for a successor
+    """
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        channel.close()
+        LOGGER.info("No predecessor listening on %s", path)
+        return None
+
+    with channel:
+        channel.settimeout(timeout)
+        channel.sendall(HANDOFF_REQUEST)
+        listener = receive_socket(channel)
+        channel.settimeout(None)
+        LOGGER.info("Inherited the listening socket %s",
+                    listener.getsockname())
+        try:
+            state = read_state(channel)
+        except (HandoffError, OSError, ValueError) as e:
+            LOGGER.error("Starting without the predecessor's state: %s", e)
+            state = None
+
+    return listener, state
+
+
+async def wait_for_successor(path, loop):
+    """
+    Listen on the unix socket ``path`` until a successor process asks for a
+    handoff (see :func:`request_handoff`). The path is unlinked first in
+    case a predecessor died without cleaning up, and again when done.
+
+    :return: the non-blocking channel to the successor
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(1)
+        listener.setblocking(False)
+        LOGGER.info("Waiting for a successor on %s", path)
+
+        while True:
+            channel, _ = await loop.sock_accept(listener)
+            channel.setblocking(False)
+            request = b''
+            while len(request) < len(HANDOFF_REQUEST):
+                chunk = await loop.sock_recv(
+                    channel, len(HANDOFF_REQUEST) - len(request))
+                if not chunk:
+                    break
+                request += chunk
+
+            if request == HANDOFF_REQUEST:
+                return channel
+
+            LOGGER.error("Ignoring a bad handoff request: %r", request)
+            channel.close()
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1,91 @@
+import hashlib
+from bisect import bisect, bisect_left, insort
+
+
+class HashRing:
+    """
+    A consistent hash ring.
+
+    Each node sits at ``replicas`` points on the ring, and a key belongs to
+    the first node clockwise of the key's own hash. Adding or removing a
+    node only moves the keys next to its points, about ``1 / n`` of them.
+    """
+    def __init__(self, replicas=64):
+        """
+        :param replicas: the points per node; more spread keys more evenly
+        """
+        self._replicas = replicas
+        self._points = []  # Sorted hashes.
+        self._nodes = {}   # hash -> node
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def _node_points(self, node):
+        return (self._hash("{}#{}".format(node, i))
+                for i in range(self._replicas))
+
+    def add(self, node):
+        for point in self._node_points(node):
+            if point not in self._nodes:
+                self._nodes[point] = node
+                insort(self._points, point)
+
+    def add_many(self, nodes):
+        """
+        Add several nodes, sorting the ring once rather than inserting each
+        point in turn.
+        """
+        added = False
+        for node in nodes:
+            for point in self._node_points(node):
+                if point not in self._nodes:
+                    self._nodes[point] = node
+                    self._points.append(point)
+                    added = True
+
+        if added:
+            self._points.sort()
+
+    def remove(self, node):
+        for point in self._node_points(node):
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                del self._points[bisect_left(self._points, point)]
+
+    def remove_many(self, nodes):
+        """
+        Remove several nodes with one pass over the ring, rather than one
+        list deletion per point.
+        """
+        removed = False
+        for node in nodes:
+            for point in self._node_points(node):
+                if self._nodes.get(point) == node:
+                    del self._nodes[point]
+                    removed = True
+
+        if removed:
+            self._points = [p for p in self._points if p in self._nodes]
+
+    def walk(self, key):
+        """
+        Yield each node once, clockwise from the key: its owner first, then
+        the nodes that would take over from it in turn.
+        """
+        n = len(self._points)
+        start = bisect(self._points, self._hash(key))
+        seen = set()
+        for i in range(n):
+            node = self._nodes[self._points[(start + i) % n]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+    def owner(self, key):
+        """
+        :return: the node the key maps to, or None on an empty ring
+        """
+        return next(self.walk(key), None)
@@ -0,0 +1,157 @@
+import math
+from array import array
+
+
+# (seconds per bucket, buckets) of each tier, finest first: a second's
+# resolution for ten minutes, and a minute's for a day.
+DEFAULT_TIERS = ((1, 600), (60, 1440))
+
+# What every bucket sums.
+FIELDS = ('acquired', 'timed_out', 'wait', 'released', 'failed', 'expired',
+          'utilisation', 'samples')
+
+
+class RingSeries:
+    """
+    Sums over fixed-width time buckets, kept in one preallocated array per
+    field and reused as a ring: as time moves on, the oldest bucket is
+    cleared and becomes the newest. Memory is fixed at ``size`` floats per
+    field.
+    """
+    def __init__(self, resolution, size, fields=FIELDS):
+        """
+        :param resolution: seconds per bucket
+        :param size: the number of buckets kept
+        """
+        self.resolution = resolution
+        self.size = size
+        self._columns = {field: array('f', [0.0]) * size for field in fields}
+        self._newest = None  # The absolute number of the newest bucket.
+
+    @property
+    def span(self):
+        return self.resolution * self.size
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column)
+                   for column in self._columns.values())
+
+    def add(self, now, values):
+        """
+        Add to the sums of the bucket ``now`` falls in. Buckets skipped
+        since the last add are cleared on the way, so the cost is constant
+        amortised over time.
+
+        :param values: a mapping of field to amount
+        """
+        bucket = int(now // self.resolution)
+        newest = self._newest
+        if newest is None:
+            self._newest = bucket
+        elif bucket > newest:
+            for skipped in range(max(newest + 1, bucket - self.size + 1),
+                                 bucket + 1):
+                i = skipped % self.size
+                for column in self._columns.values():
+                    column[i] = 0.0
+            self._newest = bucket
+        elif bucket <= newest - self.size:
+            return  # Older than the ring reaches back.
+
+        i = bucket % self.size
+        for field, value in values.items():
+            self._columns[field][i] += value
+
+    def read(self, now, count):
+        """
+        :return: per field, the sums of the last ``count`` buckets up to the
+            one ``now`` falls in, oldest first
+        """
+        end = int(now // self.resolution)
+        count = min(count, self.size)
+        newest = self._newest
+        res = {}
+        for field, column in self._columns.items():
+            res[field] = [column[b % self.size]
+                          if newest is not None
+                          and newest - self.size < b <= newest else 0.0
+                          for b in range(end - count + 1, end + 1)]
+        return res
+
+
+class DomainHistory:
+    """
+    A domain's recent acquires, waits, releases, failures and pool
+    utilisation, in tiers of :class:`RingSeries` from fine and short to
+    coarse and long. Every event is added to each tier.
+    """
+    def __init__(self, clock, tiers=DEFAULT_TIERS):
+        """
+        :param clock: returns the current time in seconds
+        :param tiers: ``(seconds per bucket, buckets)`` pairs, finest first
+        """
+        self._clock = clock
+        self._tiers = [RingSeries(resolution, size)
+                       for resolution, size in tiers]
+
+    @property
+    def nbytes(self):
+        return sum(tier.nbytes for tier in self._tiers)
+
+    def record(self, **values):
+        """
+        :param values: amounts to add, by field (see ``FIELDS``)
+        """
+        now = self._clock()
+        for tier in self._tiers:
+            tier.add(now, values)
+
+    def series(self, window=None, step=None):
+        """
+        Downsample the history into points.
+
+        The window is read from the finest tier that spans it (or else the
+        coarsest, cut to its span), and its buckets are summed into points
+        of ``step`` seconds, rounded up to a whole number of buckets.
+
+        :param window: seconds of history; the finest tier's span by default
+        :param step: seconds per point; the tier's resolution by default
+        :return: ``step``, ``window`` and, oldest first with the last one
+            still filling up, the points' ``acquired``, ``timed_out``,
+            ``released``, ``failed`` and ``expired`` counts, their
+            ``acquire_rate`` per second, and their ``mean_wait``,
+            ``failure_rate`` (of releases) and mean ``utilisation`` (None
+            where nothing was recorded)
+        """
+        if window is None:
+            window = self._tiers[0].span
+        tier = next((t for t in self._tiers if t.span >= window),
+                    self._tiers[-1])
+
+        per_point = int(math.ceil((step or 0) / tier.resolution))
+        per_point = min(max(1, per_point), tier.size)
+        step = per_point * tier.resolution
+        points = max(1, int(math.ceil(window / step)))
+        points = min(points, tier.size // per_point)
+        buckets = tier.read(self._clock(), points * per_point)
+
+        sums = {field: [sum(values[i:i + per_point])
+                        for i in range(0, len(values), per_point)]
+                for field, values in buckets.items()}
+
+        res = {'step': step, 'window': len(sums['acquired']) * step}
+        for field in ('acquired', 'timed_out', 'released', 'failed',
+                      'expired'):
+            res[field] = [int(n) for n in sums[field]]
+        res['acquire_rate'] = [n / step for n in sums['acquired']]
+        res['mean_wait'] = _ratios(
+            sums['wait'], [a + t for a, t in zip(sums['acquired'],
+                                                 sums['timed_out'])])
+        res['failure_rate'] = _ratios(sums['failed'], sums['released'])
+        res['utilisation'] = _ratios(sums['utilisation'], sums['samples'])
+        return res
+
+
+def _ratios(numerators, denominators):
+    return [n / d if d else None for n, d in zip(numerators, denominators)]
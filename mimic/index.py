@@ -0,0 +1,224 @@
+import ipaddress
+import math
+import re
+from bisect import bisect_left, bisect_right
+from mimic.query import EMPTY
+
+
+INDEXED_FIELDS = ('proto', 'host', 'port', 'geo', 'anon_level')
+
+# Bare (un-namespaced) terms match any of these, as they did originally.
+LEGACY_FIELDS = ('geo', 'anon_level')
+
+RANGE_FIELDS = ('resp_time',)
+
+_CIDR_TERM = re.compile(r'^host:([0-9A-Fa-f.:]+/\d+)$')
+
+_RANGE_TERM = re.compile(r'^(\w+)\s*(<=|>=|<|>)\s*'
+                         r'([-+]?[0-9.]+(?:[eE][-+]?\d+)?)$')
+
+
+def index_keys(proxy_props):
+    """
+    :return: the namespaced index keys for a proxy (e.g. ``geo:US``,
+        ``port:3128``, ``tag:ACME``)
+    """
+    keys = []
+    for field in INDEXED_FIELDS:
+        value = getattr(proxy_props, field)
+        if value is not None:
+            keys.append("{}:{}".format(field, value))
+    keys.extend("tag:{}".format(tag) for tag in proxy_props.tags)
+    return tuple(keys)
+
+
+class RangeIndex:
+    """
+    Proxies sorted by a numeric value, for ``<``, ``<=``, ``>`` and ``>=``
+    selection by bisection.
+    """
+    def __init__(self):
+        self._values = []   # Sorted.
+        self._proxies = []  # Parallel to ``_values``.
+        self._by_proxy = {}
+
+    def __len__(self):
+        return len(self._by_proxy)
+
+    def add(self, proxy, value):
+        """
+        Index a proxy under a value, replacing any previous value.
+
+        :raises ValueError: if the value is NaN or infinite, which would
+            break the ordering
+        """
+        if not math.isfinite(value):
+            raise ValueError("Can't index {} under {!r}".format(proxy, value))
+        self.remove(proxy)
+
+        i = bisect_right(self._values, value)
+        self._values.insert(i, value)
+        self._proxies.insert(i, proxy)
+        self._by_proxy[proxy] = value
+
+    def value_of(self, proxy):
+        return self._by_proxy.get(proxy)
+
+    def remove(self, proxy):
+        value = self._by_proxy.pop(proxy, None)
+        if value is None:
+            return
+
+        i = bisect_left(self._values, value)
+        while self._proxies[i] != proxy:
+            i += 1
+        del self._values[i]
+        del self._proxies[i]
+
+    def select(self, op, bound):
+        """
+        :param op: one of ``<``, ``<=``, ``>`` or ``>=``
+        :param bound: the value compared against
+        :return: the set of proxies whose value satisfies ``value op bound``
+        """
+        if op == '<':
+            lo, hi = 0, bisect_left(self._values, bound)
+        elif op == '<=':
+            lo, hi = 0, bisect_right(self._values, bound)
+        elif op == '>':
+            lo, hi = bisect_right(self._values, bound), len(self._values)
+        else:
+            lo, hi = bisect_left(self._values, bound), len(self._values)
+
+        return set(self._proxies[lo:hi])
+
+
+class PropertyIndex:
+    """
+    Posting lists from namespaced property keys to proxies, plus range
+    indexes over numeric properties.
+
+    Terms are looked up as:
+
+    - ``field:value`` for any of ``INDEXED_FIELDS`` or ``tag:name``
+    - ``resp_time<1.5`` (or ``<=``, ``>``, ``>=``) for ``RANGE_FIELDS``
+    - ``host:10.0.0.0/8`` for the hosts within a network (by address)
+    - a bare ``value``, matching it as a ``geo`` or ``anon_level``
+    """
+    def __init__(self):
+        self._postings = {}
+        self._keys = {}  # proxy -> its keys, for delisting without scans.
+        self._ranges = {field: RangeIndex() for field in RANGE_FIELDS}
+
+    def add(self, proxy, proxy_props):
+        """
+        Index a proxy's properties.
+
+        :param proxy: the proxy string
+        :param proxy_props: the proxy's ``ProxyProps``
+        """
+        self.remove(proxy)
+
+        # First, so that a value the range indexes refuse indexes nothing.
+        for field, range_index in self._ranges.items():
+            value = getattr(proxy_props, field)
+            if value is not None:
+                range_index.add(proxy, value)
+
+        keys = index_keys(proxy_props)
+        for key in keys:
+            self._postings.setdefault(key, set()).add(proxy)
+        self._keys[proxy] = keys
+
+    def remove(self, proxy):
+        """
+        Remove a proxy from every posting list and range index.
+        """
+        for key in self._keys.pop(proxy, ()):
+            proxies = self._postings[key]
+            proxies.discard(proxy)
+            if not proxies:
+                del self._postings[key]
+
+        for range_index in self._ranges.values():
+            range_index.remove(proxy)
+
+    def update_value(self, field, proxy, value):
+        """
+        Move a proxy within a range index (e.g. on a new response time).
+        """
+        if proxy in self._keys:
+            self._ranges[field].add(proxy, value)
+
+    def value(self, field, proxy):
+        """
+        :return: a proxy's value in a range index, or None
+        """
+        return self._ranges[field].value_of(proxy)
+
+    def posting(self, term):
+        """
+        :param term: a requirement term
+        :return: the set of proxies matching it
+        """
+        proxies = self._postings.get(term)
+        if proxies is not None:
+            return proxies
+
+        match = _RANGE_TERM.match(term)
+        if match:
+            field, op, bound = match.groups()
+            range_index = self._ranges.get(field)
+            if range_index is None:
+                return EMPTY
+            return range_index.select(op, float(bound))
+
+        match = _CIDR_TERM.match(term)
+        if match:
+            return self._hosts_within(match.group(1))
+
+        # Bare values may hold a colon too (e.g. ProxyBroker's CONNECT:80
+        # anonymity level); an unknown namespace finds nothing here.
+        legacy = [self._postings.get(field + ':' + term, EMPTY)
+                  for field in LEGACY_FIELDS]
+        return set().union(*legacy) if all(legacy) else max(legacy, key=len)
+
+    def _hosts_within(self, cidr):
+        """
+        :return: the set of proxies whose host is an address in the network
+        """
+        try:
+            network = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            return EMPTY
+
+        matching = set()
+        for key, proxies in self._postings.items():
+            if not key.startswith('host:'):
+                continue
+            try:
+                address = ipaddress.ip_address(key[5:].strip('[]'))
+            except ValueError:
+                continue  # A hostname.
+            if address in network:
+                matching |= proxies
+        return matching
+
+    def keys_of(self, proxy):
+        return self._keys.get(proxy, ())
+
+    def sizes(self):
+        """
+        :return: per namespace (e.g. ``geo``), the number of distinct keys
+            and of proxies under them, so the size doesn't grow with the pool
+        """
+        sizes = {}
+        for key, proxies in self._postings.items():
+            namespace = key.partition(':')[0]
+            counts = sizes.setdefault(namespace, {'keys': 0, 'entries': 0})
+            counts['keys'] += 1
+            counts['entries'] += len(proxies)
+        return sizes
+
+    def __contains__(self, proxy):
+        return proxy in self._keys
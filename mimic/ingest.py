@@ -0,0 +1,173 @@
+import aiohttp
+import asyncio
+import json
+
+from mimic.util import proxy_dicts_from_proxy_broker_proxy, setup_logger
+
+
+LOGGER = setup_logger('ingest')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(fp, chunk_size=CHUNK_SIZE):
+    """
+    Read a text file in chunks that end on line boundaries.
+
+    :param fp: an open text file
+    :param chunk_size: the number of characters read at a time
+    :return: a generator of chunks, each holding whole lines
+    """
+    tail = ''
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+
+        data = tail + data
+        cut = data.rfind('\n') + 1
+        tail = data[cut:]
+        if cut:
+            yield data[:cut]
+
+    if tail:
+        yield tail
+
+
+class IngestPipeline:
+    """
+    Streams ProxyBroker proxies into a mimic server.
+
+    Proxies are converted with ``proxy_dicts_from_proxy_broker_proxy``,
+    grouped into batches of ``batch_size`` and handed to
+    ``max_connections`` workers through a queue holding at most
+    ``max_pending_batches`` batches. When registration falls behind, putting
+    a proxy blocks, which pushes back on whatever is producing them. Workers
+    share one pooled connector and post each batch to
+    ``/proxies/register_many`` in a single request.
+    """
+    def __init__(self, endpoint, loop=None,
+                 batch_size=50,
+                 max_pending_batches=4,
+                 max_connections=4,
+                 report_interval=5.0,
+                 report=print):
+        """
+        :param endpoint: url to the mimic server (with no trailing slash)
+        :param report: called with a progress line every
+            ``report_interval`` seconds
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        self._url = endpoint + '/proxies/register_many'
+        self._batch_size = batch_size
+        self._max_connections = max_connections
+        self._report_interval = report_interval
+        self._report = report
+
+        self._queue = asyncio.Queue(maxsize=max_pending_batches,
+                                    loop=self._loop)
+        self._batch = []
+        self._session = None
+        self._workers = []
+        self._reporter = None
+
+        self._start_time = None
+        self._seen = 0
+        self._registered = 0
+        self._failed = 0
+
+    async def start(self):
+        """
+        Open the connection pool and start the workers.
+        """
+        connector = aiohttp.TCPConnector(limit=self._max_connections,
+                                         loop=self._loop)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              loop=self._loop)
+        self._start_time = self._loop.time()
+        self._workers = [self._loop.create_task(self._work())
+                         for _ in range(self._max_connections)]
+        self._reporter = self._loop.create_task(self._report_progress())
+
+    async def put(self, proxy):
+        """
+        Add a ProxyBroker proxy, waiting if too many batches are pending.
+        """
+        for proxy_dict in proxy_dicts_from_proxy_broker_proxy(proxy):
+            self._batch.append(proxy_dict)
+            self._seen += 1
+            if len(self._batch) >= self._batch_size:
+                await self._flush()
+
+    async def consume(self, proxies):
+        """
+        Drain a ProxyBroker result queue until its ``None`` sentinel.
+        """
+        while True:
+            proxy = await proxies.get()
+            if proxy is None:
+                break
+            await self.put(proxy)
+        await self._flush()
+
+    async def close(self):
+        """
+        Flush pending proxies, wait for the workers and report totals.
+        """
+        await self._flush()
+        for _ in self._workers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._workers, loop=self._loop)
+
+        self._reporter.cancel()
+        await self._session.close()
+        self._report(self.progress_line())
+
+    async def _flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            await self._queue.put(batch)
+
+    async def _work(self):
+        while True:
+            batch = await self._queue.get()
+            if batch is None:
+                break
+            await self._post(batch)
+
+    async def _post(self, batch):
+        try:
+            async with self._session.post(
+                    self._url, data=json.dumps(batch),
+                    headers={'Content-Type': 'application/json'}) as resp:
+                await resp.read()
+                ok = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            LOGGER.info("Failed to register a batch: %s", e)
+            ok = False
+
+        if ok:
+            self._registered += len(batch)
+        else:
+            self._failed += len(batch)
+
+    async def _report_progress(self):
+        try:
+            while True:
+                await asyncio.sleep(self._report_interval, loop=self._loop)
+                self._report(self.progress_line())
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self):
+        elapsed = max(self._loop.time() - (self._start_time or 0), 1e-9)
+        return {'seen': self._seen,
+                'registered': self._registered,
+                'failed': self._failed,
+                'pending_batches': self._queue.qsize(),
+                'per_second': self._registered / elapsed}
+
+    def progress_line(self):
+        return ("seen={seen} registered={registered} failed={failed} "
+                "pending_batches={pending_batches} "
+                "rate={per_second:.1f}/s".format(**self.stats()))
@@ -0,0 +1,46 @@
+import uuid
+
+
+def new_lease_id():
+    """
+    :return: an opaque, unguessable lease identifier
+    """
+    return uuid.uuid4().hex
+
+
+class Lease:
+    """
+    A client's claim on a proxy until ``deadline`` (in loop time).
+
+    A hedged lease covers a small group of ``proxies`` that carry the same
+    request; ``proxy`` is the first of them.
+
+    The ``fence`` increases with every lease a broker grants, so anything
+    downstream that tracks the last fence it saw can refuse work from a
+    holder whose lease has already been superseded.
+    """
+    __slots__ = ['id', 'proxies', 'client', 'fence', 'acquired_at',
+                 'deadline']
+
+    def __init__(self, proxies, client, fence, acquired_at, deadline,
+                 lease_id=None):
+        self.id = lease_id or new_lease_id()
+        self.proxies = tuple(proxies)
+        self.client = client
+        self.fence = fence
+        self.acquired_at = acquired_at
+        self.deadline = deadline
+
+    @property
+    def proxy(self):
+        return self.proxies[0]
+
+    def expires_in(self, now):
+        return max(0.0, self.deadline - now)
+
+    def to_dict(self, now):
+        return {'lease': self.id,
+                'proxy': self.proxy,
+                'proxies': list(self.proxies),
+                'fence': self.fence,
+                'expires_in': self.expires_in(now)}
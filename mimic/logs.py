@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+# Every service logs under this one (see ``mimic.util.setup_logger``).
+ROOT_LOGGER = 'mimic'
+
+# Records waiting for the background thread before new ones are dropped.
+MAX_QUEUED_RECORDS = 10000
+
+
+def event_of(record):
+    """
+    :return: the record's event name (``extra={'event': ...}``), or else
+        its message template, which is just as stable
+    """
+    return getattr(record, 'event', None) or record.msg
+
+
+def parse_sample_rates(specs):
+    """
+    :param specs: ``event=rate`` strings, e.g. ``acquire=0.01``
+    :return: a mapping of event to rate
+    :raises ValueError: on a malformed spec or a rate outside [0, 1]
+    """
+    rates = {}
+    for spec in specs:
+        event, sep, rate = spec.partition('=')
+        if not sep or not event:
+            raise ValueError("Expected event=rate, not {}".format(spec))
+        rates[event] = float(rate)
+        if not 0 <= rates[event] <= 1:
+            raise ValueError("Sample rates go from 0 to 1: {}".format(spec))
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line.
+    """
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'event': event_of(record),
+                 'message': record.getMessage()}
+        if record.args:
+            entry['args'] = record.args
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Thins out chatty events.
+
+    An event with a sample rate keeps only that fraction of its records,
+    at random; and, with ``max_per_second``, every event is held to that
+    many records a second (a token bucket with as large a burst). The next
+    record kept for an event carries the number dropped before it as
+    ``suppressed``.
+    """
+    def __init__(self, sample_rates=None, max_per_second=None,
+                 clock=time.monotonic):
+        """
+        :param sample_rates: a mapping of event to the fraction of its
+            records to keep
+        :param max_per_second: the most records per event per second, or
+            None for no limit
+        """
+        super().__init__()
+        self._sample_rates = dict(sample_rates or {})
+        self._max_per_second = max_per_second
+        self._clock = clock
+        self._buckets = {}  # event -> [tokens, last refill]
+        self._suppressed = {}  # event -> dropped since the last kept one
+
+    def filter(self, record):
+        event = event_of(record)
+
+        rate = self._sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return self._drop(event)
+
+        if self._max_per_second is not None and not self._take_token(event):
+            return self._drop(event)
+
+        suppressed = self._suppressed.pop(event, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _take_token(self, event):
+        now = self._clock()
+        bucket = self._buckets.get(event)
+        if bucket is None:
+            bucket = self._buckets[event] = [self._max_per_second, now]
+
+        tokens = min(self._max_per_second,
+                     bucket[0] + (now - bucket[1]) * self._max_per_second)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+
+        bucket[0] = tokens - 1
+        return True
+
+    def _drop(self, event):
+        self._suppressed[event] = self._suppressed.get(event, 0) + 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records, unformatted, to a bounded queue for a background thread
+    to format and write. When the queue is full, records are dropped and
+    counted rather than blocking the caller.
+
+    Since formatting is deferred, arguments should not be mutated after
+    they are logged.
+    """
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(stream=None, json_lines=True, sample_rates=None,
+                      max_per_second=None, max_queued=MAX_QUEUED_RECORDS):
+    """
+    Route all of mimic's logging through a queue drained by a background
+    thread, replacing the handlers ``setup_logger`` installed.
+
+    :param stream: where to write records; stderr by default
+    :param json_lines: write JSON lines (see :class:`JSONFormatter`), or
+        else the plain messages
+    :param sample_rates: see :class:`SamplingFilter`
+    :param max_per_second: see :class:`SamplingFilter`
+    :param max_queued: records waiting to be written before new ones are
+        dropped
+    :return: the queue handler, for its ``dropped`` count
+    """
+    global _listener
+    stop_logging()
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    if json_lines:
+        writer.setFormatter(JSONFormatter())
+
+    handler = NonBlockingQueueHandler(queue.Queue(max_queued))
+    handler.addFilter(SamplingFilter(sample_rates, max_per_second))
+
+    root = logging.getLogger(ROOT_LOGGER)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.propagate = False
+
+    _listener = QueueListener(handler.queue, writer)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """
+    Write out queued records and stop the background thread, if running.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
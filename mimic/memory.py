@@ -0,0 +1,87 @@
+import sys
+from collections import deque
+from itertools import islice
+
+
+# Elements measured per container; the rest are assumed to be alike.
+SAMPLE_SIZE = 32
+
+# The most elements a client may ask to have measured per container.
+MAX_SAMPLE_SIZE = 10000
+
+# How far into nested containers (and mimic's own objects) to look.
+MAX_DEPTH = 3
+
+_SEQUENCES = (list, tuple, set, frozenset, deque)
+
+
+def estimate_size(obj, sample=SAMPLE_SIZE, depth=MAX_DEPTH):
+    """
+    Estimate the bytes an object holds.
+
+    Containers are sized by measuring up to ``sample`` of their elements
+    and scaling by their length, so the cost is bounded however large the
+    pool grows. Only builtin containers and mimic's own objects are looked
+    into; anything else (e.g. tasks) counts its own shallow size.
+
+    Shared objects, such as the proxy strings every domain keys on, count
+    once in every structure that refers to them, so totals overestimate.
+
+    :param sample: the elements measured per container
+    :param depth: how many levels of nesting to look into
+    :return: the estimated bytes
+    """
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+
+    if isinstance(obj, dict):
+        elements = islice(obj.items(), sample)
+    elif isinstance(obj, _SEQUENCES):
+        elements = islice(obj, sample)
+    elif type(obj).__module__.startswith('mimic.'):
+        return size + sum(estimate_size(value, sample, depth - 1)
+                          for value in _attributes(obj))
+    else:
+        return size
+
+    n = len(obj)
+    measured = 0
+    total = 0
+    for element in elements:
+        measured += 1
+        if isinstance(obj, dict):
+            key, element = element
+            total += estimate_size(key, sample, depth - 1)
+        total += estimate_size(element, sample, depth - 1)
+
+    if measured:
+        size += int(total * n / measured)
+    return size
+
+
+def _attributes(obj):
+    if hasattr(obj, '__dict__'):
+        return list(vars(obj).values())
+    return [getattr(obj, name) for name in getattr(obj, '__slots__', ())
+            if hasattr(obj, name)]
+
+
+def structure_sizes(obj, names, sample=SAMPLE_SIZE):
+    """
+    :param names: the attributes of ``obj`` to measure
+    :return: a mapping of each attribute (without its leading underscore)
+        to its estimated bytes
+    """
+    return {name.lstrip('_'): estimate_size(getattr(obj, name), sample)
+            for name in names}
+
+
+def count_unknown(keys, known):
+    """
+    :return: how many of the keys are not in ``known`` (a container or a
+        predicate)
+    """
+    if callable(known):
+        return sum(1 for key in keys if not known(key))
+    return sum(1 for key in keys if key not in known)
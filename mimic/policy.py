@@ -0,0 +1,145 @@
+import json
+import math
+from numbers import Real
+from mimic.broker import TUNABLE_DEFAULTS
+
+
+# Settings that map client identities to numbers; the rest are numbers.
+MAPPING_SETTINGS = ('client_weights', 'client_caps')
+
+# Settings for which 0 is meaningless (a zero weight, delay or capacity);
+# the rest may be 0 (e.g. a cap of 0 turns a client away).
+POSITIVE_SETTINGS = ('return_delay', 'auto_return_delay', 'bad_return_delay',
+                     'max_consecutive_failures', 'retry_time',
+                     'client_weights', 'proxy_capacity')
+
+
+def _is_amount(value, positive=False):
+    return (isinstance(value, Real) and not isinstance(value, bool)
+            and math.isfinite(value)
+            and (value > 0 if positive else value >= 0))
+
+
+def check_settings(settings):
+    """
+    Check broker settings against ``TUNABLE_DEFAULTS``: every key must be
+    known, and every value a non-negative number (positive for
+    ``POSITIVE_SETTINGS``; for ``MAPPING_SETTINGS``, a mapping of client to
+    one), or None where the default is None.
+
+    :raises ValueError: on the first bad setting
+    """
+    if not isinstance(settings, dict):
+        raise ValueError("Broker settings must be an object, not {!r}".format(
+            settings))
+
+    unknown = set(settings) - set(TUNABLE_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown broker settings: {}".format(
+            ", ".join(sorted(unknown))))
+
+    for name, value in settings.items():
+        if value is None and TUNABLE_DEFAULTS[name] is None:
+            continue
+        positive = name in POSITIVE_SETTINGS
+        if name in MAPPING_SETTINGS:
+            ok = isinstance(value, dict) and all(
+                isinstance(k, str) and _is_amount(v, positive)
+                for k, v in value.items())
+        else:
+            ok = _is_amount(value, positive)
+        if not ok:
+            raise ValueError("Bad value for {}: {!r}".format(name, value))
+
+
+class PolicyTable:
+    """
+    Broker settings per domain pattern.
+
+    A pattern is either an exact domain (``example.com``) or a wildcard over
+    its subdomains at any depth (``*.example.com``). A domain takes the
+    ``default`` settings, overridden by its exact pattern if there is one,
+    or else by the longest matching wildcard. Resolutions are cached per
+    domain until the table is replaced.
+    """
+    def __init__(self, default=None, domains=None):
+        """
+        :param default: settings for every domain
+        :param domains: a mapping of pattern to settings
+        :raises ValueError: on a malformed table or a bad setting (see
+            :func:`check_settings`), so that ``Broker.configure`` never sees
+            one
+        """
+        default = {} if default is None else default
+        check_settings(default)
+        self._default = dict(default)
+
+        domains = {} if domains is None else domains
+        if not isinstance(domains, dict):
+            raise ValueError("domains must be an object of pattern to "
+                             "settings, not {!r}".format(domains))
+
+        self._exact = {}
+        self._wildcards = {}  # suffix (without "*.") -> settings
+        for pattern, settings in domains.items():
+            if not isinstance(pattern, str):
+                raise ValueError("Bad domain pattern: {!r}".format(pattern))
+            check_settings(settings)
+            pattern = pattern.lower()
+            if pattern.startswith('*.'):
+                self._wildcards[pattern[2:]] = dict(settings)
+            else:
+                self._exact[pattern] = dict(settings)
+
+        self._cache = {}
+
+    @classmethod
+    def from_dict(cls, table):
+        """
+        :raises ValueError: if the table is malformed
+        """
+        if not isinstance(table, dict):
+            raise ValueError("A policy table must be an object, not "
+                             "{!r}".format(table))
+        return cls(table.get('default'), table.get('domains'))
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a JSON file of the form
+        ``{"default": {...}, "domains": {"pattern": {...}}}``.
+        """
+        with open(path) as fp:
+            return cls.from_dict(json.load(fp))
+
+    def _match(self, domain):
+        settings = self._exact.get(domain)
+        if settings is not None:
+            return settings
+
+        # Strip one leading label at a time: the longest suffix wins.
+        rest = domain
+        while '.' in rest:
+            rest = rest.split('.', 1)[1]
+            settings = self._wildcards.get(rest)
+            if settings is not None:
+                return settings
+        return None
+
+    def settings_for(self, domain):
+        """
+        :param domain: an (interned) broker domain
+        :return: the broker settings for the domain
+        """
+        settings = self._cache.get(domain)
+        if settings is None:
+            settings = dict(self._default)
+            settings.update(self._match(domain) or {})
+            self._cache[domain] = settings
+        return settings
+
+    def to_dict(self):
+        domains = dict(self._exact)
+        domains.update(('*.' + suffix, settings)
+                       for suffix, settings in self._wildcards.items())
+        return {'default': self._default, 'domains': domains}
@@ -0,0 +1,180 @@
+import aiohttp
+import asyncio
+
+from mimic.util import setup_logger
+
+
+LOGGER = setup_logger('prober')
+
+FIVE_MINUTES = 5 * 60
+
+
+class ProxyProber:
+    """
+    Checks registered proxies in the background.
+
+    Every proxy is fetched through against a probe target (ideally a local or
+    internal endpoint, so probing never touches third-party sites). Each
+    sweep spaces probes ``probe_period / len(pool)`` seconds apart, so every
+    proxy is checked about once a period regardless of pool size, but never
+    faster than ``max_probe_rate`` probes a second. At most
+    ``max_concurrency`` probes are in flight, sharing one pooled connector.
+
+    Successful probes feed their response time to every ``DomainMonitor``.
+    After ``max_failures`` consecutive failed probes a proxy is delisted
+    globally.
+    """
+    def __init__(self, proxy_collection, brokerage, probe_url, loop=None,
+                 max_concurrency=10,
+                 timeout=10,
+                 max_failures=3,
+                 probe_period=FIVE_MINUTES,
+                 max_probe_rate=10.0,
+                 probe_fn=None):
+        """
+        :param probe_url: the url fetched through each proxy
+        :param probe_fn: an optional coroutine function ``(proxy) -> bool``
+            replacing the HTTP probe (e.g. for tests)
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        self._proxy_collection = proxy_collection
+        self._brokerage = brokerage
+        self._probe_url = probe_url
+        self._max_concurrency = max_concurrency
+        self._timeout = timeout
+        self._max_failures = max_failures
+        self._probe_period = probe_period
+        self._max_probe_rate = max_probe_rate
+        self._probe_fn = probe_fn or self._http_probe
+
+        self._semaphore = asyncio.Semaphore(max_concurrency, loop=self._loop)
+        self._session = None
+        self._task = None
+        self._in_flight = set()
+
+        self._consecutive_failures = {}
+        self._probes_run = 0
+        self._probes_failed = 0
+        self._delisted = 0
+
+    def start(self):
+        """
+        Start sweeping in the background.
+        """
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+            LOGGER.info("Started prober against %s", self._probe_url)
+
+    async def stop(self):
+        """
+        Stop sweeping and close pooled connections.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        for task in list(self._in_flight):
+            task.cancel()
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        try:
+            while True:
+                await self.sweep()
+        except asyncio.CancelledError:
+            pass
+
+    async def sweep(self):
+        """
+        Probe every registered proxy once.
+        """
+        proxies = self._proxy_collection.proxy_names()
+        if not proxies:
+            await asyncio.sleep(self._probe_period, loop=self._loop)
+            return
+
+        spacing = max(self._probe_period / len(proxies),
+                      1.0 / self._max_probe_rate)
+
+        for proxy in proxies:
+            await self._semaphore.acquire()
+            task = self._loop.create_task(self._probe_and_record(proxy))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+            await asyncio.sleep(spacing, loop=self._loop)
+
+    async def probe(self, proxy):
+        """
+        Probe a single proxy and record the outcome.
+
+        :param proxy: the proxy string
+        :return: the response time, or None on failure
+        """
+        start_time = self._loop.time()
+        try:
+            ok = await asyncio.wait_for(self._probe_fn(proxy),
+                                        self._timeout, loop=self._loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            ok = False
+
+        self._probes_run += 1
+        if ok is None:  # The probe can't check this kind of proxy.
+            return None
+        elif ok:
+            response_time = self._loop.time() - start_time
+            self._consecutive_failures.pop(proxy, None)
+            self._proxy_collection.record_response_time(proxy, response_time)
+            return response_time
+        else:
+            self._probes_failed += 1
+            self._record_failure(proxy)
+            return None
+
+    async def _probe_and_record(self, proxy):
+        try:
+            await self.probe(proxy)
+        finally:
+            self._semaphore.release()
+
+    def _record_failure(self, proxy):
+        failures = self._consecutive_failures.get(proxy, 0) + 1
+        if failures < self._max_failures:
+            self._consecutive_failures[proxy] = failures
+            return
+
+        LOGGER.info("Proxy %s failed %s probes; delisting", proxy, failures)
+        self._consecutive_failures.pop(proxy, None)
+        # The brokers delist it from their monitors, and forget its score.
+        self._brokerage.delist_on_all(proxy)
+        self._proxy_collection.unregister_many([proxy])
+        self._delisted += 1
+
+    async def _http_probe(self, proxy):
+        proto, _, address = proxy.partition('://')
+        if not proto.startswith('HTTP'):
+            return None  # aiohttp only speaks to HTTP proxies.
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency,
+                                             loop=self._loop)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  loop=self._loop)
+
+        async with self._session.get(self._probe_url,
+                                     proxy='http://' + address.lower(),
+                                     timeout=self._timeout) as resp:
+            await resp.read()
+            return resp.status < 400
+
+    def stats(self):
+        return {'probe_url': self._probe_url,
+                'probes_run': self._probes_run,
+                'probes_failed': self._probes_failed,
+                'in_flight': len(self._in_flight),
+                'failing': len(self._consecutive_failures),
+                'delisted': self._delisted}
@@ -1,3 +1,6 @@
+from mimic.index import PropertyIndex
+from mimic.memory import SAMPLE_SIZE, estimate_size
+from mimic.query import Query
 from mimic.util import ProxyProps, setup_logger
 from copy import deepcopy
 
@@ -9,19 +12,132 @@ class ProxyCollection:
     def __init__(self):
         self._proxies = {}
         self._monitors = {}
+        self._props = PropertyIndex()  # Of the registry, for bulk changes.
 
     def register_proxy(self, proxy):
         proxy = ProxyProps(**proxy)
+        self._props.add(str(proxy), proxy)
         self._proxies[str(proxy)] = proxy
         for monitor in self._monitors.values():
             monitor.register(proxy)
-        LOGGER.info("ProxyCollection registering %s", str(proxy))
+        LOGGER.info("ProxyCollection registering %s", proxy)
+
+    def delist_proxy(self, proxy):
+        """
+        Remove a proxy from the collection and from every domain monitor.
+
+        :param proxy: the proxy string
+        """
+        if self._proxies.pop(proxy, None) is None:
+            return False
+
+        self._props.remove(proxy)
+        for monitor in self._monitors.values():
+            monitor.delist(proxy)
+        LOGGER.info("ProxyCollection delisting %s", proxy)
+        return True
+
+    def record_response_time(self, proxy, response_time):
+        """
+        Feed a measured response time to every domain monitor.
+        """
+        self._props.update_value('resp_time', proxy, response_time)
+        for monitor in self._monitors.values():
+            monitor.record_response_time(proxy, response_time)
+
+    def select(self, *requirements):
+        """
+        :param requirements: requirement terms, as for an acquire (see
+            :class:`mimic.query.Query`), matched against the registered
+            properties and the latest probed response times
+        :return: the set of registered proxy strings matching them all
+        """
+        query = Query.compile(requirements)
+        return set(query.candidates(self._proxies.keys(),
+                                    self._props.posting))
+
+    def delist_many(self, proxies):
+        """
+        Remove several proxies from the collection and from every domain
+        monitor.
+
+        :return: the number that were registered
+        """
+        proxies = self.unregister_many(proxies)
+        for monitor in self._monitors.values():
+            monitor.delist_many(proxies)
+
+        LOGGER.info("ProxyCollection delisted %s proxies", len(proxies))
+        return len(proxies)
+
+    def unregister_many(self, proxies):
+        """
+        Remove several proxies from the collection only, for when the domain
+        monitors have already delisted them (as a broker's delist does).
+
+        :return: the list of those that were registered
+        """
+        proxies = [proxy for proxy in proxies
+                   if self._proxies.pop(proxy, None) is not None]
+        for proxy in proxies:
+            self._props.remove(proxy)
+        return proxies
+
+    def retag(self, proxies, geo=None, anon_level=None, add_tags=(),
+              remove_tags=()):
+        """
+        Change registered proxies' properties in place, re-indexing them in
+        every domain monitor without touching their leases or learned
+        response times.
+
+        :param geo: the new geo, if any
+        :param anon_level: the new anonymity level, if any
+        :param add_tags: tags to add
+        :param remove_tags: tags to remove
+        :return: the number of proxies retagged
+        """
+        retagged = 0
+        for proxy in proxies:
+            props = self._proxies.get(proxy)
+            if props is None:
+                continue
+
+            if geo is not None:
+                props.geo = geo
+            if anon_level is not None:
+                props.anon_level = anon_level
+            props.tags = (props.tags - frozenset(remove_tags)) | frozenset(
+                add_tags)
+
+            resp_time = self._props.value('resp_time', proxy)
+            self._props.add(proxy, props)
+            if resp_time is not None:
+                self._props.update_value('resp_time', proxy, resp_time)
+            for monitor in self._monitors.values():
+                monitor.reindex(props)
+            retagged += 1
+
+        LOGGER.info("ProxyCollection retagged %s proxies", retagged)
+        return retagged
 
     def register_domain_monitor(self, monitor):
         self._monitors[monitor.domain] = monitor
         for proxy in self._proxies.values():
             monitor.register(proxy)
 
+    def is_registered(self, proxy):
+        return proxy in self._proxies
+
+    def memory_usage(self, sample=SAMPLE_SIZE):
+        return {'proxies': estimate_size(self._proxies, sample),
+                'proxy_index': estimate_size(self._props, sample)}
+
+    def proxy_names(self):
+        """
+        :return: a snapshot list of the registered proxy strings
+        """
+        return list(self._proxies)
+
     @property
     def proxies(self):
         return deepcopy(self._proxies)
@@ -0,0 +1,96 @@
+import time
+from mimic.memory import SAMPLE_SIZE, count_unknown, structure_sizes
+from mimic.util import summarize
+
+
+class ProxyState:
+    """
+    Per-proxy state shared by every domain.
+
+    It caps how many leases a proxy may hold across all domains at once, and
+    keeps a failure score per proxy that decays by half every
+    ``failure_half_life`` seconds. The score lowers the proxy's chance of
+    being picked on every domain, so a proxy failing on many sites is
+    avoided on the next one, too. Every check is O(1).
+    """
+    def __init__(self, max_leases=None, failure_half_life=600.0,
+                 clock=time.monotonic):
+        """
+        :param max_leases: the most concurrent leases on one proxy, or None
+            for no limit
+        :param failure_half_life: seconds for a failure score to halve
+        :param clock: the time source for decay
+        """
+        self._max_leases = max_leases
+        self._half_life = failure_half_life
+        self._clock = clock
+        self._leases = {}    # proxy -> concurrent leases
+        self._failures = {}  # proxy -> (score, when it was last updated)
+
+    def can_lease(self, proxy, n=1):
+        """
+        :return: whether the proxy has room for ``n`` more leases
+        """
+        return (self._max_leases is None
+                or self._leases.get(proxy, 0) + n <= self._max_leases)
+
+    def leased(self, proxy):
+        self._leases[proxy] = self._leases.get(proxy, 0) + 1
+
+    def returned(self, proxy):
+        n = self._leases.get(proxy, 0) - 1
+        if n > 0:
+            self._leases[proxy] = n
+        else:
+            self._leases.pop(proxy, None)
+
+    def leases(self, proxy):
+        return self._leases.get(proxy, 0)
+
+    def record_failure(self, proxy):
+        now = self._clock()
+        self._failures[proxy] = (self.failure_score(proxy, now) + 1, now)
+
+    def forget(self, proxy):
+        """
+        Drop a delisted proxy's failure score.
+        """
+        self._failures.pop(proxy, None)
+
+    def failure_score(self, proxy, now=None):
+        """
+        :return: the proxy's failure count, decayed to ``now``
+        """
+        score, updated_at = self._failures.get(proxy, (0.0, 0.0))
+        if not score:
+            return 0.0
+
+        now = self._clock() if now is None else now
+        return score * 0.5 ** ((now - updated_at) / self._half_life)
+
+    def weight(self, proxy):
+        """
+        :return: the probability of accepting the proxy when it is picked,
+            from 1 (no recent failures) towards 0
+        """
+        return 1 / (1 + self.failure_score(proxy))
+
+    def memory_usage(self, sample=SAMPLE_SIZE):
+        return structure_sizes(self, ('_leases', '_failures'), sample)
+
+    def leaks(self, registered):
+        """
+        :param registered: a predicate for proxies still registered
+        :return: counts of lease counts and failure scores kept for the
+            proxies that aren't
+        """
+        return {'unregistered_lease_counts': count_unknown(self._leases,
+                                                           registered),
+                'unregistered_failure_scores': count_unknown(self._failures,
+                                                             registered)}
+
+    def stats(self):
+        now = self._clock()
+        return {'leased': summarize(self._leases.values()),
+                'failure_scores': summarize(self.failure_score(p, now)
+                                            for p in self._failures)}
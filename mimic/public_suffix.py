@@ -0,0 +1,185 @@
+"""
+A compiled public-suffix trie for finding registrable domains (eTLD+1).
+
+Rules use the `Public Suffix List <https://publicsuffix.org/list/>`_ format:
+one suffix per line, ``//`` comments, ``*.`` wildcards and ``!`` exceptions.
+A small set of common suffixes ships by default; load the full list with
+:meth:`PublicSuffixTrie.from_file` when accuracy on the long tail matters.
+"""
+
+_TERMINAL = '\0'
+_RULE = 1
+_EXCEPTION = 2
+
+
+DEFAULT_RULES = """
+com
+net
+org
+edu
+gov
+mil
+int
+info
+biz
+io
+co
+us
+ca
+de
+fr
+nl
+ru
+it
+es
+uk
+co.uk
+org.uk
+ac.uk
+gov.uk
+me.uk
+ltd.uk
+plc.uk
+au
+com.au
+net.au
+org.au
+edu.au
+gov.au
+nz
+co.nz
+org.nz
+jp
+co.jp
+ne.jp
+or.jp
+ac.jp
+br
+com.br
+net.br
+org.br
+cn
+com.cn
+net.cn
+org.cn
+gov.cn
+in
+co.in
+net.in
+org.in
+za
+co.za
+kr
+co.kr
+or.kr
+mx
+com.mx
+ar
+com.ar
+tr
+com.tr
+tw
+com.tw
+hk
+com.hk
+sg
+com.sg
+"""
+
+
+class PublicSuffixTrie:
+    """
+    A trie over reversed domain labels (``www.example.co.uk`` is walked as
+    ``uk``, ``co``, ``example``, ``www``).
+
+    Lookup cost is proportional to the number of labels in the host, not the
+    number of rules.
+    """
+    def __init__(self, rules=()):
+        self._root = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def from_string(cls, text):
+        """
+        Compile a trie from text in the Public Suffix List format.
+        """
+        return cls(_iter_rules(text.splitlines()))
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Compile a trie from a Public Suffix List file.
+        """
+        with open(path, encoding='utf-8') as fp:
+            return cls(_iter_rules(fp))
+
+    def add(self, rule):
+        """
+        Add a single rule (e.g. ``co.uk``, ``*.ck`` or ``!www.ck``).
+        """
+        rule = rule.strip().lower()
+        kind = _RULE
+        if rule.startswith('!'):
+            kind, rule = _EXCEPTION, rule[1:]
+
+        node = self._root
+        for label in reversed(rule.split('.')):
+            node = node.setdefault(label, {})
+        node[_TERMINAL] = kind
+
+    def public_suffix_length(self, labels):
+        """
+        :param labels: the host's labels, right-most (TLD) first
+        :return: the number of labels in the public suffix (at least one,
+            per the list's implicit ``*`` rule)
+        """
+        node, length = self._root, 1
+
+        for i, label in enumerate(labels):
+            wildcard = node.get('*')
+            if wildcard is not None and wildcard.get(_TERMINAL) == _RULE:
+                length = max(length, i + 1)
+
+            node = node.get(label)
+            if node is None:
+                break
+
+            kind = node.get(_TERMINAL)
+            if kind == _EXCEPTION:
+                return i
+            elif kind == _RULE:
+                length = max(length, i + 1)
+
+        return length
+
+    def registrable_domain(self, host):
+        """
+        :param host: a lower-cased host name, without port
+        :return: the public suffix plus one label (e.g. ``example.co.uk``),
+            or the host itself if it is an IP address or a bare suffix
+        """
+        if not host or host[0] == '[' or _is_ipv4(host):
+            return host
+
+        labels = host.split('.')
+        n = self.public_suffix_length(labels[::-1])
+        if len(labels) <= n:
+            return host
+
+        return '.'.join(labels[-(n + 1):])
+
+
+def _iter_rules(lines):
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('//'):
+            yield line.split()[0]
+
+
+def _is_ipv4(host):
+    return host.replace('.', '').isdigit()
+
+
+DEFAULT_SUFFIX_TRIE = PublicSuffixTrie.from_string(DEFAULT_RULES)
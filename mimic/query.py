@@ -0,0 +1,100 @@
+EMPTY = frozenset()
+
+
+class Query:
+    """
+    A compiled set of proxy requirements.
+
+    Each requirement is a term of tags joined by ``|`` (any may match). A
+    term starting with ``!`` excludes every tag in it. Terms are ANDed, so
+    ``['US|CA|GB', '!HTTP-TRANSPARENT']`` asks for a proxy in the US,
+    Canada or Britain that isn't transparent.
+    """
+    __slots__ = ['groups', 'negated']
+
+    def __init__(self, groups=(), negated=()):
+        """
+        :param groups: tuples of tags; a proxy must match a tag in each
+        :param negated: tags a proxy must not have
+        """
+        self.groups = tuple(tuple(group) for group in groups)
+        self.negated = tuple(negated)
+
+    @classmethod
+    def parse(cls, requirements):
+        """
+        :param requirements: an iterable of requirement terms
+        :return: the compiled query
+        """
+        groups, negated = [], []
+        for term in requirements:
+            term = term.strip()
+            is_negated = term.startswith('!')
+            if is_negated:
+                term = term[1:]
+
+            tags = [tag.strip() for tag in term.split('|') if tag.strip()]
+            if not tags:
+                continue
+
+            if is_negated:
+                negated.extend(tags)
+            else:
+                groups.append(tags)
+
+        return cls(groups, negated)
+
+    @classmethod
+    def compile(cls, requirements):
+        """
+        Like :meth:`parse`, but passes an already compiled query through.
+        """
+        if len(requirements) == 1 and isinstance(requirements[0], cls):
+            return requirements[0]
+        return cls.parse(requirements)
+
+    def candidates(self, available, postings):
+        """
+        Evaluate the query.
+
+        The planner visits OR groups from the smallest combined posting list
+        to the largest, so the working set shrinks as early as possible and
+        later groups are checked by membership instead of materialized.
+        Exclusions run last, over the (by then small) working set.
+
+        :param available: the set of proxies that may be returned; it is
+            never mutated
+        :param postings: a callable mapping a tag to its set of proxies
+        :return: the matching proxies (possibly ``available`` itself)
+        """
+        plan = []
+        for group in self.groups:
+            sets = [postings(tag) for tag in group]
+            plan.append((sum(len(s) for s in sets), sets))
+        plan.sort(key=lambda step: step[0])
+
+        result = available
+        for cost, sets in plan:
+            if not cost or not result:
+                return EMPTY
+            elif len(sets) == 1:
+                result = result & sets[0]  # Iterates the smaller set.
+            elif cost < len(result):
+                result = result & set().union(*sets)
+            else:
+                result = {p for p in result if any(p in s for s in sets)}
+
+        for tag in self.negated:
+            excluded = postings(tag)
+            if excluded and result:
+                result = result - excluded
+
+        return result
+
+    def __bool__(self):
+        return bool(self.groups or self.negated)
+
+    def __repr__(self):
+        terms = ['|'.join(group) for group in self.groups]
+        terms.extend('!' + tag for tag in self.negated)
+        return "Query({})".format(','.join(terms))
@@ -0,0 +1,133 @@
+import math
+from collections import deque
+
+
+DEFAULT_CLIENT = 'default'
+
+# Idle clients (with no parked waiters) remembered before they're pruned.
+MAX_IDLE_CLIENTS = 1024
+
+
+class Waiter:
+    """
+    A parked acquire, for up to ``size`` proxies.
+    """
+    __slots__ = ['client', 'query', 'future', 'enqueued_at', 'size']
+
+    def __init__(self, client, query, future, enqueued_at, size=1):
+        self.client = client
+        self.query = query
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.size = size
+
+
+class FairScheduler:
+    """
+    Weighted fair queueing of waiters across clients.
+
+    This is start-time fair queueing: each client carries a virtual finish
+    tag that advances by ``1 / weight`` for every proxy it is handed, and
+    freed proxies go to the waiting client with the smallest tag. A client
+    that has been idle re-enters at the current virtual time, so it can't
+    bank credit while it isn't competing. Within a client, waiters are
+    served first come, first served.
+    """
+    def __init__(self, weights=None, default_weight=1.0):
+        """
+        :param weights: a mapping of client name to relative weight
+        :param default_weight: the weight of unlisted clients
+        """
+        self.set_weights(weights, default_weight)
+        self._queues = {}  # client -> deque of waiters
+        self._finish = {}  # client -> virtual finish tag
+        self._virtual_time = 0.0
+        self._waiting = 0
+
+    def set_weights(self, weights, default_weight=1.0):
+        """
+        Replace the client weights; tags already earned are kept.
+
+        :raises ValueError: unless every weight is a positive, finite number
+        """
+        weights = dict(weights or {})
+        checked = list(weights.items())
+        checked.append(("unlisted clients", default_weight))
+        for client, weight in checked:
+            if not (isinstance(weight, (int, float))
+                    and math.isfinite(weight) and weight > 0):
+                raise ValueError("The weight of {} must be positive, not "
+                                 "{!r}".format(client, weight))
+        self._weights = weights
+        self._default_weight = default_weight
+
+    def weight(self, client):
+        return self._weights.get(client, self._default_weight)
+
+    def push(self, waiter):
+        queue = self._queues.get(waiter.client)
+        if queue is None:
+            queue = self._queues[waiter.client] = deque()
+            self._finish[waiter.client] = max(
+                self._finish.get(waiter.client, 0.0), self._virtual_time)
+
+        queue.append(waiter)
+        self._waiting += 1
+
+    def remove(self, waiter):
+        queue = self._queues.get(waiter.client)
+        if queue is None:
+            return False
+
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return False
+
+        self._waiting -= 1
+        if not queue:
+            self._retire(waiter.client)
+        return True
+
+    def clients_in_order(self):
+        """
+        :return: the clients with waiters, most deserving first
+        """
+        return sorted(self._queues, key=self._finish.__getitem__)
+
+    def waiters_of(self, client):
+        """
+        :return: a snapshot of the client's waiters, oldest first
+        """
+        return list(self._queues.get(client, ()))
+
+    def charge(self, client, amount=1):
+        """
+        Account for ``amount`` proxies handed to a client.
+        """
+        start = self._finish.get(client, self._virtual_time)
+        self._virtual_time = max(self._virtual_time, start)
+        self._finish[client] = start + amount / self.weight(client)
+
+        if len(self._finish) - len(self._queues) > MAX_IDLE_CLIENTS:
+            self._prune()
+
+    def waiting_for(self, client):
+        return len(self._queues.get(client, ()))
+
+    def _retire(self, client):
+        del self._queues[client]
+        # Forget clients that aren't ahead of the virtual clock.
+        if self._finish.get(client, 0.0) <= self._virtual_time:
+            self._finish.pop(client, None)
+
+    def _prune(self):
+        """
+        Forget every client without parked waiters. Those still ahead of the
+        virtual clock lose their lead, which beats growing without bound.
+        """
+        self._finish = {client: tag for client, tag in self._finish.items()
+                        if client in self._queues}
+
+    def __len__(self):
+        return self._waiting
@@ -0,0 +1,112 @@
+import random
+from mimic.util import summarize
+
+
+class ResponseTimeWeighted:
+    """
+    Pick proxies at random, weighted in favour of the faster ones by their
+    last response time. Outcomes are ignored.
+    """
+    name = 'response_time'
+
+    def choose(self, proxies, response_times):
+        """
+        :param proxies: a non-empty list of candidate proxies
+        :param response_times: a mapping of proxy to last response time
+        :return: the chosen proxy
+        """
+        # Network conditions change. Selection is a function of the average
+        # response time. It's stochastic to avoid synchronization issues but
+        # weighted in favor of faster proxies.
+        #
+        # Do stochastic acceptance for fast proportional selection.
+        # See: http://jbn.github.io/fast_proportional_selection/
+        min_resp_time, max_resp_time, resp_times = 1000000000, -1, []
+        for proxy in proxies:
+            resp_time = response_times[proxy]
+            if resp_time > max_resp_time:
+                max_resp_time = resp_time
+            if resp_time < min_resp_time:
+                min_resp_time = resp_time
+            resp_times.append(resp_time)
+
+        if max_resp_time == 0.0:
+            return random.choice(proxies)
+
+        n = len(proxies)
+        while True:
+            i = int(n * random.random())
+            score = max_resp_time - (resp_times[i] - min_resp_time)
+            if random.random() < score:
+                return proxies[i]
+
+    def record(self, proxy, is_failure):
+        pass
+
+    def forget(self, proxy):
+        pass
+
+    def stats(self):
+        return {'policy': self.name}
+
+
+class ThompsonSampling:
+    """
+    Pick the proxy with the best sampled successful throughput.
+
+    Each proxy's success rate on the domain has a Beta posterior, updated
+    in O(1) per outcome. A choice draws a success rate from every
+    candidate's posterior and divides it by the candidate's last response
+    time, so proxies that are fast but often fail lose out, while proxies
+    with little history still get explored.
+    """
+    name = 'thompson'
+
+    def __init__(self, prior_successes=1.0, prior_failures=1.0,
+                 min_resp_time=0.01):
+        """
+        :param prior_successes: the pseudo-count of successes for a proxy
+            with no history
+        :param prior_failures: the pseudo-count of failures for a proxy
+            with no history
+        :param min_resp_time: the floor on response times, so that unknown
+            (zero) response times don't dominate
+        """
+        self._prior = (prior_successes, prior_failures)
+        self._min_resp_time = min_resp_time
+        self._outcomes = {}  # proxy -> [successes, failures]
+
+    def choose(self, proxies, response_times):
+        best, best_score = None, -1.0
+        for proxy in proxies:
+            successes, failures = self._outcomes.get(proxy, self._prior)
+            rate = random.betavariate(successes, failures)
+            score = rate / max(response_times[proxy], self._min_resp_time)
+            if score > best_score:
+                best, best_score = proxy, score
+        return best
+
+    def record(self, proxy, is_failure):
+        outcome = self._outcomes.get(proxy)
+        if outcome is None:
+            outcome = self._outcomes[proxy] = list(self._prior)
+        outcome[1 if is_failure else 0] += 1
+
+    def forget(self, proxy):
+        self._outcomes.pop(proxy, None)
+
+    def success_rate(self, proxy):
+        """
+        :return: the posterior mean success rate of a proxy
+        """
+        successes, failures = self._outcomes.get(proxy, self._prior)
+        return successes / (successes + failures)
+
+    def stats(self):
+        return {'policy': self.name,
+                'success_rates': summarize(map(self.success_rate,
+                                               self._outcomes))}
+
+
+SELECTION_POLICIES = {policy.name: policy
+                      for policy in (ResponseTimeWeighted, ThompsonSampling)}
@@ -1,10 +1,42 @@
+import asyncio
+import functools
 import json
 import logging
+import math
+import signal
 
 from aiohttp import web
 from asyncio import get_event_loop
-from mimic.util import parse_and_intern_domain
+from mimic.util import (DomainResolver, DOMAIN_GROUPINGS, PROXY_DEFAULTS,
+                        setup_logger)
+from mimic.public_suffix import PublicSuffixTrie
 from mimic import ProxyCollection, Brokerage
+from mimic.broker import AcquireAborted, AdmissionRejected
+from mimic.debug import DebugSurface, mark
+from mimic.export import (CHUNK_ROWS, CONTENT_TYPES, ENCODERS,
+                          MAX_CHUNK_ROWS)
+from mimic.gateway import ProxyGateway
+from mimic.handoff import (bind_listener, encode_state, request_handoff,
+                           send_socket, wait_for_successor)
+from mimic.logs import configure_logging, parse_sample_rates
+from mimic.memory import MAX_SAMPLE_SIZE, SAMPLE_SIZE
+from mimic.policy import PolicyTable
+from mimic.prober import ProxyProber
+from mimic.proxy_state import ProxyState
+from mimic.selection import SELECTION_POLICIES
+from mimic.throttle import AdaptiveThrottle
+
+
+LOGGER = setup_logger('server')
+
+# The most proxies a single hedged acquire may lease.
+MAX_HEDGE = 4
+
+# Seconds a process handing off waits for its in-flight requests.
+DRAIN_TIMEOUT = 10.0
+
+# The bounds, in seconds, of the profiler's sampling interval.
+PROFILER_INTERVALS = (0.001, 1.0)
 
 
 def bad_request(err_msg):
@@ -17,12 +49,104 @@ def csv_param(params, param):
     return value.split(",") if value else []
 
 
+def too_many_requests(err_msg, retry_after):
+    raise web.HTTPTooManyRequests(text=json.dumps(err_msg),
+                                  headers={'Retry-After': str(retry_after)},
+                                  content_type="application/javascript")
+
+
+def service_unavailable(err_msg, retry_after=0):
+    """
+    Answer 503, closing the connection so the client's retry opens a new
+    one (which, during a handoff, the successor accepts).
+    """
+    exc = web.HTTPServiceUnavailable(text=json.dumps(err_msg),
+                                     headers={'Retry-After': str(retry_after)},
+                                     content_type="application/javascript")
+    exc.force_close()
+    raise exc
+
+
 def required_param(params, param):
     if param not in params:
         bad_request({'err': "{} is a required parameter.".format(param)})
     return params[param]
 
 
+def required_requirements(params):
+    """
+    :return: the non-empty ``requirements`` selecting the proxies a bulk
+        operation applies to
+    """
+    requirements = csv_param(params, 'requirements')
+    if not any(term.strip() for term in requirements):
+        bad_request({'err': "requirements is a required parameter."})
+    return requirements
+
+
+def optional_response_time(params):
+    """
+    :return: the client's measured response time, or None if it sent none
+        (the broker then estimates one from the lease's duration)
+    """
+    value = params.get('response_time')
+    if value in (None, ''):
+        return None
+    try:
+        response_time = float(value)
+    except ValueError:
+        response_time = math.nan
+    if not math.isfinite(response_time) or response_time < 0:
+        bad_request("response_time must be a finite, non-negative number")
+    return response_time
+
+
+def proxy_from_params(params):
+    """
+    Normalize a proxy's registration parameters.
+
+    :param params: a mapping with ``proto``, ``host`` and ``port`` and,
+        optionally, ``resp_time`` (``PROXY_DEFAULTS``' by default), ``geo``,
+        ``anon_level``, ``tags`` (a list or comma-separated string) and
+        ``capacity``
+    :return: the proxy dict, for ``ProxyCollection.register_proxy``
+    :raises ValueError: on a missing or malformed parameter
+    """
+    for k in 'proto', 'host', 'port':
+        if params.get(k) is None:
+            raise ValueError("{} is a required parameter.".format(k))
+    proxy = {k: str(params[k]).upper() for k in ['proto', 'host', 'port']}
+    proxy['port'] = _convert(int, 'port', proxy['port'])
+    for k in 'resp_time', 'geo', 'anon_level':
+        if params.get(k) is not None:
+            proxy[k] = str(params[k]).upper()
+    proxy['resp_time'] = _convert(
+        float, 'resp_time', proxy.get('resp_time',
+                                      PROXY_DEFAULTS['resp_time']))
+    if not math.isfinite(proxy['resp_time']) or proxy['resp_time'] < 0:
+        raise ValueError("resp_time must be a finite, non-negative number")
+
+    tags = params.get('tags')
+    if tags:
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        proxy['tags'] = [str(tag).strip().upper() for tag in tags]
+
+    if params.get('capacity') is not None:
+        proxy['capacity'] = _convert(int, 'capacity', params['capacity'])
+        if proxy['capacity'] < 1:
+            raise ValueError("capacity must be at least 1")
+
+    return proxy
+
+
+def _convert(kind, param, value):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise ValueError("{} must be a number, not {!r}".format(param, value))
+
+
 def human_json(obj):
     return json.dumps(obj, indent=4, sort_keys=True)
 
@@ -42,31 +166,222 @@ class RESTProxyBroker:
                  readme_str=DEFAULT_README,
                  debug=True,
                  loop=None,
-                 log_level=logging.ERROR):
-
+                 log_level=logging.ERROR,
+                 prober=None,
+                 policy_file=None,
+                 gateway=None,
+                 debug_surface=None):
+        """
+        :param policy_file: a JSON policy table (see
+            :class:`mimic.policy.PolicyTable`), reloaded on SIGHUP or
+            ``POST /admin/policies/reload``
+        :param gateway: a :class:`mimic.gateway.ProxyGateway` to run
+            alongside the API
+        :param debug_surface: a :class:`mimic.debug.DebugSurface` to serve
+            under ``/debug``; it also times every handler
+        """
         self._proxy_collection = proxy_collection or ProxyCollection()
         self._brokerage = brokerage or Brokerage(self._proxy_collection)
         self._readme_str = readme_str
-
-        for service in ['broker', 'domain_monitor', 'proxy_collection']:
+        self._prober = prober
+        self._policy_file = policy_file
+        self._gateway = gateway
+        self._debug = debug_surface
+        self._draining = False
+        self._listener = None
+        self._server = None
+        self._handler = None
+
+        for service in ['broker', 'domain_monitor', 'proxy_collection',
+                        'prober', 'server', 'gateway', 'ingest', 'debug',
+                        'handoff']:
             logging.getLogger('mimic.' + service).setLevel(log_level)
 
-        self._app = web.Application(loop=loop or get_event_loop(), debug=debug)
+        middlewares = []
+        if self._debug is not None:
+            middlewares.append(self._debug.handlers.middleware)
+
+        self._app = web.Application(loop=loop or get_event_loop(), debug=debug,
+                                    middlewares=middlewares)
 
         routes = [('GET',    "/",                 self.readme),
                   ('GET',    "/proxies",          self.list_proxies),
                   ('POST',   "/proxies/register", self.register_proxy),
+                  ('POST',   "/proxies/register_many",
+                   self.register_proxies),
                   ('POST',   "/proxies/acquire",  self.acquire_proxy),
                   ('POST',   "/proxies/release",  self.release_proxy),
+                  ('POST',   "/proxies/renew",    self.renew_lease),
+                  ('POST',   "/proxies/acquire_multi",
+                   self.acquire_proxy_multi),
+                  ('POST',   "/proxies/release_multi",
+                   self.release_proxy_multi),
+                  ('GET',    "/proxies/state",    self.get_proxy_state),
+                  ('POST',   "/admin/proxies/delist",
+                   self.delist_matching),
+                  ('POST',   "/admin/proxies/retag", self.retag_matching),
+                  ('GET',    "/admin/policies",   self.get_policies),
+                  ('POST',   "/admin/policies/reload", self.reload_policies),
+                  ('GET',    "/memory",           self.get_memory_report),
                   ('GET',    "/domains",          self.list_all_stats),
                   ('GET',    "/domains/{domain}", self.get_domain_stats),
-                  ('DELETE', "/domains/{domain}", self.delete_domain)]
+                  ('GET',    "/domains/{domain}/history",
+                   self.get_domain_history),
+                  ('DELETE', "/domains/{domain}", self.delete_domain),
+                  ('GET',    "/export",           self.export_usage)]
+
+        if self._prober is not None:
+            routes.append(('GET', "/prober", self.get_prober_stats))
+            self._app.on_startup.append(self._start_prober)
+            self._app.on_shutdown.append(self._stop_prober)
+
+        if self._gateway is not None:
+            routes.append(('GET', "/gateway", self.get_gateway_stats))
+            self._app.on_startup.append(self._start_gateway)
+            self._app.on_shutdown.append(self._stop_gateway)
+
+        if self._debug is not None:
+            routes.append(('GET', "/debug", self.get_debug_stats))
+            routes.append(('GET', "/debug/profiler", self.get_profile))
+            routes.append(('POST', "/debug/profiler", self.control_profiler))
+            self._app.on_startup.append(self._start_debug)
+            self._app.on_shutdown.append(self._stop_debug)
+
+        if self._policy_file is not None:
+            self.load_policies()
+            if hasattr(signal, 'SIGHUP'):
+                self._app.on_startup.append(self._watch_sighup)
+                self._app.on_shutdown.append(self._unwatch_sighup)
 
         for route_triplet in routes:
             self._app.router.add_route(*route_triplet)
 
-    def run(self, *args, **kwargs):
-        web.run_app(self._app, *args, **kwargs)
+    async def _start_gateway(self, app):
+        await self._gateway.start()
+
+    async def _stop_gateway(self, app):
+        await self._gateway.close()
+
+    def load_policies(self):
+        """
+        (Re)load the policy file into the brokerage. Live brokers pick up the
+        changes; on error, the current table stays.
+
+        :return: the new table
+        :raises OSError, ValueError: if the file can't be read or is invalid
+        """
+        table = PolicyTable.from_file(self._policy_file)
+        self._brokerage.set_policy_table(table)
+        LOGGER.info("Loaded policies from %s", self._policy_file)
+        return table
+
+    def _reload_on_sighup(self):
+        try:
+            self.load_policies()
+        except (OSError, ValueError) as e:
+            LOGGER.error("Kept the current policies: %s", e)
+
+    async def _watch_sighup(self, app):
+        app.loop.add_signal_handler(signal.SIGHUP, self._reload_on_sighup)
+
+    async def _unwatch_sighup(self, app):
+        app.loop.remove_signal_handler(signal.SIGHUP)
+
+    async def _start_debug(self, app):
+        self._debug.start()
+
+    async def _stop_debug(self, app):
+        self._debug.stop()
+
+    async def _start_prober(self, app):
+        self._prober.start()
+
+    async def _stop_prober(self, app):
+        await self._prober.stop()
+
+    def run(self, host='0.0.0.0', port=8080, handoff_path=None,
+            drain_timeout=DRAIN_TIMEOUT, **kwargs):
+        """
+        Serve until interrupted.
+
+        With a ``handoff_path``, first ask the process waiting for a
+        successor on that unix socket, if any, to hand over its listening
+        socket and state; otherwise bind ``host:port``. Then wait there in
+        turn for a successor, hand over to it, and exit (see
+        :meth:`hand_off` and :mod:`mimic.handoff`).
+
+        :param drain_timeout: seconds to let in-flight requests finish,
+            whether handing off or shutting down
+        """
+        if handoff_path is None:
+            web.run_app(self._app, host=host, port=port, **kwargs)
+            return
+
+        loop = self._app.loop
+        inherited = request_handoff(handoff_path, drain_timeout)
+        if inherited is None:
+            self._listener = bind_listener(host, port)
+        else:
+            self._listener, state = inherited
+            if state is not None:
+                self._brokerage.restore(state)
+
+        loop.run_until_complete(self._app.startup())
+        self._handler = self._app.make_handler()
+        self._server = loop.run_until_complete(
+            loop.create_server(self._handler, sock=self._listener))
+        LOGGER.info("Serving on %s", self._listener.getsockname())
+
+        successor = loop.create_task(
+            self._hand_off_when_asked(handoff_path, drain_timeout))
+        try:
+            loop.run_until_complete(successor)
+        except KeyboardInterrupt:
+            successor.cancel()
+            loop.run_until_complete(asyncio.wait([successor], loop=loop))
+        finally:
+            self._server.close()
+            loop.run_until_complete(self._server.wait_closed())
+            loop.run_until_complete(self._app.shutdown())
+            loop.run_until_complete(
+                self._handler.finish_connections(drain_timeout))
+            loop.run_until_complete(self._app.cleanup())
+        loop.close()
+
+    async def _hand_off_when_asked(self, handoff_path, drain_timeout):
+        channel = await wait_for_successor(handoff_path, self._app.loop)
+        with channel:
+            await self.hand_off(channel, drain_timeout)
+
+    async def hand_off(self, channel, drain_timeout=DRAIN_TIMEOUT):
+        """
+        Hand the server over to the successor process at the other end of
+        the unix socket ``channel``.
+
+        The successor gets the listening socket first, so connections
+        keep queueing on it while this process stops accepting. Parked
+        acquires are answered 503 to retry at once, against the successor;
+        the other in-flight requests get up to ``drain_timeout`` to finish.
+        Then the registry, the domains' learned state and the live leases
+        (see :meth:`mimic.brokerage.Brokerage.snapshot`) follow, and the
+        successor starts accepting.
+
+        The gateway, if any, is closed rather than handed over, so its
+        tunnels don't outlive this process.
+        """
+        send_socket(channel, self._listener)
+        self._server.close()
+        self._draining = True
+        self._brokerage.abort_waiters()
+        LOGGER.info("Handing off; draining for up to %ss", drain_timeout)
+
+        await self._handler.finish_connections(drain_timeout)
+        if self._gateway is not None:
+            await self._gateway.close()
+
+        state = encode_state(self._brokerage.snapshot())
+        await self._app.loop.sock_sendall(channel, state)
+        LOGGER.info("Handed off %s bytes of state", len(state))
 
     async def readme(self, request):
         return web.Response(text=self._readme_str, content_type='text/html')
@@ -77,33 +392,113 @@ class RESTProxyBroker:
 
     async def register_proxy(self, request):
         await request.post()
-
-        proxy = {k: required_param(request.POST, k).upper()
-                 for k in ['proto', 'host', 'port']}
-        proxy['port'] = int(proxy['port'])
-        for k in 'resp_time', 'geo', 'anon_level':
-            if k in request.POST:
-                proxy[k] = request.POST[k].upper()
-        if 'resp_time' in proxy:
-            proxy['resp_time'] = float(proxy['resp_time'])
+        try:
+            proxy = proxy_from_params(request.POST)
+        except ValueError as e:
+            bad_request({'err': str(e)})
+        mark(request, 'parse')
 
         self._proxy_collection.register_proxy(proxy)
+        mark(request, 'broker')
 
         return web.json_response({'msg': "OK"})
 
+    async def register_proxies(self, request):
+        try:
+            proxy_params = await request.json()
+        except ValueError:
+            proxy_params = None
+        if not isinstance(proxy_params, list):
+            bad_request({'err': "Expected a JSON list of proxies."})
+
+        proxies = []
+        for i, params in enumerate(proxy_params):
+            if not isinstance(params, dict):
+                bad_request({'err': "Proxy {} is not an object.".format(i)})
+            try:
+                proxies.append(proxy_from_params(params))
+            except ValueError as e:
+                bad_request({'err': "Proxy {}: {}".format(i, e)})
+        for proxy in proxies:
+            self._proxy_collection.register_proxy(proxy)
+
+        return web.json_response({'msg': "OK", 'registered': len(proxies)})
+
     async def acquire_proxy(self, request):
         await request.post()
 
         url = required_param(request.POST, 'url')
 
-        domain = parse_and_intern_domain(url)
+        domain = self._brokerage.resolve_domain(url)
         if not domain:
             bad_request("Could not extract domain from {}".format(domain))
 
         requirements = csv_param(request.POST, 'requirements')
         max_wait_time = int(request.POST.get('max_wait_time', 60))
+        client = request.POST.get('client')
+        hedge = int(request.POST.get('hedge', 1))
+        if not 1 <= hedge <= MAX_HEDGE:
+            bad_request("hedge must be between 1 and {}".format(MAX_HEDGE))
+        session = request.POST.get('session') or None
+        mark(request, 'parse')
+        self._refuse_while_draining()
+
+        try:
+            res = await self._brokerage.acquire(url, requirements,
+                                                max_wait_time, client=client,
+                                                hedge=hedge, session=session)
+        except AdmissionRejected as e:
+            too_many_requests({'err': str(e), 'retry_after': e.retry_after},
+                              e.retry_after)
+        except AcquireAborted as e:
+            service_unavailable({'err': str(e)})
+        mark(request, 'broker')
+        return web.json_response(res)
+
+    def _refuse_while_draining(self):
+        if self._draining:
+            service_unavailable({'err': "Handing off to a new process."})
+
+    async def acquire_proxy_multi(self, request):
+        await request.post()
+
+        urls = request.POST.getall('url', [])
+        if not urls:
+            bad_request("Expected one or more url params.")
+        domains = [self._brokerage.resolve_domain(url) for url in urls]
+        if not all(domains):
+            bad_request("Could not extract a domain from every url")
+        if len(set(domains)) != len(domains):
+            bad_request("Expected urls on distinct domains")
+
+        requirements = csv_param(request.POST, 'requirements')
+        max_wait_time = int(request.POST.get('max_wait_time', 60))
+        client = request.POST.get('client')
+        mark(request, 'parse')
+        self._refuse_while_draining()
+
+        try:
+            res = await self._brokerage.acquire_multi(urls, requirements,
+                                                      max_wait_time,
+                                                      client=client)
+        except AdmissionRejected as e:
+            too_many_requests({'err': str(e), 'retry_after': e.retry_after},
+                              e.retry_after)
+        except AcquireAborted as e:
+            service_unavailable({'err': str(e)})
+        mark(request, 'broker')
+        return web.json_response(res)
+
+    async def release_proxy_multi(self, request):
+        await request.post()
 
-        res = await self._brokerage.acquire(url, requirements, max_wait_time)
+        lease = required_param(request.POST, 'lease')
+        resp_time = optional_response_time(request.POST)
+        failed = request.POST.get('is_failure', 'false').lower() == 'true'
+        mark(request, 'parse')
+
+        res = self._brokerage.release_multi(lease, resp_time, failed)
+        mark(request, 'broker')
         return web.json_response(res)
 
     async def release_proxy(self, request):
@@ -113,21 +508,204 @@ class RESTProxyBroker:
         proxy = required_param(request.POST, 'proxy')
         if proxy is None:
             return web.Response(text='No such proxy', status=403)
-        resp_time = float(request.POST.get('response_time', 60.0))
+        resp_time = optional_response_time(request.POST)
         failed = request.POST.get('is_failure', 'false').lower() == 'true'
-
-        res = await self._brokerage.release(broker, proxy, resp_time, failed)
+        lease = request.POST.get('lease') or None
+        fence = request.POST.get('fence') or None
+        if lease is None and fence is None:
+            # It can't be told apart from a late release by an earlier
+            # holder, so say so rather than quietly ignoring it.
+            bad_request("lease id required (or the lease's fence)")
+        if fence is not None:
+            try:
+                fence = int(fence)
+            except ValueError:
+                bad_request("fence must be an integer")
+        mark(request, 'parse')
+
+        res = await self._brokerage.release(broker, proxy, resp_time, failed,
+                                            lease=lease, fence=fence)
+        mark(request, 'broker')
         return web.json_response(res)
 
+    async def renew_lease(self, request):
+        await request.post()
+
+        broker = required_param(request.POST, 'broker')
+        lease = required_param(request.POST, 'lease')
+        extension = request.POST.get('extension')
+        if extension is not None:
+            try:
+                extension = float(extension)
+            except ValueError:
+                bad_request("extension must be a number of seconds")
+        mark(request, 'parse')
+
+        try:
+            expires_in = self._brokerage.renew(broker, lease, extension)
+        except ValueError as e:
+            bad_request(str(e))
+        mark(request, 'broker')
+        return web.json_response({'renewed': expires_in is not None,
+                                  'expires_in': expires_in})
+
+    async def delist_matching(self, request):
+        await request.post()
+        requirements = required_requirements(request.POST)
+        mark(request, 'parse')
+
+        proxies = self._brokerage.delist_matching(requirements)
+        mark(request, 'broker')
+        return web.json_response({'delisted': len(proxies),
+                                  'proxies': sorted(proxies)})
+
+    async def retag_matching(self, request):
+        await request.post()
+        requirements = required_requirements(request.POST)
+        changes = {k: request.POST[k].upper()
+                   for k in ['geo', 'anon_level'] if request.POST.get(k)}
+        for k in 'add_tags', 'remove_tags':
+            changes[k] = [tag.strip().upper()
+                          for tag in csv_param(request.POST, k)
+                          if tag.strip()]
+        if not any(changes.values()):
+            bad_request({'err': "Expected geo, anon_level, add_tags or "
+                                "remove_tags."})
+        mark(request, 'parse')
+
+        proxies = self._brokerage.retag_matching(requirements, **changes)
+        mark(request, 'broker')
+        return web.json_response({'retagged': len(proxies),
+                                  'proxies': sorted(proxies)})
+
+    async def get_proxy_state(self, request):
+        return web.json_response(self._brokerage.proxy_state.stats(),
+                                 dumps=human_json)
+
+    async def get_policies(self, request):
+        return web.json_response(self._brokerage.policy_table.to_dict(),
+                                 dumps=human_json)
+
+    async def reload_policies(self, request):
+        if self._policy_file is None:
+            bad_request({'err': "No policy file configured."})
+
+        try:
+            table = self.load_policies()
+        except (OSError, ValueError) as e:
+            bad_request({'err': "Kept the current policies: {}".format(e)})
+        return web.json_response(table.to_dict(), dumps=human_json)
+
     async def list_all_stats(self, request):
         stats = self._brokerage.list_all()
+        mark(request, 'broker')
         return web.json_response(stats, dumps=human_json)
 
     async def get_domain_stats(self, request):
         domain = request.match_info['domain'].lower()
+        mark(request, 'parse')
         stats = self._brokerage.list_all().get(domain, {})
+        mark(request, 'broker')
         return web.json_response(stats, dumps=human_json)
 
+    async def get_domain_history(self, request):
+        domain = request.match_info['domain'].lower()
+        try:
+            window = float(request.GET.get('window') or 0) or None
+            step = float(request.GET.get('step') or 0) or None
+        except ValueError:
+            window = step = -1
+        if not all(value is None or (math.isfinite(value) and value > 0)
+                   for value in (window, step)):
+            bad_request("window and step must be positive seconds")
+        mark(request, 'parse')
+
+        history = self._brokerage.history(domain, window, step)
+        if history is None:
+            raise web.HTTPNotFound(text=json.dumps("No such domain"),
+                                   content_type="application/javascript")
+        mark(request, 'broker')
+        return web.json_response(history)
+
+    async def export_usage(self, request):
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in ENCODERS:
+            bad_request("format must be one of {}".format(
+                ", ".join(sorted(ENCODERS))))
+        try:
+            chunk_rows = int(request.GET.get('chunk_rows', CHUNK_ROWS))
+        except ValueError:
+            chunk_rows = 0
+        if not 1 <= chunk_rows <= MAX_CHUNK_ROWS:
+            bad_request("chunk_rows must be 1 to {}".format(MAX_CHUNK_ROWS))
+
+        response = web.StreamResponse()
+        response.content_type = CONTENT_TYPES[fmt]
+        response.headers['Content-Disposition'] = (
+            'attachment; filename="mimic-usage.{}"'.format(fmt))
+        await response.prepare(request)
+
+        # Rows are encoded a chunk at a time, yielding to the loop between
+        # chunks while the client catches up.
+        rows = self._brokerage.usage_rows()
+        for chunk in ENCODERS[fmt](rows, chunk_rows):
+            response.write(chunk)
+            await response.drain()
+        await response.write_eof()
+        return response
+
+    async def get_memory_report(self, request):
+        try:
+            sample = int(request.GET.get('sample', SAMPLE_SIZE))
+        except ValueError:
+            sample = 0
+        if not 1 <= sample <= MAX_SAMPLE_SIZE:
+            bad_request("sample must be 1 to {}".format(MAX_SAMPLE_SIZE))
+        domains = request.GET.getall('domain', None)
+
+        report = self._brokerage.memory_report(sample, domains)
+        return web.json_response(report, dumps=human_json)
+
+    async def get_debug_stats(self, request):
+        return web.json_response(self._debug.stats(), dumps=human_json)
+
+    async def get_profile(self, request):
+        return web.Response(text=self._debug.profiler.collapsed(),
+                            content_type='text/plain')
+
+    async def control_profiler(self, request):
+        await request.post()
+
+        profiler = self._debug.profiler
+        action = required_param(request.POST, 'action')
+        if action == 'start':
+            if request.POST.get('interval'):
+                try:
+                    interval = float(request.POST['interval'])
+                except ValueError:
+                    interval = math.nan
+                low, high = PROFILER_INTERVALS
+                if not low <= interval <= high:
+                    bad_request("interval must be {} to {} seconds".format(
+                        low, high))
+                profiler.interval = interval
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        elif action == 'reset':
+            profiler.reset()
+        else:
+            bad_request({'err': "action must be start, stop or reset."})
+
+        return web.json_response({'running': profiler.running,
+                                  'samples': profiler.samples})
+
+    async def get_gateway_stats(self, request):
+        return web.json_response(self._gateway.stats(), dumps=human_json)
+
+    async def get_prober_stats(self, request):
+        return web.json_response(self._prober.stats(), dumps=human_json)
+
     async def delete_domain(self, request):
         # TODO
         return web.Response(body=b"not_implemented")
@@ -153,11 +731,221 @@ def parse_args():
 
     parser.add_argument('--debug', dest='debug', action='store_true')
 
+    parser.add_argument('--domain-grouping',
+                        action='store',
+                        dest='domain_grouping',
+                        help='how urls are grouped into broker domains',
+                        choices=DOMAIN_GROUPINGS,
+                        default='netloc')
+
+    parser.add_argument('--public-suffix-list',
+                        action='store',
+                        dest='public_suffix_list',
+                        help='path to a public suffix list file, used with '
+                             '--domain-grouping=registrable',
+                        default=None)
+
+    parser.add_argument('--max-waiters-per-domain',
+                        action='store',
+                        dest='max_waiters_per_domain',
+                        help='answer 429 once this many acquires wait on '
+                             'a domain',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--max-total-waiters',
+                        action='store',
+                        dest='max_total_waiters',
+                        help='answer 429 once this many acquires wait '
+                             'across all domains',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--probe-url',
+                        action='store',
+                        dest='probe_url',
+                        help='enable background probing of proxies against '
+                             'this (preferably local) url',
+                        default=None)
+
+    parser.add_argument('--probe-concurrency',
+                        action='store',
+                        dest='probe_concurrency',
+                        help='the maximum number of probes in flight',
+                        default=10,
+                        type=int)
+
+    parser.add_argument('--probe-period',
+                        action='store',
+                        dest='probe_period',
+                        help='seconds between probes of the same proxy',
+                        default=300.0,
+                        type=float)
+
+    parser.add_argument('--adaptive-throttle',
+                        dest='adaptive_throttle',
+                        help='tune each proxy\'s cooldown per domain from '
+                             'its successes and failures',
+                        action='store_true')
+
+    parser.add_argument('--min-return-delay',
+                        action='store',
+                        dest='min_return_delay',
+                        help='the shortest adaptive cooldown, in seconds',
+                        default=1.0,
+                        type=float)
+
+    parser.add_argument('--max-return-delay',
+                        action='store',
+                        dest='max_return_delay',
+                        help='the longest adaptive cooldown, in seconds',
+                        default=600.0,
+                        type=float)
+
+    parser.add_argument('--selection-policy',
+                        action='store',
+                        dest='selection_policy',
+                        help='how a proxy is picked among those matching '
+                             'an acquire',
+                        choices=sorted(SELECTION_POLICIES),
+                        default='response_time')
+
+    parser.add_argument('--max-leases-per-proxy',
+                        action='store',
+                        dest='max_leases_per_proxy',
+                        help='the most domains a proxy may be leased to at '
+                             'once',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--failure-half-life',
+                        action='store',
+                        dest='failure_half_life',
+                        help='seconds for a proxy\'s cross-domain failure '
+                             'score to halve',
+                        default=600.0,
+                        type=float)
+
+    parser.add_argument('--gateway-port',
+                        action='store',
+                        dest='gateway_port',
+                        help='also serve a forward proxy on this port that '
+                             'brokers an upstream for every request',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--policy-file',
+                        action='store',
+                        dest='policy_file',
+                        help='a JSON table of per-domain broker settings, '
+                             'reloaded on SIGHUP',
+                        default=None)
+
+    parser.add_argument('--debug-endpoints',
+                        dest='debug_endpoints',
+                        help='serve loop lag, task counts, handler timings '
+                             'and a sampling profiler under /debug',
+                        action='store_true')
+
+    parser.add_argument('--log-level',
+                        action='store',
+                        dest='log_level',
+                        help='the lowest level logged',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default='ERROR')
+
+    parser.add_argument('--log-format',
+                        action='store',
+                        dest='log_format',
+                        help='write JSON lines or plain messages',
+                        choices=['json', 'text'],
+                        default='json')
+
+    parser.add_argument('--log-sample',
+                        action='append',
+                        dest='log_sample',
+                        metavar='EVENT=RATE',
+                        help='keep only this fraction of a log event '
+                             '(e.g. acquire=0.01); repeatable',
+                        default=[])
+
+    parser.add_argument('--log-rate-limit',
+                        action='store',
+                        dest='log_rate_limit',
+                        help='the most records per log event per second',
+                        default=None,
+                        type=float)
+
+    parser.add_argument('--handoff-socket',
+                        action='store',
+                        dest='handoff_socket',
+                        help='a unix socket path where a new process takes '
+                             'over the listening socket and live state from '
+                             'the running one, for restarts without downtime',
+                        default=None)
+
+    parser.add_argument('--drain-timeout',
+                        action='store',
+                        dest='drain_timeout',
+                        help='seconds for in-flight requests to finish '
+                             'before handing off',
+                        default=DRAIN_TIMEOUT,
+                        type=float)
+
     return parser.parse_args()
 
 
 if __name__ == '__main__':
-    command_line_args = parse_args()
-
-    server = RESTProxyBroker(debug=command_line_args.debug)
-    server.run(host=command_line_args.host, port=int(command_line_args.port))
+    args = parse_args()
+
+    configure_logging(json_lines=args.log_format == 'json',
+                      sample_rates=parse_sample_rates(args.log_sample),
+                      max_per_second=args.log_rate_limit)
+
+    suffix_trie = None
+    if args.public_suffix_list:
+        suffix_trie = PublicSuffixTrie.from_file(args.public_suffix_list)
+
+    resolver = DomainResolver(args.domain_grouping, suffix_trie)
+    proxy_collection = ProxyCollection()
+    broker_opts = {}
+    if args.max_waiters_per_domain is not None:
+        broker_opts['max_waiters'] = args.max_waiters_per_domain
+    if args.adaptive_throttle:
+        broker_opts['throttle_factory'] = functools.partial(
+            AdaptiveThrottle,
+            min_delay=args.min_return_delay,
+            max_delay=args.max_return_delay)
+    brokerage = Brokerage(proxy_collection, broker_opts=broker_opts,
+                          domain_resolver=resolver,
+                          max_total_waiters=args.max_total_waiters,
+                          selection_policy_factory=SELECTION_POLICIES[
+                              args.selection_policy],
+                          proxy_state=ProxyState(args.max_leases_per_proxy,
+                                                 args.failure_half_life))
+
+    prober = None
+    if args.probe_url:
+        prober = ProxyProber(proxy_collection, brokerage, args.probe_url,
+                             max_concurrency=args.probe_concurrency,
+                             probe_period=args.probe_period)
+
+    gateway = None
+    if args.gateway_port is not None:
+        gateway = ProxyGateway(brokerage, args.host, args.gateway_port)
+
+    debug_surface = None
+    if args.debug_endpoints:
+        debug_surface = DebugSurface(brokerage, get_event_loop())
+
+    server = RESTProxyBroker(proxy_collection=proxy_collection,
+                             brokerage=brokerage,
+                             debug=args.debug,
+                             prober=prober,
+                             policy_file=args.policy_file,
+                             gateway=gateway,
+                             debug_surface=debug_surface,
+                             log_level=getattr(logging, args.log_level))
+    server.run(host=args.host, port=int(args.port),
+               handoff_path=args.handoff_socket,
+               drain_timeout=args.drain_timeout)
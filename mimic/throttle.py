@@ -0,0 +1,113 @@
+from mimic.util import summarize
+
+
+class FixedThrottle:
+    """
+    The same cooldowns for every proxy: ``return_delay`` after a success
+    and ``bad_return_delay`` after a failure.
+    """
+    def __init__(self, return_delay, bad_return_delay):
+        self.return_delay = return_delay
+        self.bad_return_delay = bad_return_delay
+
+    def reconfigure(self, return_delay, bad_return_delay):
+        self.return_delay = return_delay
+        self.bad_return_delay = bad_return_delay
+
+    def cooldown(self, proxy, is_failure):
+        """
+        :return: the seconds to hold a released proxy back
+        """
+        return self.bad_return_delay if is_failure else self.return_delay
+
+    def current(self, proxy):
+        """
+        :return: the proxy's success cooldown, without adjusting it
+        """
+        return self.return_delay
+
+    def mean_cooldown(self):
+        return self.return_delay
+
+    def forget(self, proxy):
+        pass
+
+    def stats(self):
+        return {'mode': 'fixed',
+                'return_delay': self.return_delay,
+                'bad_return_delay': self.bad_return_delay}
+
+
+class AdaptiveThrottle:
+    """
+    Per-proxy cooldowns tuned by additive-decrease, multiplicative-increase.
+
+    Every proxy starts at ``initial_delay``. A successful release shortens
+    its cooldown by ``decrease_step`` seconds and a failed one multiplies it
+    by ``increase_factor``, always within ``[min_delay, max_delay]``. So a
+    lenient domain is worked ever harder, while the first sign of pushback
+    backs off sharply.
+    """
+    def __init__(self, initial_delay=30.0, min_delay=1.0, max_delay=600.0,
+                 decrease_step=1.0, increase_factor=2.0):
+        """
+        :param initial_delay: the cooldown of a proxy with no history,
+            clamped to the bounds
+        :param min_delay: the shortest cooldown
+        :param max_delay: the longest cooldown
+        :param decrease_step: seconds taken off after a success
+        :param increase_factor: the multiplier applied after a failure
+        """
+        assert 0 < min_delay <= max_delay
+        assert decrease_step >= 0 and increase_factor >= 1
+
+        self.initial_delay = min(max(initial_delay, min_delay), max_delay)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.decrease_step = decrease_step
+        self.increase_factor = increase_factor
+        self._cooldowns = {}
+
+    def reconfigure(self, return_delay, bad_return_delay):
+        """
+        Ignored: the cooldowns are learned within their own bounds.
+        """
+
+    def cooldown(self, proxy, is_failure):
+        """
+        Adjust the proxy's cooldown for an outcome.
+
+        :return: the seconds to hold the released proxy back
+        """
+        current = self._cooldowns.get(proxy, self.initial_delay)
+        if is_failure:
+            current = min(self.max_delay, current * self.increase_factor)
+        else:
+            current = max(self.min_delay, current - self.decrease_step)
+
+        self._cooldowns[proxy] = current
+        return current
+
+    def current(self, proxy):
+        return self._cooldowns.get(proxy, self.initial_delay)
+
+    def mean_cooldown(self):
+        if not self._cooldowns:
+            return self.initial_delay
+        return sum(self._cooldowns.values()) / len(self._cooldowns)
+
+    def sustainable_rate(self):
+        """
+        :return: the requests per second the tracked proxies can take, if
+            each is reused as soon as its cooldown ends
+        """
+        return sum(1 / c for c in self._cooldowns.values())
+
+    def forget(self, proxy):
+        self._cooldowns.pop(proxy, None)
+
+    def stats(self):
+        return {'mode': 'adaptive',
+                'cooldowns': summarize(self._cooldowns.values()),
+                'mean_cooldown': self.mean_cooldown(),
+                'sustainable_rate': self.sustainable_rate()}
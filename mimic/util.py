@@ -1,5 +1,8 @@
 import logging
-from urllib.parse import urlparse
+import sys
+from collections import OrderedDict
+from mimic.memory import SAMPLE_SIZE, estimate_size
+from mimic.public_suffix import DEFAULT_SUFFIX_TRIE
 
 
 PROXY_DEFAULTS = {'proto': None,
@@ -7,15 +10,25 @@ PROXY_DEFAULTS = {'proto': None,
                   'port': None,
                   'resp_time': 0,
                   'geo': "UNK",
-                  'anon_level': "HTTP-TRANSPARENT"}
+                  'anon_level': "HTTP-TRANSPARENT",
+                  'tags': (),
+                  'capacity': 1}
 
 
-INTERNED_DOMAINS = {}
+INTERNED_DOMAINS = OrderedDict()
+
+MAX_INTERNED_DOMAINS = 10000
+
+DOMAIN_GROUPINGS = ('netloc', 'host', 'registrable')
 
 
 def setup_logger(service, default_level=logging.INFO):
     """
-    Setup a logger for a given service with a StreamHandler attached.
+    Setup a logger for a given service.
+
+    Services propagate to the shared ``mimic`` logger, which gets a
+    StreamHandler the first time through, unless
+    :func:`mimic.logs.configure_logging` already set up its handlers.
 
     :param service: the service to log (i.e. `mimic.<service>`)
     :param default_level: the logging level
@@ -23,11 +36,139 @@ def setup_logger(service, default_level=logging.INFO):
     """
     logger = logging.getLogger('mimic.' + service)
     logger.setLevel(default_level)
-    logger.addHandler(logging.StreamHandler())
+
+    root = logging.getLogger('mimic')
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler())
 
     return logger
 
 
+def summarize(values):
+    """
+    :param values: numbers, e.g. one per proxy
+    :return: their ``count``, ``min``, ``median`` and ``max`` (None if
+        there are none), for stats that mustn't grow with the pool
+    """
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return {'count': 0, 'min': None, 'median': None, 'max': None}
+
+    mid = n // 2
+    median = values[mid] if n % 2 else (values[mid - 1] + values[mid]) / 2
+    return {'count': n, 'min': values[0], 'median': median,
+            'max': values[-1]}
+
+
+def extract_netloc(url):
+    """
+    Extract the lower-cased network location from a url.
+
+    This is a cheap substitute for ``urlparse(url).netloc`` on the acquire
+    hot path. Userinfo (``user:pass@``) is dropped so credentials never end
+    up in broker keys.
+
+    :param url: the url to some resource
+    :return: the ``host[:port]`` part of the url, or '' if there is none
+    """
+    start = url.find('://')
+    if start >= 0:
+        start += 3
+    elif url.startswith('//'):
+        start = 2
+    else:
+        return ''
+
+    end = len(url)
+    for sep in '/?#':
+        i = url.find(sep, start, end)
+        if i >= 0:
+            end = i
+
+    netloc = url[start:end]
+    at = netloc.rfind('@')
+    if at >= 0:
+        netloc = netloc[at + 1:]
+
+    return netloc.lower()
+
+
+def host_from_netloc(netloc):
+    """
+    :param netloc: a ``host[:port]`` string (IPv6 hosts in brackets)
+    :return: the host, without the port
+    """
+    if netloc.startswith('['):
+        return netloc[:netloc.find(']') + 1]
+
+    host, sep, port = netloc.rpartition(':')
+    return host if sep and port.isdigit() else netloc
+
+
+class DomainResolver:
+    """
+    Maps urls to the (interned) domain that keys their broker.
+
+    The grouping decides how coarse a domain is:
+
+    - ``netloc``: the full ``host[:port]`` (the historical behavior)
+    - ``host``: the host without its port
+    - ``registrable``: the registrable domain (eTLD+1), so
+      ``a.cdn.example.com`` and ``example.com:443`` share a broker
+
+    Resolutions are cached in an LRU bounded by ``max_interned`` so hostile
+    url variety can't grow memory without bound.
+    """
+    def __init__(self, grouping='netloc', suffix_trie=None,
+                 max_interned=MAX_INTERNED_DOMAINS, cache=None):
+        if grouping not in DOMAIN_GROUPINGS:
+            raise ValueError("Unknown domain grouping: {}".format(grouping))
+
+        self._grouping = grouping
+        self._suffix_trie = suffix_trie or DEFAULT_SUFFIX_TRIE
+        self._max_interned = max_interned
+        self._cache = OrderedDict() if cache is None else cache
+
+    @property
+    def grouping(self):
+        return self._grouping
+
+    def resolve(self, url):
+        """
+        :param url: the url to some resource
+        :return: the interned domain for the url, or '' if it has none
+        """
+        netloc = extract_netloc(url)
+
+        cache = self._cache
+        domain = cache.get(netloc)
+        if domain is not None:
+            cache.move_to_end(netloc)
+            return domain
+
+        if self._grouping == 'netloc':
+            domain = netloc
+        else:
+            domain = host_from_netloc(netloc)
+            if self._grouping == 'registrable':
+                domain = self._suffix_trie.registrable_domain(domain)
+            # Distinct netlocs share one group; intern so `is` still works.
+            domain = sys.intern(domain)
+
+        cache[netloc] = domain
+        if len(cache) > self._max_interned:
+            cache.popitem(last=False)
+
+        return domain
+
+    def memory_usage(self, sample=SAMPLE_SIZE):
+        return {'interned_domains': estimate_size(self._cache, sample)}
+
+
+DEFAULT_RESOLVER = DomainResolver(cache=INTERNED_DOMAINS)
+
+
 def parse_and_intern_domain(url):
     """
     Parse the url; extract the name; and, return the interned (cached) name.
@@ -37,16 +178,7 @@ def parse_and_intern_domain(url):
     :param url: the url to some resource
     :return: the interned domain
     """
-    domain = urlparse(url).netloc.lower()
-
-    # This form of interning compacts memory.
-    # Also it allows for `is` comparison.
-    interned_domain = INTERNED_DOMAINS.get(domain)
-    if interned_domain is None:
-        INTERNED_DOMAINS[domain] = domain
-        return domain
-    else:
-        return interned_domain
+    return DEFAULT_RESOLVER.resolve(url)
 
 
 def url_from_proxy(proxy_dict):
@@ -57,16 +189,19 @@ class ProxyProps:
     """
     A thin class to declare a proxy's properties.
     """
-    __slots__ = ['proto', 'host', 'port', 'resp_time', 'geo', 'anon_level']
+    __slots__ = ['proto', 'host', 'port', 'resp_time', 'geo', 'anon_level',
+                 'tags', 'capacity']
 
     def __init__(self, proto, host, port, resp_time,
-                 geo=None, anon_level=None):
+                 geo=None, anon_level=None, tags=(), capacity=1):
         self.proto = proto
         self.host = host
         self.port = port
         self.resp_time = resp_time
         self.geo = geo
         self.anon_level = anon_level
+        self.tags = frozenset(tags)
+        self.capacity = capacity  # Concurrent leases per domain.
 
     def __str__(self):
         return "{}://{}:{}".format(self.proto, self.host, self.port).upper()
@@ -80,7 +215,9 @@ class ProxyProps:
                 'port': self.port,
                 'resp_time': self.resp_time,
                 'geo': self.geo,
-                'anon_level': self.anon_level}
+                'anon_level': self.anon_level,
+                'tags': sorted(self.tags),
+                'capacity': self.capacity}
 
     def _key(self):
         return self.proto, self.host, self.port
@@ -1,8 +1,11 @@
 import asyncio
+import functools
+import json
 import asynctest
 from mimic.broker import *
 from mimic.util import ProxyProps
 from mimic.domain_monitor import DomainMonitor
+from mimic.throttle import AdaptiveThrottle
 
 
 REQUEST_URL_A = 'http://google.com/search'
@@ -17,6 +20,7 @@ class TestBrokerage(asynctest.ClockedTestCase):
         self.domain_monitor.register(proxy_a)
         self.domain_monitor.register(proxy_b)
 
+        self.proxy_props = [proxy_a, proxy_b]
         self.proxy_strs = {str(proxy_a), str(proxy_b)}
 
     async def test_acquire_release_easy(self):
@@ -235,7 +239,399 @@ class TestBrokerage(asynctest.ClockedTestCase):
         # Acquire should return None, as a sentinel.
         self.assertEqual([None], acquired)
 
+    async def test_fair_share_across_clients(self):
+        broker = Broker(self.domain_monitor, return_delay=1)
+
+        # 'big' holds both proxies and parks ten more acquires.
+        held = [await broker.acquire(client='big') for _ in range(2)]
+        served = []
+
+        async def acquire(client):
+            proxy = await broker.acquire(client=client)
+            served.append(client)
+            broker.release(proxy, 0.1)
+
+        for client in ['big'] * 10 + ['small'] * 2:
+            self.loop.create_task(acquire(client))
+        await self.advance(0)
+        self.assertEqual(broker.stats()['waiting'], 12)
+
+        for proxy in held:
+            broker.release(proxy, 0.1)
+        await self.advance(2)
+
+        self.assertEqual(sorted(served[:4]), ['big', 'big', 'small', 'small'])
+        self.assertEqual(broker.stats()['clients']['small']['acquired'], 2)
+
+    async def test_client_caps(self):
+        broker = Broker(self.domain_monitor, client_caps={'capped': 1})
+
+        proxy = await broker.acquire(client='capped')
+        self.assertIsNotNone(proxy)
+        parked = self.loop.create_task(broker.acquire(client='capped',
+                                                      max_wait_time=1))
+        await self.advance(0)
+        self.assertIsNotNone(await broker.acquire(client='other'))
+        await self.advance(2)
+        self.assertIsNone(await parked)
+
+        broker.release(proxy, 0.1)
+        stats = broker.stats()['clients']['capped']
+        self.assertEqual((stats['acquired'], stats['timed_out']), (1, 1))
+        self.assertEqual(stats['held'], 0)
+
+    async def test_admission_control(self):
+        broker = Broker(self.domain_monitor, max_waiters=1)
+        held = [await broker.acquire() for _ in range(2)]
+
+        parked = self.loop.create_task(broker.acquire())
+        await self.advance(0)
+
+        # Both proxies auto-return in a minute; the parked waiter gets the
+        # first, so a newcomer should come back for the second.
+        with self.assertRaises(AdmissionRejected) as cm:
+            await broker.acquire()
+        self.assertEqual(cm.exception.retry_after, ONE_MINUTE)
+        self.assertEqual(broker.stats()['rejected'], 1)
+
+        broker.release(held[0], 0.1)
+        await self.advance(THIRTY_SECONDS + 1)
+        self.assertIsNotNone(await parked)
+
+    async def test_shared_waiter_budget(self):
+        budget = WaiterBudget(1)
+        broker = Broker(self.domain_monitor, waiter_budget=budget)
+        other = Broker(DomainMonitor('yahoo.com'), waiter_budget=budget)
+
+        parked = self.loop.create_task(other.acquire(max_wait_time=5))
+        await self.advance(0)
+        self.assertEqual(budget.in_use, 1)
+
+        for _ in range(2):
+            await broker.acquire()
+        with self.assertRaises(AdmissionRejected):
+            await broker.acquire()
+
+        await self.advance(6)
+        self.assertIsNone(await parked)
+        self.assertEqual(budget.in_use, 0)
+
+    async def test_lease_renew(self):
+        broker = Broker(self.domain_monitor)
+        lease = await broker.acquire_lease()
+        self.assertEqual(lease.fence, 1)
+        self.assertIs(broker.lease_for(lease.proxy), lease)
+
+        await self.advance(ONE_MINUTE - 1)
+        self.assertIsNotNone(broker.renew(lease.id, 10))
+
+        # The original deadline passes without the proxy coming back.
+        await self.advance(2)
+        self.assertEqual(broker.stats()['leased'], 1)
+
+        await self.advance(10)
+        self.assertEqual(broker.stats()['leased'], 0)
+        self.assertIsNone(broker.renew(lease.id))
+
+        for extension in [0, -1, float('nan'), MAX_LEASE_EXTENSION + 1]:
+            with self.assertRaises(ValueError):
+                broker.renew(lease.id, extension)
+
+    async def test_stale_release_ignored(self):
+        broker = Broker(self.domain_monitor, auto_return_delay=10)
+        lease = await broker.acquire_lease()
+        await self.advance(5)
+        await broker.acquire()
+
+        # The lease auto-returns and someone else takes the proxy.
+        await self.advance(6)
+        relet = await broker.acquire_lease()
+        self.assertEqual(relet.proxy, lease.proxy)
+        self.assertGreater(relet.fence, lease.fence)
+
+        self.assertFalse(broker.release(lease.proxy, 0.1, lease=lease.id))
+        self.assertFalse(broker.release(lease.proxy, 0.1, fence=lease.fence))
+        self.assertIs(broker.lease_for(relet.proxy), relet)
+
+        # Without the lease id or fence, the earlier holder's late release
+        # cannot be told apart from the new holder's, so it is ignored.
+        self.assertFalse(broker.release(lease.proxy, 0.1))
+        self.assertIs(broker.lease_for(relet.proxy), relet)
+        self.assertTrue(broker.release(relet.proxy, 0.1, fence=relet.fence))
+        self.assertIsNone(broker.lease_for(relet.proxy))
+
+    async def test_adaptive_throttle(self):
+        factory = functools.partial(AdaptiveThrottle, initial_delay=10,
+                                    decrease_step=5)
+        broker = Broker(self.domain_monitor, throttle_factory=factory)
+
+        proxy = await broker.acquire()
+        broker.release(proxy, 0.1)
+        self.assertEqual(broker.stats()['throttle']['cooldowns'],
+                         {'count': 1, 'min': 5, 'median': 5, 'max': 5})
+
+        # The shorter cooldown brings the proxy back well within the fixed
+        # ``return_delay``.
+        await self.advance(6)
+        self.assertEqual(broker.stats()['available'], 2)
+
+        for _ in range(2):
+            await broker.acquire()
+        broker.release(proxy, 0.1, is_failure=True)
+        self.assertEqual(broker._throttle.current(proxy), 10)
+
+        broker.delist(proxy)
+        self.assertEqual(broker.stats()['throttle']['cooldowns']['count'], 0)
+
+    async def test_hedged_acquire(self):
+        factory = functools.partial(AdaptiveThrottle, initial_delay=10)
+        broker = Broker(self.domain_monitor, throttle_factory=factory)
+
+        lease = await broker.acquire_lease(hedge=3)
+        self.assertEqual(set(lease.proxies), self.proxy_strs)
+        self.assertEqual(broker.stats()['leased'], 1)
+        self.assertEqual(broker.client_stats()['default']['held'], 2)
+
+        winner, loser = lease.proxies
+        self.assertTrue(broker.release(winner, 0.05, lease=lease.id))
+        self.assertFalse(broker.release(loser, 0.05, lease=lease.id))
+
+        # Only the winner's outcome counts; the loser keeps its cooldown.
+        self.assertEqual(broker._throttle.current(winner), 9)
+        self.assertEqual(broker.stats()['throttle']['cooldowns']['count'], 1)
+        self.assertEqual(self.domain_monitor._response_times[loser], 0.1)
+
+        await self.advance(11)
+        self.assertEqual(broker.stats()['available'], 2)
+        self.assertEqual(self.domain_monitor._response_times[winner], 0.05)
+
+    async def test_hedged_acquire_waits_and_caps(self):
+        broker = Broker(self.domain_monitor, client_caps={'capped': 1})
+
+        lease = await broker.acquire_lease(hedge=2, client='capped')
+        self.assertEqual(len(lease.proxies), 1)
+
+        # A hedged waiter is served with whatever frees up.
+        held = await broker.acquire()
+        parked = self.loop.create_task(broker.acquire_lease(hedge=2))
+        await self.advance(0)
+        self.assertEqual(broker.stats()['waiting'], 1)
+
+        broker.release(held, 0.1)
+        await self.advance(THIRTY_SECONDS + 1)
+        self.assertEqual((await parked).proxies, (held,))
+
+    async def test_hedged_delist(self):
+        broker = Broker(self.domain_monitor)
+        lease = await broker.acquire_lease(hedge=2)
+        gone, kept = lease.proxies
+
+        broker.delist(gone)
+        self.assertEqual(lease.proxies, (kept,))
+        self.assertEqual(broker.client_stats()['default']['held'], 1)
+
+        await self.advance(ONE_MINUTE + 1)
+        self.assertEqual(broker.stats()['available'], 1)
+        self.assertEqual(broker.stats()['leased'], 0)
+
+    async def test_delist_many(self):
+        broker = Broker(self.domain_monitor)
+        proxy_c = ProxyProps('http', 'proxy-c', 8888, 0.1)
+        broker.register(proxy_c)
+        for _ in range(3):
+            await broker.acquire()
+        self.assertEqual(len(broker._tasks), 3)
+
+        gone = self.proxy_strs
+        broker.delist_many(gone)
+        self.assertEqual(len(broker._tasks), 1)
+        self.assertEqual(broker.stats()['leased'], 1)
+
+        await self.advance(ONE_MINUTE + 1)
+        self.assertEqual(broker.stats()['available'], 1)
+        self.assertEqual(await broker.acquire(), str(proxy_c))
+
+    async def test_session_affinity(self):
+        broker = Broker(self.domain_monitor, sticky_wait_time=5)
+        ring = list(self.domain_monitor.session_proxies('s1'))
+
+        proxy = await broker.acquire(session='s1')
+        self.assertEqual(proxy, ring[0])
+
+        # Released proxies cool down for 30s, too long to wait for, so the
+        # session falls back to the next proxy on the ring.
+        broker.release(proxy, 0.1)
+        self.assertEqual(await broker.acquire(session='s1'), ring[1])
+
+        # Close to the end of the cooldown, it waits instead.
+        await self.advance(THIRTY_SECONDS - 2)
+        waiting = self.loop.create_task(broker.acquire(session='s1'))
+        await self.advance(3)
+        self.assertEqual(await waiting, ring[0])
+
+    async def test_session_remapped_on_delist(self):
+        broker = Broker(self.domain_monitor)
+        ring = list(self.domain_monitor.session_proxies('s1'))
+
+        broker.delist(ring[0])
+        self.assertEqual(await broker.acquire(session='s1'), ring[1])
+
+    async def test_concurrent_slots(self):
+        monitor = DomainMonitor('google.com')
+        proxy = ProxyProps('http', 'proxy-a', 8888, 0.1, capacity=2)
+        monitor.register(proxy)
+        broker = Broker(monitor)
+
+        first = await broker.acquire_lease()
+        second = await broker.acquire_lease()
+        self.assertEqual(first.proxy, second.proxy)
+        self.assertIsNone(await broker.acquire(max_wait_time=0))
+
+        # Each slot cools down on its own.
+        self.assertTrue(broker.release(str(proxy), 0.1, lease=second.id))
+        self.assertIs(broker.lease_for(str(proxy)), first)
+        await self.advance(THIRTY_SECONDS + 1)
+        self.assertEqual(broker.stats()['free_slots'], 1)
+
+        # The other slot is still leased until its auto-return.
+        await self.advance(ONE_MINUTE - THIRTY_SECONDS)
+        self.assertIsNone(broker.lease_for(str(proxy)))
+        self.assertEqual(broker.stats()['free_slots'], 2)
+
+    async def test_hedge_takes_distinct_proxies(self):
+        monitor = DomainMonitor('google.com')
+        monitor.register(ProxyProps('http', 'proxy-a', 8888, 0.1,
+                                    capacity=3))
+        broker = Broker(monitor)
 
+        lease = await broker.acquire_lease(hedge=2)
+        self.assertEqual(len(lease.proxies), 1)
 
+    async def test_configure_capacity(self):
+        broker = Broker(self.domain_monitor)
+        broker.configure(proxy_capacity=2)
+        self.assertEqual(broker.stats()['free_slots'], 4)
 
+        broker.configure()
+        self.assertEqual(broker.stats()['free_slots'], 2)
 
+    async def test_release_estimates_response_time(self):
+        broker = Broker(self.domain_monitor)
+        proxy = await broker.acquire()
+        await self.advance(4)
+
+        broker.release(proxy)
+        await self.advance(THIRTY_SECONDS + 1)
+        latency = broker.stats()['latency']
+        self.assertEqual(latency['estimated']['samples'], 1)
+        self.assertAlmostEqual(latency['estimated']['mean'], 4, places=3)
+        self.assertEqual(latency['measured']['samples'], 0)
+
+    async def test_configure(self):
+        broker = Broker(self.domain_monitor, client_caps={'capped': 1})
+        await broker.acquire(client='capped')
+        parked = self.loop.create_task(broker.acquire(client='capped'))
+        await self.advance(0)
+
+        # Lifting the cap lets the waiter through at once.
+        broker.configure(return_delay=5)
+        self.assertIsNotNone(await parked)
+        self.assertEqual(broker.stats()['throttle']['return_delay'], 5)
+
+        with self.assertRaises(ValueError):
+            broker.configure(bogus=1)
+
+        # A zero weight is refused, leaving the settings as they were.
+        with self.assertRaises(ValueError):
+            broker.configure(return_delay=7, client_weights={'capped': 0})
+        self.assertEqual(broker.stats()['throttle']['return_delay'], 5)
+
+    async def test_idle_client_stats_pruned(self):
+        broker = Broker(self.domain_monitor)
+        await broker.acquire(client='holder')
+        for i in range(2 * MAX_IDLE_CLIENTS):
+            broker._record_wait('client-{}'.format(i), 0.0, True)
+
+        stats = broker.client_stats()
+        self.assertLessEqual(len(stats), MAX_IDLE_CLIENTS + 2)
+        self.assertEqual(stats['holder']['held'], 1)
+
+    async def test_abort_waiters(self):
+        broker = Broker(self.domain_monitor)
+        for _ in range(2):
+            await broker.acquire()
+        parked = self.loop.create_task(broker.acquire())
+        await self.advance(0)
+
+        self.assertEqual(broker.abort_waiters(), 1)
+        with self.assertRaises(AcquireAborted):
+            await parked
+        self.assertEqual(broker.stats()['waiting'], 0)
+
+    async def test_snapshot_restore(self):
+        broker = Broker(self.domain_monitor)
+        lease = await broker.acquire_lease(client='c')
+        cooled = await broker.acquire()
+        broker.release(cooled, 0.5)
+        await self.advance(10)
+
+        snapshot = broker.snapshot()
+        self.assertEqual(snapshot['leases'][0]['lease'], lease.id)
+        self.assertEqual(snapshot['leases'][0]['expires_in'], ONE_MINUTE - 10)
+        self.assertEqual(snapshot['cooling'], [
+            {'proxy': cooled, 'returns_in': THIRTY_SECONDS - 10,
+             'response_time': 0.5, 'source': 'measured'}])
+
+        monitor = DomainMonitor('google.com')
+        for props in self.proxy_props:
+            monitor.register(props)
+        successor = Broker(monitor)
+        successor.restore(snapshot)
+        self.assertEqual(successor.stats()['available'], 0)
+        self.assertEqual(successor.get_lease(lease.id).client, 'c')
+
+        self.assertTrue(successor.release(lease.proxy, 0.2, lease=lease.id))
+        await self.advance(THIRTY_SECONDS - 10)
+        self.assertEqual(successor.stats()['available'], 1)
+        self.assertEqual(monitor.snapshot()['response_times'][cooled], 0.5)
+
+        # New leases are fenced past the predecessor's.
+        self.assertEqual((await successor.acquire_lease()).fence,
+                         snapshot['fence'] + 1)
+
+    async def test_restore_keeps_failed_out_proxies(self):
+        broker = Broker(self.domain_monitor)
+        failed = await broker.acquire()
+        broker._consecutive_failures[failed] = 2
+        broker.release(failed, 0.1, True)
+
+        snapshot = json.loads(json.dumps(broker.snapshot()))
+        self.assertEqual(snapshot['monitor']['retired'], [failed])
+
+        monitor = DomainMonitor('google.com')
+        for props in self.proxy_props:
+            monitor.register(props)
+        successor = Broker(monitor)
+        successor.restore(snapshot)
+        self.assertEqual(successor.stats()['available'], 1)
+        self.assertNotEqual(await successor.acquire(), failed)
+        self.assertIsNone(await successor.acquire(max_wait_time=0))
+
+    async def test_history(self):
+        broker = Broker(self.domain_monitor,
+                        history_tiers=((1, 120), (60, 60)))
+        proxy = await broker.acquire()
+        await broker.acquire()
+        parked = self.loop.create_task(broker.acquire(max_wait_time=2))
+        await self.advance(2)
+        self.assertIsNone(await parked)
+        broker.release(proxy, 0.1, True)
+        await self.advance(ONE_MINUTE)
+
+        history = broker.history(window=2 * ONE_MINUTE, step=ONE_MINUTE)
+        self.assertEqual(history['acquired'], [2, 0])
+        self.assertEqual(history['timed_out'], [1, 0])
+        self.assertEqual(history['failed'], [1, 0])
+        self.assertEqual(history['expired'], [0, 1])
+        self.assertEqual(history['utilisation'], [0.875, None])
+        self.assertEqual(broker.memory_usage()['history'], 4 * 8 * 180)
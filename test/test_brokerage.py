@@ -2,6 +2,9 @@ import asyncio
 import asynctest
 from mimic.brokerage import *
 from mimic.proxy_collection import *
+from mimic.policy import PolicyTable
+from mimic.proxy_state import ProxyState
+from mimic.util import DomainResolver
 
 
 REQUEST_URL_A = 'http://www.google.com/search'
@@ -30,3 +33,243 @@ class TestBrokerage(asynctest.ClockedTestCase):
         res = await self.brokerage.acquire(REQUEST_URL_A, [], 10.0)
         self.assertEqual(res['broker'], "www.google.com")
         del res['proxy']
+
+    async def test_acquire_grouped_by_registrable_domain(self):
+        brokerage = Brokerage(self.proxy_collection,
+                              domain_resolver=DomainResolver('registrable'))
+
+        for url in ["http://a.cdn.google.com/x", "https://google.com:443/"]:
+            res = await brokerage.acquire(url, [], 10.0)
+            self.assertEqual(res['broker'], "google.com")
+
+        self.assertEqual(list(brokerage.list_all()), ["google.com"])
+
+    async def test_memory_report(self):
+        state = ProxyState()
+        brokerage = Brokerage(self.proxy_collection, proxy_state=state)
+        res = await brokerage.acquire(REQUEST_URL_A, [], 0)
+        await brokerage.acquire("http://a.com/", [], 0)
+
+        report = brokerage.memory_report(domains=["www.google.com"])
+        self.assertEqual(list(report['domains']), ["www.google.com"])
+        domain = report['domains']["www.google.com"]
+        self.assertGreater(domain['broker']['tasks'], 0)
+        self.assertGreater(domain['monitor']['props'], 0)
+        self.assertEqual(set(domain['leaks'].values()), {0})
+        self.assertGreater(report['global']['bytes']['proxies'], 0)
+        self.assertGreater(report['total'], domain['total'])
+
+        # Delisting a proxy drops its failure score.
+        await brokerage.release(res['broker'], res['proxy'], 0.1, True,
+                                lease=res['lease'])
+        self.proxy_collection.delist_proxy(res['proxy'])
+        brokerage.delist_on_all(res['proxy'])
+        leaks = brokerage.memory_report()['global']['leaks']
+        self.assertEqual(leaks['unregistered_failure_scores'], 0)
+
+    async def test_max_leases_per_proxy(self):
+        state = ProxyState(max_leases=1)
+        brokerage = Brokerage(self.proxy_collection, proxy_state=state)
+
+        held = []
+        for url in ["http://a.com/", "http://b.com/"]:
+            res = await brokerage.acquire(url, [], 0)
+            held.append(res)
+
+        # Both proxies are leased elsewhere, so a third domain gets none.
+        res = await brokerage.acquire("http://c.com/", [], 0)
+        self.assertIsNone(res['proxy'])
+
+        await brokerage.release(held[0]['broker'], held[0]['proxy'], 0.1,
+                                False, lease=held[0]['lease'])
+        self.assertEqual(state.leases(held[0]['proxy']), 0)
+        res = await brokerage.acquire("http://c.com/", [], 0)
+        self.assertEqual(res['proxy'], held[0]['proxy'])
+
+    async def test_acquire_multi(self):
+        urls = ["http://example.com/", "http://cdn.example.net/x"]
+        for bad in [[], urls + ["http://example.com/api"]]:
+            with self.assertRaises(ValueError):
+                await self.brokerage.acquire_multi(bad, [], 0)
+
+        # Only proxy_b is free on the CDN.
+        res = await self.brokerage.acquire("http://cdn.example.net/", ['us'],
+                                           0)
+        self.assertIsNotNone(res['proxy'])
+
+        res = await self.brokerage.acquire_multi(urls, [], 0)
+        self.assertEqual(res['brokers'], ["example.com", "cdn.example.net"])
+        self.assertEqual(res['proxy'], 'HTTP://LOCALHOST:8889')
+        self.assertEqual(set(res['leases']), set(res['brokers']))
+
+        # Nothing is free on the CDN now, so nothing is leased anywhere.
+        empty = await self.brokerage.acquire_multi(urls, [], 0)
+        self.assertIsNone(empty['proxy'])
+        stats = self.brokerage.list_all()
+        self.assertEqual(stats['example.com']['leased'], 1)
+
+        self.assertTrue(self.brokerage.release_multi(res['lease'], 0.1,
+                                                     False))
+        self.assertFalse(self.brokerage.release_multi(res['lease'], 0.1,
+                                                      False))
+        stats = self.brokerage.list_all()
+        self.assertEqual(stats['example.com']['leased'], 0)
+        self.assertEqual(stats['cdn.example.net']['leased'], 1)
+
+    async def test_acquire_multi_never_partial(self):
+        urls = ["http://example.com/", "http://example.net/"]
+        # As from a broker shutting down.
+        self.brokerage._broker_for("example.net").lease_available = (
+            lambda *args: None)
+
+        res = await self.brokerage.acquire_multi(urls, [], 0)
+        self.assertIsNone(res['proxy'])
+        stats = self.brokerage.list_all()['example.com']
+        self.assertEqual((stats['available'], stats['leased']), (2, 0))
+        self.assertEqual(self.brokerage._multi_leases, {})
+
+    async def test_acquire_multi_waits_for_release(self):
+        urls = ["http://example.com/", "http://example.net/"]
+        held = [await self.brokerage.acquire(urls[0], [], 0)
+                for _ in range(2)]
+
+        waiting = self.loop.create_task(
+            self.brokerage.acquire_multi(urls, [], 60))
+        await self.advance(1)
+        self.assertFalse(waiting.done())
+
+        await self.brokerage.release(held[0]['broker'], held[0]['proxy'],
+                                     0.1, False, lease=held[0]['lease'])
+        await self.advance(31)
+        res = await waiting
+        self.assertEqual(res['proxy'], held[0]['proxy'])
+
+    async def test_acquire_multi_admission(self):
+        brokerage = Brokerage(self.proxy_collection,
+                              broker_opts={'max_waiters': 1})
+        urls = ["http://example.com/", "http://example.net/"]
+        for _ in range(2):
+            await brokerage.acquire(urls[0], [], 0)
+
+        waiting = self.loop.create_task(brokerage.acquire_multi(urls, [], 5))
+        await self.advance(1)
+
+        # The parked multi acquire fills example.com's one waiter place.
+        with self.assertRaises(AdmissionRejected):
+            await brokerage.acquire(urls[0], [], 5)
+        with self.assertRaises(AdmissionRejected):
+            await brokerage.acquire_multi(urls, [], 5)
+
+        await self.advance(5)
+        self.assertIsNone((await waiting)['proxy'])
+        parked = self.loop.create_task(brokerage.acquire(urls[0], [], 1))
+        await self.advance(2)
+        self.assertIsNone((await parked)['proxy'])
+
+    async def test_multi_lease_forgotten_when_it_ends(self):
+        urls = ["http://example.com/", "http://example.net/"]
+        await self.brokerage.acquire_multi(urls, [], 0)
+        self.assertEqual(len(self.brokerage._multi_leases), 1)
+
+        await self.advance(61)
+        self.assertEqual(self.brokerage._multi_leases, {})
+        self.assertEqual(self.brokerage._multi_groups, {})
+
+    async def test_policy_table_reload(self):
+        table = PolicyTable(domains={'*.strict.com': {'return_delay': 300,
+                                                      'max_waiters': 0}})
+        brokerage = Brokerage(self.proxy_collection, policy_table=table)
+
+        res = await brokerage.acquire("http://www.strict.com/", [], 0)
+        await brokerage.release(res['broker'], res['proxy'], 0.1, False,
+                                fence=res['fence'])
+        stats = brokerage.list_all()['www.strict.com']
+        self.assertEqual(stats['throttle']['return_delay'], 300)
+
+        # The live broker picks up the new table and keeps its state.
+        leased = await brokerage.acquire("http://www.strict.com/", [], 0)
+        brokerage.set_policy_table(PolicyTable())
+        stats = brokerage.list_all()['www.strict.com']
+        self.assertEqual(stats['throttle']['return_delay'], 30)
+        self.assertEqual(stats['leased'], 1)
+        self.assertTrue(await brokerage.release(leased['broker'],
+                                                leased['proxy'], 0.1, False,
+                                                lease=leased['lease']))
+
+    async def test_snapshot_restore(self):
+        urls = ["http://example.com/", "http://example.net/"]
+        single = await self.brokerage.acquire(REQUEST_URL_A, [], 0)
+        multi = await self.brokerage.acquire_multi(urls, [], 0)
+        snapshot = self.brokerage.snapshot()
+
+        successor = Brokerage(ProxyCollection())
+        successor.restore(snapshot)
+        stats = successor.list_all()
+        self.assertEqual(set(stats),
+                         {"www.google.com"} | set(multi['brokers']))
+        self.assertEqual(stats["www.google.com"]['leased'], 1)
+
+        self.assertTrue(successor.release_multi(multi['lease'], 0.1, False))
+        self.assertTrue(await successor.release(
+            single['broker'], single['proxy'], 0.1, False,
+            lease=single['lease']))
+
+    async def test_abort_waiters(self):
+        urls = ["http://example.com/", "http://example.net/"]
+        for _ in range(2):
+            await self.brokerage.acquire(urls[0], [], 0)
+        waiting = [self.loop.create_task(self.brokerage.acquire_multi(
+                       urls, [], 60)),
+                   self.loop.create_task(self.brokerage.acquire(
+                       urls[0], [], 60))]
+        await self.advance(1)
+
+        self.brokerage.abort_waiters()
+        for task in waiting:
+            with self.assertRaises(AcquireAborted):
+                await task
+
+    async def test_delist_matching(self):
+        leased = await self.brokerage.acquire(REQUEST_URL_A, ['us'], 0)
+
+        # Each monitor is delisted from once, by its broker.
+        monitor = self.proxy_collection._monitors['www.google.com']
+        delists = []
+        delist_many = monitor.delist_many
+        monitor.delist_many = lambda proxies: (delists.append(proxies),
+                                               delist_many(proxies))
+
+        delisted = self.brokerage.delist_matching(['port:8888'])
+        self.assertEqual(delisted, {leased['proxy']})
+        self.assertEqual(delists, [delisted])
+
+        stats = self.brokerage.list_all()['www.google.com']
+        self.assertEqual((stats['available'], stats['leased']), (1, 0))
+        self.assertEqual(self.proxy_collection.select(), {
+            str(ProxyProps('http', 'localhost', 8889, 0.2))})
+        self.assertEqual(self.brokerage.delist_matching(['tag:NONE']),
+                         set())
+
+    async def test_retag_matching(self):
+        await self.brokerage.acquire(REQUEST_URL_A, ['us'], 0)
+        retagged = self.brokerage.retag_matching(
+            ['host:127.0.0.0/8|host:localhost', 'resp_time>0.15'], geo='CA',
+            add_tags=['FAST'])
+        self.assertEqual(len(retagged), 1)
+
+        self.assertEqual(self.proxy_collection.select('tag:FAST', 'CA'),
+                         retagged)
+        leased = await self.brokerage.acquire(REQUEST_URL_A, ['CA'], 0)
+        self.assertEqual({leased['proxy']}, retagged)
+
+    async def test_usage_rows(self):
+        await self.brokerage.acquire(REQUEST_URL_A, ['us'], 0)
+        await self.brokerage.acquire("http://example.com/", [], 0)
+
+        rows = list(self.brokerage.usage_rows())
+        self.assertEqual(len(rows), 4)
+        acquisitions = {(row[0], row[1]): row[4] for row in rows}
+        self.assertEqual(acquisitions[("www.google.com",
+                                       "HTTP://LOCALHOST:8888")], 1)
+        self.assertEqual(sum(n for (domain, _), n in acquisitions.items()
+                             if domain == "example.com"), 1)
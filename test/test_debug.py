@@ -0,0 +1,103 @@
+import asynctest
+import gc
+import threading
+import time
+import unittest
+from mimic.broker import THIRTY_SECONDS
+from mimic.brokerage import Brokerage
+from mimic.debug import (LoopLagMonitor, GCTimer, SamplingProfiler,
+                         HandlerTimings, DebugSurface, mark, TIMER_KEY)
+from mimic.proxy_collection import ProxyCollection
+from mimic.util import ProxyProps
+
+
+class TestInstruments(unittest.TestCase):
+    def test_lag_histogram(self):
+        lag = LoopLagMonitor(None, buckets=(0.01, 0.1))
+        for seconds in (0.001, 0.05, 0.05, 3):
+            lag.record(seconds)
+
+        stats = lag.stats()
+        self.assertEqual(stats['samples'], 4)
+        self.assertEqual(stats['max'], 3)
+        self.assertEqual(stats['histogram'],
+                         {'<=0.01': 1, '<=0.1': 2, '>0.1': 1})
+
+    def test_gc_timer(self):
+        timer = GCTimer()
+        timer.start()
+        gc.collect()
+        timer.stop()
+        self.assertEqual(timer.stats()['collections'][2], 1)
+
+    def test_profiler_collapsed_stacks(self):
+        def busy_wait_here():
+            end = time.monotonic() + 0.2
+            while time.monotonic() < end:
+                pass
+
+        profiler = SamplingProfiler(threading.get_ident(), interval=0.001)
+        profiler.start()
+        busy_wait_here()
+        profiler.stop()
+
+        self.assertGreater(profiler.samples, 0)
+        top = profiler.collapsed().splitlines()[0]
+        self.assertIn("test_debug.py:busy_wait_here", top)
+        self.assertFalse(profiler.running)
+
+
+class FakeRequest(dict):
+    pass
+
+
+class TestHandlerTimings(asynctest.TestCase):
+    async def test_phases(self):
+        timings = HandlerTimings()
+
+        async def acquire_proxy(request):
+            mark(request, 'parse')
+            mark(request, 'broker')
+            return 'response'
+
+        async def readme(request):
+            return 'readme'
+
+        for handler in (acquire_proxy, readme):
+            timed = await timings.middleware(None, handler)
+            await timed(FakeRequest())
+
+        stats = timings.stats()
+        self.assertEqual(stats['acquire_proxy']['count'], 1)
+        self.assertEqual(set(stats['acquire_proxy']),
+                         {'count', 'total', 'max', 'parse', 'broker',
+                          'serialize'})
+        self.assertEqual(set(stats['readme']), {'count', 'total', 'max'})
+
+    def test_mark_untimed(self):
+        mark(FakeRequest(), 'parse')  # No timer, no error.
+        request = FakeRequest()
+        self.assertNotIn(TIMER_KEY, request)
+
+
+class TestTaskCounts(asynctest.ClockedTestCase):
+    async def test_task_counts(self):
+        proxies = ProxyCollection()
+        proxies.register_proxy(ProxyProps('http', 'a', 80, 0.1).to_dict())
+        proxies.register_proxy(ProxyProps('http', 'b', 80, 0.1).to_dict())
+        brokerage = Brokerage(proxies, broker_opts={'loop': self.loop})
+
+        first = await brokerage.acquire('http://x.com/', [], 0)
+        await brokerage.acquire('http://x.com/', [], 0)
+        await brokerage.release(first['broker'], first['proxy'], 0.1, False,
+                                lease=first['lease'])
+
+        surface = DebugSurface(brokerage, self.loop)
+        counts = surface.task_counts()
+        self.assertEqual(counts['auto_return'], 1)
+        self.assertEqual(counts['throttled_return'], 1)
+        self.assertEqual(counts['waiters'], 0)
+        self.assertGreaterEqual(counts['live'], 2)
+
+        await self.advance(THIRTY_SECONDS + 1)
+        self.assertEqual(surface.task_counts()['throttled_return'], 0)
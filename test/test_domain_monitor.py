@@ -1,6 +1,9 @@
 import unittest
 from mimic.util import ProxyProps
 from mimic.domain_monitor import DomainMonitor
+from mimic.hashring import HashRing
+from mimic.proxy_state import ProxyState
+from mimic.selection import ThompsonSampling
 
 
 class TestDomainMonitor(unittest.TestCase):
@@ -11,8 +14,16 @@ class TestDomainMonitor(unittest.TestCase):
 
         self.assertEqual(monitor.stats(), {'acquisitions_processed': 0,
                                            'available': 0,
+                                           'free_slots': 0,
                                            'avg_resp_time': float('inf'),
-                                           'indices': {}})
+                                           'latency': {
+                                               'measured': {'samples': 0,
+                                                            'mean': None},
+                                               'estimated': {'samples': 0,
+                                                             'mean': None}},
+                                           'indices': {},
+                                           'selection': {
+                                               'policy': 'response_time'}})
 
         proxy_a = ProxyProps('http', 'localhost', 8888, 0.1,
                              'us', 'transparent')
@@ -78,4 +89,266 @@ class TestDomainMonitor(unittest.TestCase):
 
         self.assertGreater(counts[str(a)], counts[str(b)])
 
+    def test_delist_while_leased(self):
+        monitor = DomainMonitor("google.com")
+        a = ProxyProps('http', 'localhost', 8888, 0.1)
+        monitor.register(a)
+
+        acquired = monitor.acquire()
+        monitor.delist(acquired)
+        monitor.release(acquired, 0.1)
+
+        self.assertEqual(monitor.stats()['available'], 0)
+        self.assertIsNone(monitor.acquire())
+
+    def test_delist_many(self):
+        monitor = DomainMonitor("google.com")
+        proxies = [ProxyProps('http', 'localhost', port, 0.1)
+                   for port in range(8888, 8891)]
+        for proxy in proxies:
+            monitor.register(proxy)
+
+        monitor.delist_many([str(p) for p in proxies[:2]])
+        self.assertEqual(monitor.stats()['available'], 1)
+        self.assertEqual(list(monitor.session_proxies('s')),
+                         [str(proxies[2])])
+        self.assertEqual(monitor.acquire(), str(proxies[2]))
+
+    def test_large_pool_session_ring(self):
+        monitor = DomainMonitor("google.com")
+        proxies = [ProxyProps('http', 'proxy-{}'.format(i), 8888, 0.1)
+                   for i in range(2000)]
+        for proxy in proxies:
+            monitor.register(proxy)
+
+        # The ring is only built once a session needs it, in one pass.
+        self.assertIsNone(monitor._ring)
+        expected = HashRing()
+        expected.add_many(str(proxy) for proxy in proxies)
+        walked = list(monitor.session_proxies('s'))
+        self.assertEqual(walked, list(expected.walk('s')))
+
+        # Later registrations and delists join it on the next session.
+        extra = ProxyProps('http', 'proxy-extra', 8888, 0.1)
+        monitor.register(extra)
+        monitor.delist(walked[0])
+        expected.add(str(extra))
+        expected.remove(walked[0])
+        self.assertEqual(list(monitor.session_proxies('s')),
+                         list(expected.walk('s')))
+
+    def test_reindex_keeps_response_time(self):
+        monitor = DomainMonitor("google.com")
+        a = ProxyProps('http', 'localhost', 8888, 0.5, 'us')
+        monitor.register(a)
+        monitor.release(monitor.acquire(), 2.5)
+
+        a.geo = 'ca'
+        monitor.reindex(a)
+        self.assertIsNone(monitor.acquire('us'))
+        self.assertIsNone(monitor.acquire('ca', 'resp_time<1'))
+        self.assertEqual(monitor.acquire('ca', 'resp_time>2'), str(a))
+
+    def test_usage_rows(self):
+        monitor = DomainMonitor("google.com")
+        a = ProxyProps('http', 'localhost', 8888, 0.5)
+        b = ProxyProps('http', 'localhost', 8889, 1.0)
+        monitor.register(a)
+        monitor.register(b)
+
+        proxy = monitor.acquire('port:8888')
+        monitor.record_outcome(proxy, True)
+        monitor.release(proxy, 2.0)
+        monitor.release(monitor.acquire('port:8888'), 0.25)
+
+        rows = {row[0]: row for row in monitor.usage_rows()}
+        self.assertEqual(rows[str(a)][:5], (str(a), 0.25, True, 2, 1))
+        self.assertIsNotNone(rows[str(a)][5])
+        self.assertEqual(rows[str(b)], (str(b), 1.0, False, 0, 0, None))
+
+        rows = monitor.usage_rows()
+        next(rows)
+        monitor.delist_many([str(a), str(b)])
+        self.assertEqual(list(rows), [])
+        self.assertEqual(monitor.leaks()['unregistered_usage'], 0)
+
+    def test_disjunctive_and_negated_requirements(self):
+        monitor = DomainMonitor("google.com")
+        us = ProxyProps('http', 'localhost', 8888, 0.1, 'us', 'transparent')
+        ca = ProxyProps('http', 'localhost', 8889, 0.1, 'ca', 'high')
+        gb = ProxyProps('http', 'localhost', 8890, 0.1, 'gb', 'high')
+        for proxy in [us, ca, gb]:
+            monitor.register(proxy)
+
+        self.assertIsNone(monitor.acquire('us', '!transparent'))
+
+        acquired = {monitor.acquire('us|ca|gb', '!transparent')
+                    for _ in range(2)}
+        self.assertEqual(acquired, {str(ca), str(gb)})
+        self.assertIsNone(monitor.acquire('us|ca|gb', '!transparent'))
+        self.assertEqual(monitor.acquire('us|ca'), str(us))
+
+    def test_non_finite_response_times_ignored(self):
+        monitor = DomainMonitor("google.com")
+        a = ProxyProps('http', 'localhost', 8888, 0.5)
+        monitor.register(a)
+
+        for response_time in [float('nan'), float('inf'), -1.0]:
+            self.assertEqual(monitor.acquire(), str(a))
+            monitor.release(str(a), response_time)
+            monitor.record_response_time(str(a), response_time)
+
+        # The slot came back each time, and the response time held.
+        self.assertEqual(monitor.acquire('resp_time<1'), str(a))
+        self.assertEqual(monitor.snapshot()['response_times'][str(a)], 0.5)
+
+    def test_range_requirements_follow_releases(self):
+        monitor = DomainMonitor("google.com")
+        a = ProxyProps('http', 'localhost', 8888, 0.5)
+        monitor.register(a)
+
+        acquired = monitor.acquire('resp_time<1.5')
+        self.assertEqual(acquired, str(a))
+        monitor.release(acquired, 2.5)
+
+        self.assertIsNone(monitor.acquire('resp_time<1.5'))
+        self.assertEqual(monitor.acquire('resp_time>=2.5'), str(a))
+
+    def test_selection_policy(self):
+        monitor = DomainMonitor("google.com",
+                                selection_policy=ThompsonSampling())
+        flaky = ProxyProps('http', 'localhost', 8888, 0.1)
+        steady = ProxyProps('http', 'localhost', 8889, 0.2)
+        monitor.register(flaky)
+        monitor.register(steady)
+
+        for _ in range(50):
+            monitor.record_outcome(str(flaky), True)
+            monitor.record_outcome(str(steady), False)
+
+        # Twice as fast doesn't make up for failing nearly every time.
+        picks = []
+        for _ in range(20):
+            proxy = monitor.acquire()
+            picks.append(proxy)
+            monitor.release(proxy, 0)
+        self.assertGreater(picks.count(str(steady)), 15)
+
+        rates = monitor.stats()['selection']['success_rates']
+        self.assertLess(rates['min'], 0.1)
+
+        monitor.delist(str(flaky))
+        rates = monitor.stats()['selection']['success_rates']
+        self.assertEqual(rates['count'], 1)
+        self.assertGreater(rates['min'], 0.1)
+
+    def test_measured_beats_estimated(self):
+        monitor = DomainMonitor("google.com")
+        proxy = ProxyProps('http', 'localhost', 8888, 0.1)
+        monitor.register(proxy)
+        proxy = str(proxy)
+
+        monitor.release(monitor.acquire(), 5.0, 'estimated')
+        self.assertEqual(monitor.average_response_time(), 5.0)
+
+        monitor.release(monitor.acquire(), 0.5)
+        monitor.release(monitor.acquire(), 9.0, 'estimated')
+        self.assertEqual(monitor.average_response_time(), 0.5)
+
+        # Penalties steer selection, but aren't latency samples.
+        monitor.release(monitor.acquire(), 30, 'penalty')
+        self.assertEqual(monitor.average_response_time(), 30)
+
+        self.assertEqual(monitor.latency_stats(),
+                         {'measured': {'samples': 1, 'mean': 0.5},
+                          'estimated': {'samples': 2, 'mean': 7.0}})
+
+    def test_capacity_slots(self):
+        monitor = DomainMonitor("google.com")
+        wide = ProxyProps('http', 'localhost', 8888, 0.1, capacity=3)
+        narrow = ProxyProps('http', 'localhost', 8889, 0.1)
+        monitor.register(wide)
+        monitor.register(narrow)
+        self.assertEqual(monitor.stats()['free_slots'], 4)
+
+        # The most free slots win, until the proxies are level.
+        self.assertEqual(monitor.acquire(), str(wide))
+        self.assertEqual(monitor.acquire(), str(wide))
+        taken = {monitor.acquire(), monitor.acquire()}
+        self.assertEqual(taken, {str(wide), str(narrow)})
+        self.assertIsNone(monitor.acquire())
+
+        monitor.release(str(wide), 0.1)
+        self.assertEqual(monitor.free_slots(str(wide)), 1)
+        self.assertEqual(monitor.acquire(exclude=[str(wide)]), None)
+
+        # A domain-wide capacity overrides the registered ones.
+        monitor.set_capacity(4)
+        self.assertEqual(monitor.free_slots(str(narrow)), 3)
+        monitor.set_capacity(None)
+        self.assertEqual(monitor.free_slots(str(narrow)), 0)
+
+    def test_utilisation(self):
+        monitor = DomainMonitor("google.com")
+        self.assertEqual(monitor.utilisation(), 0.0)
+        wide = ProxyProps('http', 'localhost', 8888, 0.1, capacity=3)
+        monitor.register(wide)
+        monitor.register(ProxyProps('http', 'localhost', 8889, 0.1))
+
+        monitor.acquire()
+        monitor.acquire()
+        self.assertEqual(monitor.utilisation(), 0.5)
+
+        monitor.set_capacity(1)
+        self.assertEqual(monitor.utilisation(), 1.0)
+        monitor.delist(str(wide))
+        self.assertEqual(monitor.utilisation(), 0.0)
+
+    def test_retire(self):
+        monitor = DomainMonitor("google.com")
+        proxy = ProxyProps('http', 'localhost', 8888, 0.1, capacity=2)
+        monitor.register(proxy)
+
+        self.assertEqual(monitor.acquire(), str(proxy))
+        monitor.retire(str(proxy))
+        self.assertIsNone(monitor.acquire())
+
+        monitor.release(str(proxy), 0.1)
+        self.assertEqual(monitor.available, 0)
+
+    def test_shared_proxy_state(self):
+        state = ProxyState(max_leases=1)
+        google = DomainMonitor("google.com", proxy_state=state)
+        yahoo = DomainMonitor("yahoo.com", proxy_state=state)
+
+        proxy = ProxyProps('http', 'localhost', 8888, 0.1)
+        google.register(proxy)
+        yahoo.register(proxy)
+
+        self.assertEqual(google.acquire(), str(proxy))
+        self.assertIsNone(yahoo.acquire())
+
+        google.lease_ended(str(proxy))
+        self.assertEqual(yahoo.acquire(), str(proxy))
+
+    def test_failures_lower_selection_everywhere(self):
+        state = ProxyState()
+        google = DomainMonitor("google.com", proxy_state=state)
+        yahoo = DomainMonitor("yahoo.com", proxy_state=state)
+
+        flaky = ProxyProps('http', 'localhost', 8888, 0.1)
+        steady = ProxyProps('http', 'localhost', 8889, 0.1)
+        for monitor in (google, yahoo):
+            monitor.register(flaky)
+            monitor.register(steady)
+
+        for _ in range(20):
+            google.record_outcome(str(flaky), True)
 
+        picks = []
+        for _ in range(20):
+            proxy = yahoo.acquire()
+            picks.append(proxy)
+            yahoo.lease_ended(proxy)
+            yahoo.release(proxy, 0)
+        self.assertGreater(picks.count(str(steady)), 15)
@@ -0,0 +1,68 @@
+import ast
+import csv
+import io
+import math
+import struct
+import unittest
+from mimic.export import COLUMNS, chunked, csv_chunks, npy_chunks
+
+
+ROWS = [('a.com', 'HTTP://A:1', 0.5, True, 3, 1, 1500000000.25),
+        ('a.com', 'HTTP://LONGER:2', 2.0, False, 0, 0, None),
+        ('bb.com', 'HTTP://A:1', 1.0, False, 1, 0, 1500000001.0)]
+
+
+def read_npy(data):
+    """
+    Parse concatenated NPY arrays of records into rows, without numpy.
+    """
+    rows = []
+    while data:
+        assert data[:8] == b'\x93NUMPY\x01\x00'
+        header_len, = struct.unpack('<H', data[8:10])
+        assert (10 + header_len) % 64 == 0
+        header = ast.literal_eval(data[10:10 + header_len].decode('latin1'))
+        data = data[10 + header_len:]
+
+        names = [name for name, _ in header['descr']]
+        assert tuple(names) == COLUMNS
+        widths = [int(kind[2:]) for _, kind in header['descr'][:2]]
+        record = struct.Struct('<{}s{}sd?QQd'.format(*widths))
+        for _ in range(header['shape'][0]):
+            row = list(record.unpack(data[:record.size]))
+            data = data[record.size:]
+            row[:2] = [v.rstrip(b'\0').decode('utf-8') for v in row[:2]]
+            rows.append(row)
+    return rows
+
+
+class TestExport(unittest.TestCase):
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+    def test_csv(self):
+        chunks = list(csv_chunks(iter(ROWS), chunk_rows=2))
+        self.assertEqual(len(chunks), 2)
+
+        rows = list(csv.reader(io.StringIO(b''.join(chunks).decode())))
+        self.assertEqual(tuple(rows[0]), COLUMNS)
+        self.assertEqual(rows[1], ['a.com', 'HTTP://A:1', '0.5', '1', '3',
+                                   '1', '1500000000.25'])
+        self.assertEqual(rows[2][-1], '')
+        self.assertEqual(len(rows), 4)
+
+    def test_csv_without_rows(self):
+        data = b''.join(csv_chunks([]))
+        self.assertEqual(data.decode(), ','.join(COLUMNS) + '\n')
+
+    def test_npy(self):
+        chunks = list(npy_chunks(iter(ROWS), chunk_rows=2))
+        self.assertEqual(len(chunks), 2)
+
+        rows = read_npy(b''.join(chunks))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0], list(ROWS[0]))
+        self.assertEqual(rows[1][:6], list(ROWS[1][:6]))
+        self.assertTrue(math.isnan(rows[1][6]))
+        self.assertEqual(rows[2], list(ROWS[2]))
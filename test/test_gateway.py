@@ -0,0 +1,236 @@
+import asyncio
+import asynctest
+from urllib.parse import urlsplit
+from mimic.brokerage import Brokerage
+from mimic.gateway import ProxyGateway, read_head
+from mimic.proxy_collection import ProxyCollection
+from mimic.util import ProxyProps
+
+
+class StandIn:
+    """
+    A local server counting its connections.
+    """
+    def __init__(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._accept, '127.0.0.1', 0,
+                                                 loop=self.loop)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _accept(self, reader, writer):
+        self.connections += 1
+        try:
+            await self.handler(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def origin_handler(status=200, body=b'hello'):
+    async def handle(reader, writer):
+        while True:
+            head = await read_head(reader)
+            if head is None:
+                return
+            writer.write("HTTP/1.1 {} OK\r\nContent-Length: {}\r\n\r\n".format(
+                status, len(body)).encode() + body)
+            await writer.drain()
+    return handle
+
+
+async def upstream_proxy_handler(reader, writer):
+    """
+    A minimal forward proxy: absolute-form requests over keep-alive, plus
+    CONNECT tunnels.
+    """
+    while True:
+        head = await read_head(reader)
+        if head is None:
+            return
+
+        method, target, version = head.start_line.split(' ')
+        if method == 'CONNECT':
+            host, port = target.rsplit(':', 1)
+            o_reader, o_writer = await asyncio.open_connection(host,
+                                                               int(port))
+            writer.write(b"HTTP/1.1 200 OK\r\n\r\n")
+            await asyncio.gather(_pipe(reader, o_writer),
+                                 _pipe(o_reader, writer))
+            return
+
+        url = urlsplit(target)
+        o_reader, o_writer = await asyncio.open_connection(url.hostname,
+                                                           url.port)
+        o_writer.write("{} {} {}\r\n\r\n".format(method, url.path,
+                                                 version).encode())
+        resp = await read_head(o_reader)
+        length = int(resp.get('content-length'))
+        body = await o_reader.readexactly(length)
+        o_writer.close()
+
+        writer.write((resp.start_line + "\r\nContent-Length: {}\r\n\r\n"
+                      .format(length)).encode() + body)
+        await writer.drain()
+
+
+def broken_upstream_handler(response):
+    async def handle(reader, writer):
+        if await read_head(reader) is not None:
+            writer.write(response)
+            await writer.drain()
+    return handle
+
+
+async def _pipe(reader, writer):
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+class TestProxyGateway(asynctest.TestCase):
+    async def setUp(self):
+        self.origin = StandIn(self.loop, origin_handler())
+        self.origin_port = await self.origin.start()
+        self.upstream = StandIn(self.loop, upstream_proxy_handler)
+        upstream_port = await self.upstream.start()
+
+        self.proxy_collection = ProxyCollection()
+        proxy = ProxyProps('http', '127.0.0.1', upstream_port, 0.1)
+        self.proxy_collection.register_proxy(proxy.to_dict())
+        self.proxy = str(proxy)
+
+        self.brokerage = Brokerage(self.proxy_collection,
+                                   broker_opts={'loop': self.loop,
+                                                'return_delay': 0})
+        self.gateway = ProxyGateway(self.brokerage, '127.0.0.1', 0,
+                                    loop=self.loop, max_wait_time=1)
+        await self.gateway.start()
+
+    async def tearDown(self):
+        await self.gateway.close()
+        await self.upstream.close()
+        await self.origin.close()
+
+    async def fetch(self, path='/x', headers=''):
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.gateway.port)
+        writer.write("GET http://127.0.0.1:{}{} HTTP/1.1\r\n{}\r\n".format(
+            self.origin_port, path, headers).encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    def domain_stats(self):
+        return self.brokerage.list_all()['127.0.0.1:{}'.format(
+            self.origin_port)]
+
+    async def test_forward_and_release(self):
+        response = await self.fetch()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200"))
+        self.assertTrue(response.endswith(b"\r\n\r\nhello"))
+        self.assertIn(b"Connection: close", response)
+
+        stats = self.domain_stats()
+        self.assertEqual(stats['leased'], 0)
+        self.assertEqual(self.gateway.stats()['requests'], 1)
+
+        # Released with the measured time, not a made-up one.
+        await asyncio.sleep(0.01)
+        self.assertLess(self.domain_stats()['avg_resp_time'], 0.1)
+
+    async def test_upstream_connections_pooled(self):
+        for _ in range(3):
+            self.assertTrue((await self.fetch()).endswith(b"hello"))
+            await asyncio.sleep(0.01)  # Let the zero cooldown pass.
+
+        self.assertEqual(self.upstream.connections, 1)
+        stats = self.gateway.stats()
+        self.assertEqual(stats['upstream_connections_reused'], 2)
+
+    async def test_failure_status_released_as_failure(self):
+        self.origin.handler = origin_handler(status=503, body=b'')
+        response = await self.fetch()
+        self.assertTrue(response.startswith(b"HTTP/1.1 503"))
+        self.assertEqual(self.gateway.stats()['failures'], 1)
+
+    async def test_no_proxy(self):
+        self.proxy_collection.delist_proxy(self.proxy)
+        self.brokerage.delist_on_all(self.proxy)
+        response = await self.fetch()
+        self.assertTrue(response.startswith(b"HTTP/1.1 503"))
+
+    async def test_aborted_acquire(self):
+        # Hold the only proxy so the gateway's acquire parks, then abort.
+        held = await self.brokerage.acquire(
+            'http://127.0.0.1:{}/'.format(self.origin_port), {}, 1)
+        self.assertEqual(held['proxy'], self.proxy)
+        fetch = asyncio.ensure_future(self.fetch(), loop=self.loop)
+        await asyncio.sleep(0.05)
+        self.brokerage.abort_waiters()
+        response = await fetch
+        self.assertTrue(response.startswith(b"HTTP/1.1 503"))
+        self.assertIn(b"Retry-After: 0", response)
+        self.assertEqual(self.gateway.stats()['no_proxy'], 1)
+
+    async def test_connect_tunnel(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.gateway.port)
+        writer.write("CONNECT 127.0.0.1:{0} HTTP/1.1\r\n"
+                     "Host: 127.0.0.1:{0}\r\n\r\n".format(
+                         self.origin_port).encode())
+        head = await read_head(reader)
+        self.assertEqual(head.status(), 200)
+        self.assertEqual(self.gateway.stats()['tunnels'], 1)
+
+        writer.write(b"GET /x HTTP/1.1\r\n\r\n")
+        head = await read_head(reader)
+        self.assertEqual(await reader.readexactly(5), b'hello')
+        writer.close()
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.domain_stats()['leased'], 0)
+
+    async def test_bad_client_content_length(self):
+        response = await self.fetch(headers="Content-Length: lots\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 400"))
+        self.assertEqual(self.gateway.stats()['requests'], 0)
+
+    async def assert_bad_gateway(self, response):
+        self.upstream.handler = broken_upstream_handler(response)
+        self.assertTrue((await self.fetch()).startswith(b"HTTP/1.1 502"))
+        self.assertEqual(self.domain_stats()['leased'], 0)
+        self.assertEqual(self.gateway.stats()['failures'], 1)
+
+    async def test_bad_upstream_content_length(self):
+        await self.assert_bad_gateway(
+            b"HTTP/1.1 200 OK\r\nContent-Length: -1\r\n\r\n")
+
+    async def test_malformed_upstream_status(self):
+        await self.assert_bad_gateway(b"garbage\r\n\r\n")
+
+    async def test_malformed_connect_response(self):
+        self.upstream.handler = broken_upstream_handler(
+            b"HTTP/1.1 two-hundred\r\n\r\n")
+        reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                       self.gateway.port)
+        writer.write("CONNECT 127.0.0.1:{0} HTTP/1.1\r\n\r\n".format(
+            self.origin_port).encode())
+        head = await read_head(reader)
+        writer.close()
+
+        self.assertEqual(head.status(), 502)
+        self.assertEqual(self.domain_stats()['leased'], 0)
+        self.assertEqual(self.gateway.stats()['failures'], 1)
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import asynctest
+from mimic.handoff import (HandoffError, bind_listener, encode_state,
+                           read_state, receive_socket, request_handoff,
+                           send_socket, wait_for_successor)
+
+
+class TestHandoffProtocol(unittest.TestCase):
+    def setUp(self):
+        self.old, self.new = socket.socketpair(socket.AF_UNIX)
+
+    def tearDown(self):
+        self.old.close()
+        self.new.close()
+
+    def test_socket_passing(self):
+        with bind_listener('127.0.0.1', 0) as listener:
+            send_socket(self.old, listener)
+            with receive_socket(self.new) as inherited:
+                self.assertEqual(inherited.getsockname(),
+                                 listener.getsockname())
+
+                # Either copy accepts connections on the same port.
+                listener.close()
+                with socket.create_connection(inherited.getsockname()):
+                    conn, _ = inherited.accept()
+                    conn.close()
+
+    def test_no_socket_sent(self):
+        self.old.sendall(b'oops')
+        with self.assertRaises(HandoffError):
+            receive_socket(self.new)
+
+    def test_state_round_trip(self):
+        state = {'proxies': [], 'domains': {'a.com': {'fence': 3}}}
+        self.old.sendall(encode_state(state))
+        self.assertEqual(read_state(self.new), state)
+
+        self.old.sendall(encode_state(state)[:-1])
+        self.old.close()
+        with self.assertRaises(HandoffError):
+            read_state(self.new)
+
+    def test_no_predecessor(self):
+        self.assertIsNone(request_handoff('/nonexistent/mimic.sock'))
+
+
+class TestHandoff(asynctest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'handoff.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    async def test_hand_off(self):
+        waiting = self.loop.create_task(
+            wait_for_successor(self.path, self.loop))
+        await asyncio.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+
+        successor = self.loop.run_in_executor(None, request_handoff,
+                                              self.path, 5)
+        with bind_listener('127.0.0.1', 0) as listener:
+            with await waiting as channel:
+                send_socket(channel, listener)
+                await self.loop.sock_sendall(channel,
+                                             encode_state({'fence': 1}))
+            self.assertFalse(os.path.exists(self.path))
+
+            inherited, state = await successor
+            with inherited:
+                self.assertEqual(inherited.getsockname(),
+                                 listener.getsockname())
+            self.assertEqual(state, {'fence': 1})
+
+    async def test_state_after_a_long_drain(self):
+        waiting = self.loop.create_task(
+            wait_for_successor(self.path, self.loop))
+        await asyncio.sleep(0.01)
+
+        # The predecessor drains for longer than the successor's timeout.
+        successor = self.loop.run_in_executor(None, request_handoff,
+                                              self.path, 0.05)
+        with bind_listener('127.0.0.1', 0) as listener:
+            with await waiting as channel:
+                send_socket(channel, listener)
+                await asyncio.sleep(0.2)
+                await self.loop.sock_sendall(channel,
+                                             encode_state({'fence': 2}))
+
+            inherited, state = await successor
+            inherited.close()
+            self.assertEqual(state, {'fence': 2})
@@ -0,0 +1,60 @@
+import unittest
+from mimic.hashring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.ring = HashRing()
+        self.nodes = ['proxy-{}'.format(i) for i in range(10)]
+        for node in self.nodes:
+            self.ring.add(node)
+        self.keys = ['session-{}'.format(i) for i in range(1000)]
+
+    def test_walk_visits_each_node_once(self):
+        walked = list(self.ring.walk('session-0'))
+        self.assertEqual(sorted(walked), sorted(self.nodes))
+        self.assertEqual(walked[0], self.ring.owner('session-0'))
+
+    def test_spread(self):
+        owners = [self.ring.owner(key) for key in self.keys]
+        for node in self.nodes:
+            self.assertGreater(owners.count(node), 30)
+
+    def test_remove_remaps_only_its_keys(self):
+        before = {key: self.ring.owner(key) for key in self.keys}
+        self.ring.remove('proxy-3')
+        after = {key: self.ring.owner(key) for key in self.keys}
+
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(before[key] == 'proxy-3' for key in moved))
+
+        # Each moved key goes to its next node on the old ring.
+        old_ring = HashRing()
+        for node in self.nodes:
+            old_ring.add(node)
+        for key in moved:
+            self.assertEqual(after[key], list(old_ring.walk(key))[1])
+
+    def test_remove_many(self):
+        removed = self.nodes[:3]
+        self.ring.remove_many(removed + ['missing'])
+
+        owners = {self.ring.owner(key) for key in self.keys}
+        self.assertEqual(owners, set(self.nodes[3:]))
+
+        expected = HashRing()
+        for node in self.nodes[3:]:
+            expected.add(node)
+        for key in self.keys[:100]:
+            self.assertEqual(self.ring.owner(key), expected.owner(key))
+
+    def test_add_many(self):
+        ring = HashRing()
+        ring.add_many(self.nodes[:5])
+        ring.add_many(self.nodes[5:] + self.nodes[:1])
+        for key in self.keys:
+            self.assertEqual(ring.owner(key), self.ring.owner(key))
+
+    def test_empty(self):
+        self.assertIsNone(HashRing().owner('x'))
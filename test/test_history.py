@@ -0,0 +1,70 @@
+import unittest
+from mimic.history import DomainHistory, RingSeries
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRingSeries(unittest.TestCase):
+    def test_ring(self):
+        series = RingSeries(1, 4, fields=('n',))
+        self.assertEqual(series.nbytes, 16)
+        for now in range(6):
+            series.add(now + 0.5, {'n': now})
+        series.add(5.9, {'n': 1})
+        self.assertEqual(series.read(5, 4), {'n': [2, 3, 4, 6]})
+
+        # Quiet buckets read as zero, and the ring forgets what it passed.
+        self.assertEqual(series.read(7, 4), {'n': [4, 6, 0, 0]})
+        series.add(20, {'n': 1})
+        self.assertEqual(series.read(20, 8), {'n': [0, 0, 0, 1]})
+
+        # Too old to fit.
+        series.add(3, {'n': 1})
+        self.assertEqual(series.read(20, 4), {'n': [0, 0, 0, 1]})
+
+
+class TestDomainHistory(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.history = DomainHistory(self.clock, tiers=((1, 60), (10, 30)))
+
+    def test_series(self):
+        self.history.record(acquired=1, wait=2.0, utilisation=0.5,
+                            samples=1)
+        self.history.record(timed_out=1, wait=4.0, utilisation=1.0,
+                            samples=1)
+        self.clock.now = 1
+        self.history.record(released=1, failed=1)
+        self.history.record(released=1)
+
+        res = self.history.series(window=3)
+        self.assertEqual(res['step'], 1)
+        self.assertEqual(res['window'], 3)
+        self.assertEqual(res['acquired'], [0, 1, 0])
+        self.assertEqual(res['acquire_rate'], [0.0, 1.0, 0.0])
+        self.assertEqual(res['mean_wait'], [None, 3.0, None])
+        self.assertEqual(res['utilisation'], [None, 0.75, None])
+        self.assertEqual(res['failure_rate'], [None, None, 0.5])
+
+    def test_downsampling(self):
+        for now in range(0, 120, 5):
+            self.clock.now = now
+            self.history.record(acquired=1)
+
+        # Past the fine tier's minute, the coarse tier answers.
+        res = self.history.series(window=120, step=30)
+        self.assertEqual(res['step'], 30)
+        self.assertEqual(res['acquired'], [6, 6, 6, 6])
+
+        res = self.history.series(step=25)
+        self.assertEqual(res['step'], 25)
+        self.assertEqual(res['acquired'], [5, 5])
+
+        # Windows past the coarsest tier are cut to it.
+        self.assertEqual(self.history.series(window=10000)['window'], 300)
@@ -0,0 +1,96 @@
+import unittest
+from mimic.index import PropertyIndex, RangeIndex
+from mimic.util import ProxyProps
+
+
+class TestRangeIndex(unittest.TestCase):
+    def test_select(self):
+        index = RangeIndex()
+        for proxy, value in [('a', 0.5), ('b', 1.0), ('c', 1.0), ('d', 2.0)]:
+            index.add(proxy, value)
+
+        self.assertEqual(index.select('<', 1.0), {'a'})
+        self.assertEqual(index.select('<=', 1.0), {'a', 'b', 'c'})
+        self.assertEqual(index.select('>', 1.0), {'d'})
+        self.assertEqual(index.select('>=', 1.0), {'b', 'c', 'd'})
+
+    def test_update_and_remove(self):
+        index = RangeIndex()
+        index.add('a', 0.5)
+        index.add('b', 0.5)
+        index.add('a', 3.0)
+        self.assertEqual(index.select('<', 1.0), {'b'})
+
+        index.remove('b')
+        index.remove('missing')
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.select('>', 0.0), {'a'})
+
+    def test_non_finite_rejected(self):
+        index = RangeIndex()
+        index.add('a', 0.5)
+        for value in [float('nan'), float('inf'), float('-inf')]:
+            with self.assertRaises(ValueError):
+                index.add('a', value)
+        self.assertEqual(index.value_of('a'), 0.5)
+        self.assertEqual(index.select('<', 1.0), {'a'})
+
+
+class TestPropertyIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = PropertyIndex()
+        self.a = ProxyProps('HTTP', 'a', 3128, 0.5, 'US', 'HTTP-HIGH',
+                            tags=['ACME'])
+        self.b = ProxyProps('SOCKS5', 'b', 1080, 2.0, 'HTTP-HIGH', None)
+        for proxy in [self.a, self.b]:
+            self.index.add(str(proxy), proxy)
+
+    def test_namespaced_terms(self):
+        a, b = str(self.a), str(self.b)
+
+        self.assertEqual(self.index.posting('geo:US'), {a})
+        self.assertEqual(self.index.posting('port:3128'), {a})
+        self.assertEqual(self.index.posting('proto:SOCKS5'), {b})
+        self.assertEqual(self.index.posting('tag:ACME'), {a})
+        self.assertEqual(self.index.posting('anon_level:HTTP-HIGH'), {a})
+        self.assertEqual(self.index.posting('geo:HTTP-HIGH'), {b})
+        self.assertEqual(self.index.posting('tag:MISSING'), set())
+
+    def test_legacy_terms_span_geo_and_anon_level(self):
+        self.assertEqual(self.index.posting('HTTP-HIGH'),
+                         {str(self.a), str(self.b)})
+        self.assertEqual(self.index.posting('US'), {str(self.a)})
+
+    def test_legacy_terms_with_a_colon(self):
+        c = ProxyProps('HTTP', 'c', 80, 0.5, 'US', 'CONNECT:80')
+        self.index.add(str(c), c)
+        self.assertEqual(self.index.posting('CONNECT:80'), {str(c)})
+        self.assertEqual(self.index.posting('CONNECT:25'), set())
+        self.assertEqual(self.index.posting('nosuch:US'), set())
+
+    def test_range_terms(self):
+        self.assertEqual(self.index.posting('resp_time<1.5'), {str(self.a)})
+        self.index.update_value('resp_time', str(self.a), 3.0)
+        self.assertEqual(self.index.posting('resp_time<1.5'), set())
+        self.assertEqual(self.index.posting('resp_time>=2'),
+                         {str(self.a), str(self.b)})
+        self.assertEqual(self.index.posting('port<2'), set())
+
+    def test_cidr_terms(self):
+        c = ProxyProps('HTTP', '10.1.2.3', 8080, 1.0)
+        d = ProxyProps('HTTP', '192.168.0.7', 8080, 1.0)
+        for proxy in [c, d]:
+            self.index.add(str(proxy), proxy)
+
+        self.assertEqual(self.index.posting('host:10.0.0.0/8'), {str(c)})
+        self.assertEqual(self.index.posting('host:0.0.0.0/0'),
+                         {str(c), str(d)})
+        self.assertEqual(self.index.posting('host:10.1.2.3/32'), {str(c)})
+        self.assertEqual(self.index.posting('host:10.0.0.0/99'), set())
+
+    def test_remove(self):
+        self.index.remove(str(self.a))
+        self.assertNotIn(str(self.a), self.index)
+        self.assertNotIn('tag', self.index.sizes())
+        self.assertEqual(self.index.sizes()['geo'], {'keys': 1, 'entries': 1})
+        self.assertEqual(self.index.posting('resp_time<1.5'), set())
@@ -0,0 +1,61 @@
+import asyncio
+import asynctest
+import io
+import unittest
+from types import SimpleNamespace
+from mimic.ingest import IngestPipeline, iter_chunks
+
+
+def fake_proxy(port):
+    return SimpleNamespace(schemes=['HTTP'], types={'HTTP': 'High'},
+                           host='127.0.0.1', port=port, avg_resp_time=0.1,
+                           geo=SimpleNamespace(code='US'))
+
+
+class TestIterChunks(unittest.TestCase):
+    def test_chunks_end_on_lines(self):
+        text = "".join("10.0.0.{}:8080\n".format(i) for i in range(100))
+        chunks = list(iter_chunks(io.StringIO(text), chunk_size=37))
+
+        self.assertEqual("".join(chunks), text)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith("\n"))
+
+    def test_trailing_partial_line(self):
+        chunks = list(iter_chunks(io.StringIO("a\nb\nc"), chunk_size=3))
+        self.assertEqual("".join(chunks), "a\nb\nc")
+        self.assertEqual(chunks[-1], "c")
+
+
+class TestIngestPipeline(asynctest.TestCase):
+    async def test_back_pressure(self):
+        pipeline = IngestPipeline('http://localhost:8901', loop=self.loop,
+                                  batch_size=1, max_pending_batches=1)
+
+        # No workers are running, so the first batch fills the queue...
+        await pipeline.put(fake_proxy(1))
+        self.assertEqual(pipeline.stats()['pending_batches'], 1)
+
+        # ...and the next put has to wait for room.
+        blocked = self.loop.create_task(pipeline.put(fake_proxy(2)))
+        await asyncio.sleep(0.01)
+        self.assertFalse(blocked.done())
+
+        self.assertEqual(len(await pipeline._queue.get()), 1)
+        await asyncio.sleep(0.01)
+        self.assertTrue(blocked.done())
+        self.assertEqual(pipeline.stats()['seen'], 2)
+
+    async def test_consume_batches_until_sentinel(self):
+        pipeline = IngestPipeline('http://localhost:8901', loop=self.loop,
+                                  batch_size=2, max_pending_batches=10)
+        proxies = asyncio.Queue(loop=self.loop)
+        for port in range(3):
+            proxies.put_nowait(fake_proxy(port))
+        proxies.put_nowait(None)
+
+        await pipeline.consume(proxies)
+
+        batches = [pipeline._queue.get_nowait() for _ in range(2)]
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(batches[0][0]['anon_level'], 'HTTP-HIGH')
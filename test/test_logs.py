@@ -0,0 +1,98 @@
+import io
+import json
+import logging
+import queue
+import unittest
+from mimic.logs import (JSONFormatter, SamplingFilter, NonBlockingQueueHandler,
+                        configure_logging, stop_logging, parse_sample_rates,
+                        ROOT_LOGGER)
+from mimic.util import setup_logger
+
+
+def make_record(msg, *args, event=None):
+    record = logging.LogRecord('mimic.test', logging.INFO, __file__, 1, msg,
+                               args, None)
+    if event is not None:
+        record.event = event
+    return record
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLogs(unittest.TestCase):
+    def tearDown(self):
+        stop_logging()
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.propagate = True
+
+    def test_json_formatter(self):
+        record = make_record("Acquire %s on %s", 'HTTP://A:1', 'x.com',
+                             event='acquire')
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry['event'], 'acquire')
+        self.assertEqual(entry['message'], "Acquire HTTP://A:1 on x.com")
+        self.assertEqual(entry['args'], ['HTTP://A:1', 'x.com'])
+        self.assertEqual(entry['level'], 'INFO')
+
+        # Without an event name, the template stands in.
+        entry = json.loads(JSONFormatter().format(make_record("Hi %s", 1)))
+        self.assertEqual(entry['event'], "Hi %s")
+
+    def test_sampling(self):
+        sampler = SamplingFilter({'acquire': 0.0, 'release': 1.0})
+        self.assertFalse(sampler.filter(make_record("a", event='acquire')))
+        self.assertTrue(sampler.filter(make_record("r", event='release')))
+        self.assertTrue(sampler.filter(make_record("other")))
+
+    def test_rate_limit(self):
+        clock = FakeClock()
+        limiter = SamplingFilter(max_per_second=2, clock=clock)
+
+        kept = [limiter.filter(make_record("x")) for _ in range(5)]
+        self.assertEqual(kept, [True, True, False, False, False])
+        self.assertTrue(limiter.filter(make_record("y")))
+
+        clock.now = 0.5
+        record = make_record("x")
+        self.assertTrue(limiter.filter(record))
+        self.assertEqual(record.suppressed, 3)
+        self.assertFalse(limiter.filter(make_record("x")))
+
+    def test_full_queue_drops(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        handler.handle(make_record("a"))
+        handler.handle(make_record("b"))
+        self.assertEqual(handler.dropped, 1)
+
+    def test_configure_logging(self):
+        stream = io.StringIO()
+        configure_logging(stream, sample_rates={'noisy': 0.0})
+
+        logger = setup_logger('test')
+        logger.info("Kept %s", 1)
+        logger.info("Dropped", extra={'event': 'noisy'})
+        stop_logging()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['message'], "Kept 1")
+
+        # Setting up the logger again doesn't add handlers.
+        root = logging.getLogger(ROOT_LOGGER)
+        self.assertEqual(len(root.handlers), 1)
+
+    def test_parse_sample_rates(self):
+        self.assertEqual(parse_sample_rates(['acquire=0.25']),
+                         {'acquire': 0.25})
+        with self.assertRaises(ValueError):
+            parse_sample_rates(['acquire'])
+        with self.assertRaises(ValueError):
+            parse_sample_rates(['acquire=2'])
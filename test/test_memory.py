@@ -0,0 +1,32 @@
+import sys
+import unittest
+from mimic.memory import estimate_size, structure_sizes, count_unknown
+from mimic.util import ProxyProps
+
+
+class TestMemory(unittest.TestCase):
+    def test_exact_when_fully_sampled(self):
+        values = ["proxy-{}".format(i) for i in range(10)]
+        expected = sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+        self.assertEqual(estimate_size(values), expected)
+
+    def test_sampled_estimate_scales(self):
+        values = {"proxy-{:04}".format(i): i for i in range(1000)}
+        exact = estimate_size(values, sample=1000)
+        estimate = estimate_size(values, sample=10)
+        self.assertAlmostEqual(estimate / exact, 1.0, places=1)
+
+    def test_nested_and_own_objects(self):
+        props = ProxyProps('http', 'localhost', 8888, 0.1, tags=['A'])
+        self.assertGreater(estimate_size(props), sys.getsizeof(props))
+        self.assertEqual(estimate_size({'a': [1, 2]}, depth=0),
+                         sys.getsizeof({'a': [1, 2]}))
+
+    def test_structure_sizes(self):
+        props = ProxyProps('http', 'localhost', 8888, 0.1)
+        self.assertEqual(set(structure_sizes(props, ['host', 'tags'])),
+                         {'host', 'tags'})
+
+    def test_count_unknown(self):
+        self.assertEqual(count_unknown(['a', 'b', 'c'], {'a'}), 2)
+        self.assertEqual(count_unknown(['a', 'b'], lambda k: k == 'a'), 1)
@@ -0,0 +1,74 @@
+import json
+import os
+import tempfile
+import unittest
+from mimic.policy import PolicyTable
+
+
+class TestPolicyTable(unittest.TestCase):
+    def setUp(self):
+        self.table = PolicyTable(
+            default={'return_delay': 30},
+            domains={'strict.com': {'return_delay': 120},
+                     '*.strict.com': {'return_delay': 90},
+                     '*.api.strict.com': {'max_waiters': 5},
+                     '*.com': {'retry_time': 2}})
+
+    def test_exact_match(self):
+        self.assertEqual(self.table.settings_for('strict.com'),
+                         {'return_delay': 120})
+
+    def test_longest_wildcard_wins(self):
+        self.assertEqual(self.table.settings_for('www.strict.com'),
+                         {'return_delay': 90})
+        self.assertEqual(self.table.settings_for('v1.api.strict.com'),
+                         {'return_delay': 30, 'max_waiters': 5})
+        self.assertEqual(self.table.settings_for('example.com'),
+                         {'return_delay': 30, 'retry_time': 2})
+
+    def test_default(self):
+        self.assertEqual(self.table.settings_for('example.org'),
+                         {'return_delay': 30})
+        self.assertEqual(PolicyTable().settings_for('example.org'), {})
+
+    def test_unknown_setting(self):
+        with self.assertRaises(ValueError):
+            PolicyTable(domains={'a.com': {'return_dealy': 1}})
+
+    def test_bad_values(self):
+        for table in [{'default': {'return_delay': "fast"}},
+                      {'default': {'max_waiters': -1}},
+                      {'default': {'retry_time': float('nan')}},
+                      {'default': {'return_delay': None}},
+                      {'default': {'client_caps': ['a']}},
+                      {'default': {'client_weights': {'a': "heavy"}}},
+                      {'default': {'client_weights': {'a': 0}}},
+                      {'default': {'retry_time': 0}},
+                      {'default': {'return_delay': 0}},
+                      {'domains': {'a.com': {'bad_return_delay': 0}}},
+                      {'domains': {'a.com': {'proxy_capacity': 0}}},
+                      {'default': []},
+                      {'domains': ['a.com']},
+                      {'domains': {'a.com': 5}},
+                      []]:
+            with self.assertRaises(ValueError):
+                PolicyTable.from_dict(table)
+
+        table = PolicyTable.from_dict({'default': {
+            'max_waiters': 0, 'client_caps': {'bot': 2, 'banned': 0},
+            'failed_release_resp_time': 2.5, 'sticky_wait_time': 0}})
+        self.assertEqual(table.settings_for('a.com')['client_caps'],
+                         {'bot': 2, 'banned': 0})
+
+    def test_from_file(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.table.to_dict(), fp)
+        try:
+            table = PolicyTable.from_file(path)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(table.to_dict(), self.table.to_dict())
+        self.assertEqual(table.settings_for('www.strict.com'),
+                         {'return_delay': 90})
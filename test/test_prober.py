@@ -0,0 +1,86 @@
+import asyncio
+import asynctest
+from mimic.brokerage import Brokerage
+from mimic.prober import ProxyProber
+from mimic.proxy_collection import ProxyCollection
+from mimic.util import ProxyProps
+
+
+STAND_IN_RESPONSE = (b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Length: 2\r\n"
+                     b"Connection: close\r\n\r\nok")
+
+
+class TestProxyProber(asynctest.TestCase):
+    def setUp(self):
+        self.proxy_collection = ProxyCollection()
+        self.brokerage = Brokerage(self.proxy_collection,
+                                   broker_opts={'loop': self.loop})
+        self.monitor = self.brokerage._broker_for('google.com').monitor
+
+    def register(self, port):
+        proxy = ProxyProps('http', '127.0.0.1', port, 0.1)
+        self.proxy_collection.register_proxy(proxy.to_dict())
+        return str(proxy)
+
+    async def test_failed_probes_delist_globally(self):
+        proxy = self.register(8888)
+
+        async def always_fails(p):
+            return False
+
+        prober = ProxyProber(self.proxy_collection, self.brokerage,
+                             'http://localhost/', loop=self.loop,
+                             max_failures=3, probe_fn=always_fails)
+
+        for _ in range(2):
+            self.assertIsNone(await prober.probe(proxy))
+        self.assertEqual(self.monitor.stats()['available'], 1)
+
+        delists = []
+        delist_many = self.monitor.delist_many
+        self.monitor.delist_many = lambda proxies: (delists.append(proxies),
+                                                    delist_many(proxies))
+
+        await prober.probe(proxy)
+        self.assertEqual(self.monitor.stats()['available'], 0)
+        self.assertEqual(delists, [{proxy}])
+        self.assertEqual(self.proxy_collection.proxy_names(), [])
+        self.assertEqual(prober.stats()['delisted'], 1)
+
+    async def test_successful_probe_feeds_response_times(self):
+        proxy = self.register(8888)
+
+        async def succeeds(p):
+            return True
+
+        prober = ProxyProber(self.proxy_collection, self.brokerage,
+                             'http://localhost/', loop=self.loop,
+                             probe_fn=succeeds)
+        response_time = await prober.probe(proxy)
+
+        self.assertIsNotNone(response_time)
+        self.assertEqual(self.monitor._response_times[proxy],
+                         response_time)
+
+    async def test_probe_through_stand_in_proxy(self):
+        async def handle(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(STAND_IN_RESPONSE)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0,
+                                            loop=self.loop)
+        port = server.sockets[0].getsockname()[1]
+        proxy = self.register(port)
+
+        prober = ProxyProber(self.proxy_collection, self.brokerage,
+                             'http://probe.internal/', loop=self.loop)
+        try:
+            self.assertIsNotNone(await prober.probe(proxy))
+            self.assertEqual(prober.stats()['probes_failed'], 0)
+        finally:
+            await prober.stop()
+            server.close()
+            await server.wait_closed()
@@ -0,0 +1,49 @@
+import unittest
+from mimic.proxy_state import ProxyState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProxyState(unittest.TestCase):
+    def test_max_leases(self):
+        state = ProxyState(max_leases=2)
+        self.assertTrue(state.can_lease('a'))
+
+        state.leased('a')
+        state.leased('a')
+        self.assertFalse(state.can_lease('a'))
+        self.assertTrue(state.can_lease('b'))
+
+        state.returned('a')
+        self.assertTrue(state.can_lease('a'))
+        self.assertEqual(state.leases('a'), 1)
+
+    def test_unlimited_leases(self):
+        state = ProxyState()
+        for _ in range(100):
+            state.leased('a')
+        self.assertTrue(state.can_lease('a'))
+
+    def test_failure_score_decays(self):
+        clock = FakeClock()
+        state = ProxyState(failure_half_life=10, clock=clock)
+        self.assertEqual(state.weight('a'), 1)
+
+        state.record_failure('a')
+        state.record_failure('a')
+        self.assertEqual(state.failure_score('a'), 2)
+        self.assertAlmostEqual(state.weight('a'), 1 / 3)
+
+        clock.now = 10
+        self.assertAlmostEqual(state.failure_score('a'), 1)
+
+        state.record_failure('a')
+        clock.now = 20
+        self.assertAlmostEqual(state.stats()['failure_scores']['max'], 1)
+        self.assertEqual(state.stats()['leased']['count'], 0)
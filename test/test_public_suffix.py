@@ -0,0 +1,43 @@
+import unittest
+from mimic.public_suffix import PublicSuffixTrie, DEFAULT_SUFFIX_TRIE
+
+
+PSL_SAMPLE = """
+// A comment.
+com
+uk
+co.uk
+*.ck
+!www.ck
+"""
+
+
+class TestPublicSuffixTrie(unittest.TestCase):
+    def setUp(self):
+        self.trie = PublicSuffixTrie.from_string(PSL_SAMPLE)
+
+    def test_registrable_domain(self):
+        cases = {"example.com": "example.com",
+                 "a.b.example.com": "example.com",
+                 "www.example.co.uk": "example.co.uk",
+                 "co.uk": "co.uk",
+                 "foo.bar.ck": "foo.bar.ck",
+                 "a.foo.bar.ck": "foo.bar.ck",
+                 "www.ck": "www.ck",
+                 "a.www.ck": "www.ck",
+                 "unlisted.tld": "unlisted.tld",
+                 "a.unlisted.tld": "unlisted.tld"}
+
+        for host, expected in cases.items():
+            self.assertEqual(self.trie.registrable_domain(host), expected,
+                             host)
+
+    def test_ip_addresses_pass_through(self):
+        self.assertEqual(self.trie.registrable_domain("10.0.0.1"),
+                         "10.0.0.1")
+        self.assertEqual(self.trie.registrable_domain("[::1]"), "[::1]")
+
+    def test_default_trie(self):
+        self.assertEqual(
+            DEFAULT_SUFFIX_TRIE.registrable_domain("shop.example.com.au"),
+            "example.com.au")
@@ -0,0 +1,50 @@
+import unittest
+from mimic.query import Query
+
+
+POSTINGS = {'US': {'a', 'b'},
+            'CA': {'c'},
+            'GB': {'d'},
+            'HTTP-TRANSPARENT': {'a', 'c'},
+            'HTTP-HIGH': {'b', 'd', 'e'}}
+
+
+def postings(tag):
+    return POSTINGS.get(tag, set())
+
+
+class TestQuery(unittest.TestCase):
+    def test_parse(self):
+        query = Query.parse(['US|CA| GB', '!HTTP-TRANSPARENT', '', '|'])
+        self.assertEqual(query.groups, (('US', 'CA', 'GB'),))
+        self.assertEqual(query.negated, ('HTTP-TRANSPARENT',))
+        self.assertEqual(repr(query), "Query(US|CA|GB,!HTTP-TRANSPARENT)")
+
+    def test_compile_passes_queries_through(self):
+        query = Query.parse(['US'])
+        self.assertIs(Query.compile((query,)), query)
+        self.assertFalse(Query.compile(()))
+
+    def test_candidates(self):
+        available = {'a', 'b', 'c', 'd', 'e'}
+
+        def run(*requirements):
+            return set(Query.parse(requirements).candidates(available,
+                                                            postings))
+
+        self.assertEqual(run(), available)
+        self.assertEqual(run('US'), {'a', 'b'})
+        self.assertEqual(run('US|CA|GB'), {'a', 'b', 'c', 'd'})
+        self.assertEqual(run('US|CA|GB', '!HTTP-TRANSPARENT'), {'b', 'd'})
+        self.assertEqual(run('!US|CA'), {'d', 'e'})
+        self.assertEqual(run('US', 'HTTP-HIGH'), {'b'})
+        self.assertEqual(run('US', 'MISSING'), set())
+
+    def test_candidates_respect_availability(self):
+        query = Query.parse(['US|CA'])
+        self.assertEqual(set(query.candidates({'b', 'e'}, postings)), {'b'})
+
+    def test_available_is_not_mutated(self):
+        available = {'a', 'b', 'c'}
+        Query.parse(['!US']).candidates(available, postings)
+        self.assertEqual(available, {'a', 'b', 'c'})
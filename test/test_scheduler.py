@@ -0,0 +1,81 @@
+import unittest
+from mimic.scheduler import FairScheduler, MAX_IDLE_CLIENTS, Waiter
+
+
+def drain(scheduler, n):
+    served = []
+    for _ in range(n):
+        client = scheduler.clients_in_order()[0]
+        waiter = scheduler.waiters_of(client)[0]
+        scheduler.remove(waiter)
+        scheduler.charge(client)
+        served.append(client)
+    return served
+
+
+class TestFairScheduler(unittest.TestCase):
+    def push(self, scheduler, client, n):
+        waiters = [Waiter(client, None, None, 0) for _ in range(n)]
+        for waiter in waiters:
+            scheduler.push(waiter)
+        return waiters
+
+    def test_equal_weights_alternate(self):
+        scheduler = FairScheduler()
+        self.push(scheduler, 'big', 100)
+        self.push(scheduler, 'small', 2)
+
+        served = drain(scheduler, 4)
+        self.assertEqual(sorted(served), ['big', 'big', 'small', 'small'])
+        self.assertEqual(len(scheduler), 98)
+
+    def test_weights(self):
+        scheduler = FairScheduler({'a': 3, 'b': 1})
+        self.push(scheduler, 'a', 100)
+        self.push(scheduler, 'b', 100)
+
+        served = drain(scheduler, 40)
+        self.assertEqual(served.count('a'), 30)
+        self.assertEqual(served.count('b'), 10)
+
+    def test_idle_clients_do_not_bank_credit(self):
+        scheduler = FairScheduler()
+        self.push(scheduler, 'a', 10)
+        drain(scheduler, 5)
+
+        # 'b' arrives late; it shouldn't get 5 proxies in a row.
+        self.push(scheduler, 'b', 10)
+        served = drain(scheduler, 4)
+        self.assertEqual(sorted(served), ['a', 'a', 'b', 'b'])
+
+    def test_bad_weights(self):
+        for weights, default in [({'a': 0}, 1.0), ({'a': float('nan')}, 1.0),
+                                 ({'a': -1}, 1.0), ({}, 0), ({}, None)]:
+            with self.assertRaises(ValueError):
+                FairScheduler(weights, default)
+
+        scheduler = FairScheduler({'a': 2})
+        with self.assertRaises(ValueError):
+            scheduler.set_weights({'a': float('inf')})
+        self.assertEqual(scheduler.weight('a'), 2)
+
+    def test_idle_clients_pruned(self):
+        scheduler = FairScheduler()
+        self.push(scheduler, 'busy', 2)
+        for i in range(2 * MAX_IDLE_CLIENTS):
+            waiter, = self.push(scheduler, i, 1)
+            scheduler.remove(waiter)
+            scheduler.charge(i)
+
+        self.assertLessEqual(len(scheduler._finish), MAX_IDLE_CLIENTS + 1)
+        self.assertEqual(scheduler.clients_in_order(), ['busy'])
+        self.assertEqual(drain(scheduler, 2), ['busy', 'busy'])
+
+    def test_remove(self):
+        scheduler = FairScheduler()
+        waiter, = self.push(scheduler, 'a', 1)
+
+        self.assertTrue(scheduler.remove(waiter))
+        self.assertFalse(scheduler.remove(waiter))
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.clients_in_order(), [])
@@ -0,0 +1,47 @@
+import random
+import unittest
+from mimic.selection import ResponseTimeWeighted, ThompsonSampling
+
+
+class TestResponseTimeWeighted(unittest.TestCase):
+    def test_favours_fast_proxies(self):
+        random.seed(0)
+        policy = ResponseTimeWeighted()
+        times = {'fast': 0.1, 'slow': 0.9}
+        picks = [policy.choose(['fast', 'slow'], times) for _ in range(200)]
+        self.assertGreater(picks.count('fast'), picks.count('slow'))
+
+    def test_zero_response_times(self):
+        policy = ResponseTimeWeighted()
+        self.assertEqual(policy.choose(['a'], {'a': 0.0}), 'a')
+
+
+class TestThompsonSampling(unittest.TestCase):
+    def test_success_rate(self):
+        policy = ThompsonSampling()
+        self.assertEqual(policy.success_rate('a'), 0.5)
+
+        policy.record('a', False)
+        policy.record('a', False)
+        policy.record('a', True)
+        self.assertEqual(policy.success_rate('a'), 3 / 5)
+        self.assertEqual(policy.stats(), {
+            'policy': 'thompson',
+            'success_rates': {'count': 1, 'min': 3 / 5, 'median': 3 / 5,
+                              'max': 3 / 5}})
+
+        policy.forget('a')
+        self.assertEqual(policy.stats()['success_rates']['count'], 0)
+
+    def test_prefers_successful_throughput(self):
+        random.seed(0)
+        policy = ThompsonSampling()
+        for _ in range(20):
+            policy.record('reliable', False)
+            policy.record('flaky', False)
+            policy.record('flaky', True)
+
+        times = {'reliable': 0.5, 'flaky': 0.4}
+        picks = [policy.choose(['reliable', 'flaky'], times)
+                 for _ in range(100)]
+        self.assertGreater(picks.count('reliable'), 70)
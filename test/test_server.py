@@ -8,6 +8,15 @@ from mimic.util import ProxyProps
 from mimic.server import *
 
 
+THROTTLE = {'mode': 'fixed', 'return_delay': 30, 'bad_return_delay': 600}
+SELECTION = {'policy': 'response_time'}
+LATENCY = {'measured': {'samples': 0, 'mean': None},
+           'estimated': {'samples': 0, 'mean': None}}
+INDICES = {'proto': {'keys': 1, 'entries': 2},
+           'host': {'keys': 2, 'entries': 2},
+           'port': {'keys': 1, 'entries': 2}}
+
+
 @contextmanager
 def swap_argv(replacement):
     original = sys.argv
@@ -29,6 +38,22 @@ class TestServerUtil(unittest.TestCase):
     def test_csv_param(self):
         self.assertEqual(csv_param({'q': "a,b,c"}, 'q'), list('abc'))
 
+    def test_proxy_from_params(self):
+        proxy = proxy_from_params({'proto': 'http', 'host': 'me',
+                                   'port': '80', 'tags': 'acme, fast'})
+        self.assertEqual(proxy, {'proto': 'HTTP', 'host': 'ME', 'port': 80,
+                                 'resp_time': 0.0, 'tags': ['ACME', 'FAST']})
+
+        for params in [{'proto': 'http', 'host': 'me'},
+                       {'proto': 'http', 'host': 'me', 'port': 'x'},
+                       {'proto': 'http', 'host': 'me', 'port': 80,
+                        'resp_time': 'fast'}] + [
+                       {'proto': 'http', 'host': 'me', 'port': 80,
+                        'resp_time': resp_time}
+                       for resp_time in ['nan', 'inf', '-1']]:
+            with self.assertRaises(ValueError):
+                proxy_from_params(params)
+
     def test_human_json(self):
         self.assertEqual(human_json({'a': 10, 'b': 20}),
                          '{\n    "a": 10,\n    "b": 20\n}')
@@ -49,6 +74,20 @@ class TestServerUtil(unittest.TestCase):
             self.assertEqual(args.port, 80)
             self.assertTrue(args.debug)
 
+    def test_parse_log_args(self):
+        with swap_argv('run_server.py --log-format text --log-sample '
+                       'acquire=0.1 --log-sample release=0.5'):
+            args = parse_args()
+            self.assertEqual(args.log_format, 'text')
+            self.assertEqual(parse_sample_rates(args.log_sample),
+                             {'acquire': 0.1, 'release': 0.5})
+
+    def test_parse_handoff_args(self):
+        with swap_argv('run_server.py --handoff-socket /run/mimic.sock'):
+            args = parse_args()
+            self.assertEqual(args.handoff_socket, '/run/mimic.sock')
+            self.assertEqual(args.drain_timeout, DRAIN_TIMEOUT)
+
 
 class TestRestProxyBroker(AioHTTPTestCase):
 
@@ -59,10 +98,10 @@ class TestRestProxyBroker(AioHTTPTestCase):
         proxies.register_proxy(a.to_dict())
         proxies.register_proxy(b.to_dict())
         brokerage = Brokerage(proxies, broker_opts={'loop': loop})
-        app = RESTProxyBroker(proxy_collection=proxies,
-                              brokerage=brokerage,
-                              loop=loop)._app
-        return app
+        self.server = RESTProxyBroker(proxy_collection=proxies,
+                                      brokerage=brokerage,
+                                      loop=loop)
+        return self.server._app
 
     @unittest_run_loop
     async def test_get_index(self):
@@ -92,6 +131,114 @@ class TestRestProxyBroker(AioHTTPTestCase):
         self.assertEqual(req.status, 200)
         self.assertIn("HTTPS://LOCALHOST:9999", await req.json())
 
+    @unittest_run_loop
+    async def test_register_proxies(self):
+        batch = [{'proto': 'http', 'host': 'localhost', 'port': 9998},
+                 {'proto': 'http', 'host': 'localhost', 'port': 9999,
+                  'resp_time': 0.3, 'geo': 'us'}]
+        req = await self.client.request('POST', "/proxies/register_many",
+                                        data=json.dumps(batch))
+        self.assertEqual(req.status, 200)
+        self.assertEqual(await req.json(), {'msg': "OK", 'registered': 2})
+
+        req = await self.client.request('GET', '/proxies')
+        self.assertIn("HTTP://LOCALHOST:9999", await req.json())
+
+    @unittest_run_loop
+    async def test_register_proxies_bad_req(self):
+        req = await self.client.request('POST', "/proxies/register_many",
+                                        data="{}")
+        self.assertEqual(req.status, 400)
+
+        batch = [{'proto': 'http', 'host': 'localhost', 'port': 9998},
+                 {'proto': 'http', 'host': 'localhost', 'port': 'x'}, 7]
+        for i in 1, 2:
+            req = await self.client.request(
+                'POST', "/proxies/register_many",
+                data=json.dumps([batch[0], batch[i]]))
+            self.assertEqual(req.status, 400)
+            self.assertIn("Proxy 1", (await req.json())['err'])
+
+    @unittest_run_loop
+    async def test_delist_matching(self):
+        req = await self.client.request('POST', "/admin/proxies/delist",
+                                        data={'requirements': ''})
+        self.assertEqual(req.status, 400)
+
+        req = await self.client.request(
+            'POST', "/admin/proxies/delist",
+            data={'requirements': 'host:proxy-a'})
+        self.assertEqual(req.status, 200)
+        self.assertEqual(await req.json(), {
+            'delisted': 1, 'proxies': ["HTTP://PROXY-A:8888"]})
+
+        req = await self.client.request('GET', '/proxies')
+        self.assertEqual(await req.json(), ["HTTP://PROXY-B:8888"])
+
+    @unittest_run_loop
+    async def test_retag_matching(self):
+        req = await self.client.request(
+            'POST', "/admin/proxies/retag",
+            data={'requirements': 'port:8888'})
+        self.assertEqual(req.status, 400)
+
+        req = await self.client.request(
+            'POST', "/admin/proxies/retag",
+            data={'requirements': 'port:8888', 'add_tags': ', ,'})
+        self.assertEqual(req.status, 400)
+
+        req = await self.client.request(
+            'POST', "/admin/proxies/retag",
+            data={'requirements': 'host:proxy-b', 'geo': 'ca',
+                  'add_tags': 'fast, paid'})
+        self.assertEqual(req.status, 200)
+        self.assertEqual(await req.json(), {
+            'retagged': 1, 'proxies': ["HTTP://PROXY-B:8888"]})
+
+        req = await self.client.request('POST', "/proxies/acquire",
+                                        data={'url': "http://google.com/",
+                                              'requirements': 'CA,tag:PAID'})
+        self.assertEqual(req.status, 200)
+        self.assertEqual((await req.json())['proxy'], "HTTP://PROXY-B:8888")
+
+    @unittest_run_loop
+    async def test_export_usage(self):
+        req = await self.client.request('POST', "/proxies/acquire",
+                                        data={'url': "http://google.com/"})
+        self.assertEqual(req.status, 200)
+
+        req = await self.client.request('GET', "/export",
+                                        params={'chunk_rows': 1})
+        self.assertEqual(req.status, 200)
+        self.assertTrue(req.headers['Content-Type'].startswith('text/csv'))
+        lines = (await req.text()).splitlines()
+        self.assertEqual(lines[0], "domain,proxy,resp_time,measured,"
+                                   "acquisitions,failures,last_used")
+        self.assertEqual(sorted(line.split(',')[4] for line in lines[1:]),
+                         ['0', '1'])
+
+        req = await self.client.request('GET', "/export",
+                                        params={'format': 'npy'})
+        self.assertEqual(req.status, 200)
+        self.assertTrue((await req.read()).startswith(b'\x93NUMPY'))
+
+        for params in [{'format': 'xml'}, {'chunk_rows': 0},
+                       {'chunk_rows': MAX_CHUNK_ROWS + 1}]:
+            req = await self.client.request('GET', "/export", params=params)
+            self.assertEqual(req.status, 400)
+
+    @unittest_run_loop
+    async def test_memory_report(self):
+        req = await self.client.request('GET', "/memory",
+                                        params={'sample': 4})
+        self.assertEqual(req.status, 200)
+        self.assertIn('total', await req.json())
+
+        for sample in ['0', 'lots', str(MAX_SAMPLE_SIZE + 1)]:
+            req = await self.client.request('GET', "/memory",
+                                            params={'sample': sample})
+            self.assertEqual(req.status, 400)
+
     @unittest_run_loop
     async def test_acquire_good(self):
         req = await self.client.request('POST', '/proxies/acquire',
@@ -103,11 +250,52 @@ class TestRestProxyBroker(AioHTTPTestCase):
         self.assertIn(resp['proxy'], {'HTTP://PROXY-A:8888',
                                       'HTTP://PROXY-B:8888'})
 
+    @unittest_run_loop
+    async def test_acquire_hedged(self):
+        req = await self.client.request('POST', '/proxies/acquire',
+                                        data={'url': "http://google.com/",
+                                              'hedge': 2})
+        self.assertEqual(req.status, 200)
+        resp = await req.json()
+        self.assertEqual(set(resp['proxies']), {'HTTP://PROXY-A:8888',
+                                                'HTTP://PROXY-B:8888'})
+
+        req = await self.client.request('POST', '/proxies/acquire',
+                                        data={'url': "http://google.com/",
+                                              'hedge': 0})
+        self.assertEqual(req.status, 400)
+
+    @unittest_run_loop
+    async def test_policies(self):
+        req = await self.client.request('GET', '/admin/policies')
+        self.assertEqual(await req.json(), {'default': {}, 'domains': {}})
+
+        # Nothing to reload from.
+        req = await self.client.request('POST', '/admin/policies/reload')
+        self.assertEqual(req.status, 400)
+
+    @unittest_run_loop
+    async def test_acquire_while_handing_off(self):
+        self.server._draining = True
+        req = await self.client.request('POST', '/proxies/acquire',
+                                        data={'url': "http://google.com/"})
+        self.assertEqual(req.status, 503)
+        self.assertEqual(req.headers['Retry-After'], '0')
+
     @unittest_run_loop
     async def test_acquire_bad(self):
         req = await self.client.request('POST', '/proxies/acquire')
         self.assertEqual(req.status, 400)
 
+    @unittest_run_loop
+    async def test_acquire_multi_bad(self):
+        for urls in [[], ["http://google.com/a", "http://google.com/b"],
+                     ["http://google.com/", "nowhere"]]:
+            req = await self.client.request(
+                'POST', '/proxies/acquire_multi',
+                data=[('url', url) for url in urls])
+            self.assertEqual(req.status, 400)
+
     @unittest_run_loop
     async def test_release_proxy(self):
         req = await self.client.request('POST', '/proxies/acquire',
@@ -115,11 +303,60 @@ class TestRestProxyBroker(AioHTTPTestCase):
                                               'max_wait_time': 60})
         proxy = await req.json()
 
+        # Without the lease id or fence, it can't be told apart from a late
+        # release by an earlier holder.
         req = await self.client.request('POST', '/proxies/release',
-                                        data=proxy)
+                                        data={'broker': proxy['broker'],
+                                              'proxy': proxy['proxy']})
+        self.assertEqual(req.status, 400)
+        self.assertIn("lease id required", await req.json())
+
+        for response_time in ['nan', 'inf', 'abc', '-1']:
+            req = await self.client.request(
+                'POST', '/proxies/release',
+                data=dict(proxy, response_time=response_time))
+            self.assertEqual(req.status, 400)
+
+        req = await self.client.request('POST', '/proxies/release',
+                                        data=dict(proxy, response_time='0.5'))
         self.assertEqual(req.status, 200)
         self.assertEqual(await req.json(), True)
 
+        # The lease ended with the release, so repeating it is ignored.
+        req = await self.client.request('POST', '/proxies/release',
+                                        data=proxy)
+        self.assertEqual(await req.json(), False)
+
+    @unittest_run_loop
+    async def test_renew_lease(self):
+        req = await self.client.request('POST', '/proxies/acquire',
+                                        data={'url': "http://google.com/",
+                                              'max_wait_time': 60})
+        acquired = await req.json()
+        self.assertEqual(acquired['fence'], 1)
+
+        req = await self.client.request('POST', '/proxies/renew',
+                                        data={'broker': acquired['broker'],
+                                              'lease': acquired['lease'],
+                                              'extension': 120})
+        self.assertEqual(req.status, 200)
+        renewed = await req.json()
+        self.assertTrue(renewed['renewed'])
+        self.assertGreater(renewed['expires_in'], 60)
+
+        req = await self.client.request('POST', '/proxies/renew',
+                                        data={'broker': acquired['broker'],
+                                              'lease': 'nope'})
+        self.assertEqual(await req.json(), {'renewed': False,
+                                            'expires_in': None})
+
+        for extension in ['-5', 'nan', 'soon', '1e9']:
+            req = await self.client.request(
+                'POST', '/proxies/renew',
+                data={'broker': acquired['broker'],
+                      'lease': acquired['lease'], 'extension': extension})
+            self.assertEqual(req.status, 400)
+
     @unittest_run_loop
     async def test_list_all_stats(self):
         req = await self.client.request('GET', '/domains')
@@ -134,11 +371,21 @@ class TestRestProxyBroker(AioHTTPTestCase):
 
         req = await self.client.request('GET', '/domains')
         self.assertEqual(req.status, 200)
-        self.assertEqual(await req.json(),
+        stats = await req.json()
+        clients = stats['google.com'].pop('clients')
+        self.assertEqual(clients['default']['acquired'], 1)
+        self.assertEqual(stats,
                          {'google.com': {'acquisitions_processed': 1,
+                                         'waiting': 0,
+                                         'rejected': 0,
+                                         'leased': 1,
+                                         'throttle': THROTTLE,
+                                         'selection': SELECTION,
                                          'available': 1,
+                                         'free_slots': 1,
                                          'avg_resp_time': 0.1,
-                                         'indices': {}}})
+                                         'latency': LATENCY,
+                                         'indices': INDICES}})
 
     @unittest_run_loop
     async def test_get_domain_stats(self):
@@ -154,8 +401,89 @@ class TestRestProxyBroker(AioHTTPTestCase):
 
         req = await self.client.request('GET', '/domains/google.com')
         self.assertEqual(req.status, 200)
-        self.assertEqual(await req.json(),
+        stats = await req.json()
+        self.assertIn('default', stats.pop('clients'))
+        self.assertEqual(stats,
                          {'acquisitions_processed': 1,
+                          'waiting': 0,
+                          'rejected': 0,
+                          'leased': 1,
+                          'throttle': THROTTLE,
+                          'selection': SELECTION,
                           'available': 1,
+                          'free_slots': 1,
                           'avg_resp_time': 0.1,
-                          'indices': {}})
\ No newline at end of file
+                          'latency': LATENCY,
+                          'indices': INDICES})
+
+    @unittest_run_loop
+    async def test_get_domain_history(self):
+        req = await self.client.request('GET', '/domains/google.com/history')
+        self.assertEqual(req.status, 404)
+
+        await self.client.request('POST', '/proxies/acquire',
+                                  data={'url': "http://google.com/"})
+        req = await self.client.request('GET', '/domains/google.com/history',
+                                        params={'window': 60, 'step': 10})
+        self.assertEqual(req.status, 200)
+        history = await req.json()
+        self.assertEqual(history['step'], 10)
+        self.assertEqual(len(history['acquired']), 6)
+        self.assertEqual(sum(history['acquired']), 1)
+
+        for params in [{'step': 'soon'}, {'step': 'nan'},
+                       {'window': 'inf'}, {'window': '-60'}]:
+            req = await self.client.request(
+                'GET', '/domains/google.com/history', params=params)
+            self.assertEqual(req.status, 400)
+
+
+class TestDebugEndpoints(AioHTTPTestCase):
+
+    def get_app(self, loop):
+        proxies = ProxyCollection()
+        proxies.register_proxy(ProxyProps('http', 'proxy-a', 8888,
+                                          0.1).to_dict())
+        brokerage = Brokerage(proxies, broker_opts={'loop': loop})
+        return RESTProxyBroker(proxy_collection=proxies,
+                               brokerage=brokerage,
+                               loop=loop,
+                               debug_surface=DebugSurface(brokerage,
+                                                          loop))._app
+
+    @unittest_run_loop
+    async def test_debug_stats(self):
+        req = await self.client.request('POST', '/proxies/acquire',
+                                        data={'url': "http://google.com/",
+                                              'max_wait_time': 0})
+        self.assertEqual(req.status, 200)
+
+        req = await self.client.request('GET', '/debug')
+        self.assertEqual(req.status, 200)
+        stats = await req.json()
+        self.assertEqual(stats['tasks']['auto_return'], 1)
+        self.assertIn('broker', stats['handlers']['acquire_proxy'])
+        self.assertFalse(stats['profiler']['running'])
+
+    @unittest_run_loop
+    async def test_profiler_toggle(self):
+        req = await self.client.request('POST', '/debug/profiler',
+                                        data={'action': 'start'})
+        self.assertTrue((await req.json())['running'])
+
+        req = await self.client.request('POST', '/debug/profiler',
+                                        data={'action': 'stop'})
+        self.assertFalse((await req.json())['running'])
+
+        req = await self.client.request('GET', '/debug/profiler')
+        self.assertEqual(req.status, 200)
+
+        req = await self.client.request('POST', '/debug/profiler',
+                                        data={'action': 'pause'})
+        self.assertEqual(req.status, 400)
+
+        for interval in ['fast', 'nan', 'inf', '0', '2']:
+            req = await self.client.request('POST', '/debug/profiler',
+                                            data={'action': 'start',
+                                                  'interval': interval})
+            self.assertEqual(req.status, 400)
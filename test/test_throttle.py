@@ -0,0 +1,47 @@
+import unittest
+from mimic.throttle import AdaptiveThrottle, FixedThrottle
+
+
+class TestFixedThrottle(unittest.TestCase):
+    def test_cooldowns(self):
+        throttle = FixedThrottle(30, 600)
+        self.assertEqual(throttle.cooldown('a', False), 30)
+        self.assertEqual(throttle.cooldown('a', True), 600)
+        self.assertEqual(throttle.mean_cooldown(), 30)
+
+
+class TestAdaptiveThrottle(unittest.TestCase):
+    def test_additive_decrease(self):
+        throttle = AdaptiveThrottle(initial_delay=5, min_delay=2,
+                                    decrease_step=1)
+        cooldowns = [throttle.cooldown('a', False) for _ in range(5)]
+        self.assertEqual(cooldowns, [4, 3, 2, 2, 2])
+
+    def test_multiplicative_increase(self):
+        throttle = AdaptiveThrottle(initial_delay=10, max_delay=50,
+                                    increase_factor=2)
+        cooldowns = [throttle.cooldown('a', True) for _ in range(3)]
+        self.assertEqual(cooldowns, [20, 40, 50])
+
+        # Other proxies are unaffected.
+        self.assertEqual(throttle.cooldown('b', False), 9)
+
+    def test_initial_delay_clamped(self):
+        throttle = AdaptiveThrottle(initial_delay=30, min_delay=60,
+                                    max_delay=120)
+        self.assertEqual(throttle.mean_cooldown(), 60)
+
+    def test_stats(self):
+        throttle = AdaptiveThrottle(initial_delay=5, decrease_step=1)
+        throttle.cooldown('a', False)
+        throttle.cooldown('b', True)
+
+        stats = throttle.stats()
+        self.assertEqual(stats['cooldowns'], {'count': 2, 'min': 4,
+                                              'median': 7, 'max': 10})
+        self.assertEqual(stats['mean_cooldown'], 7)
+        self.assertAlmostEqual(stats['sustainable_rate'], 1 / 4 + 1 / 10)
+
+        throttle.forget('b')
+        self.assertEqual(throttle.current('b'), 5)
+        self.assertEqual(throttle.stats()['cooldowns']['count'], 1)
@@ -1,6 +1,9 @@
+import logging
 import unittest
 from itertools import product
-from mimic.util import parse_and_intern_domain, ProxyProps
+from mimic.util import (parse_and_intern_domain, ProxyProps, DomainResolver,
+                        extract_netloc, host_from_netloc, setup_logger,
+                        summarize)
 
 
 class TestGetAccessor(unittest.TestCase):
@@ -30,3 +33,61 @@ class TestGetAccessor(unittest.TestCase):
         c = ProxyProps(proto, host, port, 2.0, 'ca', 'low')
         self.assertEqual(a, c)
 
+
+    def test_summarize(self):
+        self.assertEqual(summarize([]), {'count': 0, 'min': None,
+                                         'median': None, 'max': None})
+        self.assertEqual(summarize([3, 1, 2]), {'count': 3, 'min': 1,
+                                                'median': 2, 'max': 3})
+        self.assertEqual(summarize(iter([4, 1, 2, 3]))['median'], 2.5)
+
+
+class TestDomainResolver(unittest.TestCase):
+    def test_extract_netloc(self):
+        self.assertEqual(extract_netloc("http://WWW.Yahoo.com/a?b#c"),
+                         "www.yahoo.com")
+        self.assertEqual(extract_netloc("https://u:p@example.com:443"),
+                         "example.com:443")
+        self.assertEqual(extract_netloc("//example.com?q=1"), "example.com")
+        self.assertEqual(extract_netloc("example.com/path"), "")
+
+    def test_host_from_netloc(self):
+        self.assertEqual(host_from_netloc("example.com:443"), "example.com")
+        self.assertEqual(host_from_netloc("example.com"), "example.com")
+        self.assertEqual(host_from_netloc("[::1]:8080"), "[::1]")
+
+    def test_groupings(self):
+        urls = ["http://a.cdn.example.com/x", "http://b.cdn.example.com/",
+                "https://example.com:443/"]
+
+        netloc = DomainResolver('netloc')
+        self.assertEqual(len({netloc.resolve(u) for u in urls}), 3)
+
+        host = DomainResolver('host')
+        self.assertEqual(host.resolve(urls[2]), "example.com")
+
+        registrable = DomainResolver('registrable')
+        domains = [registrable.resolve(u) for u in urls]
+        self.assertEqual(set(domains), {"example.com"})
+        self.assertIs(domains[0], domains[1])
+
+        self.assertEqual(registrable.resolve("http://www.bbc.co.uk/news"),
+                         "bbc.co.uk")
+
+    def test_bounded_cache(self):
+        resolver = DomainResolver(max_interned=2)
+        for i in range(10):
+            resolver.resolve("http://host-{}.com/".format(i))
+        self.assertEqual(len(resolver._cache), 2)
+        self.assertIn("host-9.com", resolver._cache)
+
+    def test_unknown_grouping(self):
+        with self.assertRaises(ValueError):
+            DomainResolver('tld')
+
+    def test_setup_logger_once(self):
+        setup_logger('a')
+        setup_logger('a')
+        setup_logger('b')
+        self.assertEqual(logging.getLogger('mimic.a').handlers, [])
+        self.assertEqual(len(logging.getLogger('mimic').handlers), 1)